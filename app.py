@@ -1,178 +1,49 @@
 import os
+import threading
 import streamlit as st
 import pandas as pd
-from datetime import datetime, date
-import calendar
-from math import ceil
+
+from collections import OrderedDict
+from dataclasses import replace
+
+from roster_engine import (
+    DemandParams, ScheduleSettings, PassCheckpoints, open_store, store_backend,
+    days_in_month, preference_maps, seed_demand_from_beds, run_schedule,
+    input_fingerprint,
+)
 
 # ================== 基本設定與資料路徑 ==================
 st.set_page_config(page_title="Nurse Roster • 自助註冊版", layout="wide")
 
-# 資料目錄設在目前工作目錄，避免無權限路徑
+# 資料目錄設在目前工作目錄，避免無權限路徑；目錄裡有 nursing.db（見 nursing-schedule-migrate）就用 SQLite
 DATA_DIR = os.path.join(os.getcwd(), "nursing_data")
-os.makedirs(DATA_DIR, exist_ok=True)
 
-USERS_CSV = os.path.join(DATA_DIR, "users.csv")                     # 人員清單
-PREFS_CSV_TMPL = os.path.join(DATA_DIR, "prefs_{year}_{month}.csv") # 員工請休
-HOLIDAYS_CSV_TMPL = os.path.join(DATA_DIR, "holidays_{year}_{month}.csv")  # 例假日
-EXTRA_CSV_TMPL = os.path.join(DATA_DIR, "extra_{year}_{month}.csv")        # 加開人力
+# 資料存取物件整個行程共用（所有 session、每次重跑都是同一個）：讀檔快取跨重跑有效，
+# 寫入鎖與 SQLite 連線、建表也不必每次重跑重建。以目錄與實際後端為鍵，匯入 nursing.db 後自動換成 SQLite
+@st.cache_resource
+def get_store(data_dir, backend):
+    return open_store(data_dir, backend)
+
+store = get_store(DATA_DIR, store_backend(DATA_DIR))
 
 # 預設護理長帳密（建議實際使用時改掉）
 ADMIN_USER = "headnurse"
 ADMIN_PASS = "admin123"
 
-# 班別時間（24 小時制，用於計算 11 小時休息）
-SHIFT = {
-    "D": {"start": 8,  "end": 16},
-    "E": {"start": 16, "end": 24},
-    "N": {"start": 0,  "end": 8},
-    "O": {}  # 休假
-}
-
-ORDER = ["D", "E", "N"]  # 排班處理順序
-
-# ================== 工具函式 ==================
-def days_in_month(year: int, month: int) -> int:
-    return calendar.monthrange(year, month)[1]
-
-def is_sunday(y: int, m: int, d: int) -> bool:
-    return datetime(y, m, d).weekday() == 6  # 週日
-
-def week_index(day: int) -> int:
-    if day <= 7: return 1
-    if day <= 14: return 2
-    if day <= 21: return 3
-    if day <= 28: return 4
-    return 5
-
-def rest_ok(prev_code: str, next_code: str) -> bool:
-    """
-    檢查前一日班別(prev_code)與當日班別(next_code)之間是否有 >= 11 小時休息
-    O（休假）不列入限制。
-    """
-    if prev_code in (None, "", "O") or next_code in (None, "", "O"):
-        return True
-    s1, e1 = SHIFT[prev_code]["start"], SHIFT[prev_code]["end"]
-    s2, e2 = SHIFT[next_code]["start"], SHIFT[next_code]["end"]
-    rest = s2 - e1
-    if rest < 0:
-        rest += 24
-    return rest >= 11
-
-def normalize_id(x) -> str:
-    if pd.isna(x):
-        return ""
-    return str(x).strip()
-
-# ================== 資料存取 ==================
-def load_users():
-    if os.path.exists(USERS_CSV):
-        df = pd.read_csv(USERS_CSV, dtype=str).fillna("")
-    else:
-        df = pd.DataFrame(columns=["employee_id","name","pwd4","shift","weekly_cap","senior","junior"])
-        df.to_csv(USERS_CSV, index=False)
-    for c in ["employee_id","name","pwd4","shift","weekly_cap","senior","junior"]:
-        if c not in df.columns:
-            df[c] = ""
-    return df
-
-def save_users(df):
-    df.to_csv(USERS_CSV, index=False)
-
-def prefs_path(year, month):
-    return PREFS_CSV_TMPL.format(year=year, month=f"{month:02d}")
-
-def load_prefs(year, month):
-    p = prefs_path(year, month)
-    if os.path.exists(p):
-        df = pd.read_csv(p, dtype=str).fillna("")
-        for c in ["nurse_id","date","type"]:
-            if c not in df.columns:
-                df[c] = ""
-        return df
-    return pd.DataFrame(columns=["nurse_id","date","type"])
-
-def save_prefs(df, year, month):
-    df.to_csv(prefs_path(year, month), index=False)
-
-def load_holidays(year, month):
-    p = HOLIDAYS_CSV_TMPL.format(year=year, month=f"{month:02d}")
-    if os.path.exists(p):
-        df = pd.read_csv(p, dtype=str).fillna("")
-        if "date" not in df.columns:
-            df["date"] = ""
-        return df
-    return pd.DataFrame(columns=["date"])
-
-def save_holidays(df, year, month):
-    df.to_csv(HOLIDAYS_CSV_TMPL.format(year=year, month=f"{month:02d}"), index=False)
-
-def load_extra(year, month):
-    p = EXTRA_CSV_TMPL.format(year=year, month=f"{month:02d}")
-    if os.path.exists(p):
-        df = pd.read_csv(p).fillna(0)
-    else:
-        nd = days_in_month(year, month)
-        df = pd.DataFrame({
-            "day": list(range(1, nd+1)),
-            "D_extra": [0]*nd,
-            "E_extra": [0]*nd,
-            "N_extra": [0]*nd,
-        })
-    for c in ["day","D_extra","E_extra","N_extra"]:
-        if c not in df.columns:
-            df[c] = 0
-    return df
-
-def save_extra(df, year, month):
-    df.to_csv(EXTRA_CSV_TMPL.format(year=year, month=f"{month:02d}"), index=False)
-
-# ================== 護病比 → 每日需求（能力單位） ==================
-def seed_demand_from_beds(y, m, total_beds,
-                          d_ratio_min=6, d_ratio_max=7,
-                          e_ratio_min=10, e_ratio_max=12,
-                          n_ratio_min=15, n_ratio_max=16,
-                          extra_df=None):
-    rows = []
-    nd = days_in_month(y, m)
-    ext = extra_df if extra_df is not None else pd.DataFrame(columns=["day","D_extra","E_extra","N_extra"])
-    if "day" in ext.columns:
-        ext = ext.set_index("day")
-    for d in range(1, nd+1):
-        D_min = ceil(total_beds / max(d_ratio_max,1))
-        D_max = ceil(total_beds / max(d_ratio_min,1))
-        E_min = ceil(total_beds / max(e_ratio_max,1))
-        E_max = ceil(total_beds / max(e_ratio_min,1))
-        N_min = ceil(total_beds / max(n_ratio_max,1))
-        N_max = ceil(total_beds / max(n_ratio_min,1))
-        d_ex = int(ext.at[d,"D_extra"]) if d in ext.index else 0
-        e_ex = int(ext.at[d,"E_extra"]) if d in ext.index else 0
-        n_ex = int(ext.at[d,"N_extra"]) if d in ext.index else 0
-        rows.append({
-            "day": d,
-            "D_min_units": int(D_min + d_ex),
-            "D_max_units": int(D_max + d_ex),
-            "E_min_units": int(E_min + e_ex),
-            "E_max_units": int(E_max + e_ex),
-            "N_min_units": int(N_min + n_ex),
-            "N_max_units": int(N_max + n_ex),
-        })
-    return pd.DataFrame(rows)
-
-# ================== 能力單位：新人護病比 1:4 ==================
-def per_person_units(is_junior: bool, shift_code: str,
-                     d_avg: float, e_avg: float, n_avg: float,
-                     jr_ratio: float = 4.0):
-    """
-    正式人員：1 單位（護病比依你設定）
-    新人：護病比固定 1:4，能力 = 4 / 該班別平均護病比（通常 < 1）
-    """
-    if not is_junior:
-        return 1.0
-    base = {"D": d_avg, "E": e_avg, "N": n_avg}.get(shift_code, d_avg)
-    if base <= 0:
-        return 1.0
-    return jr_ratio / base
+# ================== 資料存取（見 roster_engine.data / sqlite_store） ==================
+load_users = store.load_users
+save_users = store.save_users
+load_prefs = store.load_prefs
+save_prefs = store.save_prefs
+load_holidays = store.load_holidays
+save_holidays = store.save_holidays
+load_extra = store.load_extra
+save_extra = store.save_extra
+load_shifts = store.load_shifts
+
+# CSV 讀檔由 CsvStore 依（路徑、mtime、大小）快取、save_* 時作廢（SQLite 走索引查詢）；衍生的需求表依參數內容快取，
+# 畫面每次重跑（含 data_editor 每次輸入）都不必重算
+cached_seed_demand = st.cache_data(max_entries=32, show_spinner=False)(seed_demand_from_beds)
 
 # ================== 登入與自助註冊 ==================
 def sidebar_auth():
@@ -189,17 +60,14 @@ def sidebar_auth():
         rname = st.text_input("姓名", key="reg_name")
         rpwd  = st.text_input("身分證末四碼（做為密碼）", key="reg_pwd",
                               type="password", max_chars=4)
-        rshift = st.selectbox("固定班別", ["D","E","N"], key="reg_shift")
+        rshift = st.selectbox("固定班別", list(load_shifts()), key="reg_shift")
         rsen   = st.checkbox("資深", value=False, key="reg_sen")
         rjun   = st.checkbox("新人", value=False, key="reg_jun")
         if st.button("建立帳號", key="reg_btn"):
-            users = load_users()
-            if (users["employee_id"] == rid).any():
-                st.warning("此員工編號已存在，請直接登入。")
-            elif rid.strip()=="" or rpwd.strip()=="":
+            if rid.strip()=="" or rpwd.strip()=="":
                 st.error("員編與末四碼不可空白。")
-            else:
-                new = pd.DataFrame([{
+            # 只新增這一位；員編已存在（含同時有人註冊同一員編）就不寫入，不會蓋掉別人的密碼
+            elif not store.add_user({
                     "employee_id": rid.strip(),
                     "name": rname.strip(),
                     "pwd4": rpwd.strip(),
@@ -207,9 +75,9 @@ def sidebar_auth():
                     "weekly_cap": "",
                     "senior": "TRUE" if rsen else "FALSE",
                     "junior": "TRUE" if rjun else "FALSE",
-                }])
-                users = pd.concat([users, new], ignore_index=True)
-                save_users(users)
+                }):
+                st.warning("此員工編號已存在，請直接登入。")
+            else:
                 st.success("註冊成功！請回到上方欄位用員編＋末四碼登入。")
 
     if login_btn:
@@ -221,12 +89,11 @@ def sidebar_auth():
             st.sidebar.success("已以管理者登入")
             return
         # 一般員工
-        users = load_users()
-        row = users[users["employee_id"].astype(str) == acct]
-        if row.empty:
+        row = store.find_user(acct)
+        if row is None:
             st.sidebar.error("查無此員工。請先在下方『自助註冊』建立帳號。")
             return
-        if str(row.iloc[0]["pwd4"]).strip() != str(pwd).strip():
+        if str(row["pwd4"]).strip() != str(pwd).strip():
             st.sidebar.error("密碼錯誤（請輸入身分證末四碼）")
             return
         st.session_state["role"] = "user"
@@ -259,38 +126,24 @@ with colD:
     with c5: n_ratio_min = st.number_input("大最少", 1, 200, 15)
     with c6: n_ratio_max = st.number_input("大最多", 1, 200, 16)
 
-d_avg = (d_ratio_min + d_ratio_max) / 2.0
-e_avg = (e_ratio_min + e_ratio_max) / 2.0
-n_avg = (n_ratio_min + n_ratio_max) / 2.0
+shift_catalogue = load_shifts()
+shift_codes = list(shift_catalogue)
+
+demand_params = DemandParams(total_beds, d_ratio_min, d_ratio_max,
+                             e_ratio_min, e_ratio_max, n_ratio_min, n_ratio_max)
 
 role = st.session_state.get("role", None)
 
 # ================== 員工端（必休選取，其餘自動想休） ==================
 if role == "user":
-    users = load_users()
-    me = users[users["employee_id"] == st.session_state["acct"]].iloc[0]
+    me = store.find_user(st.session_state["acct"])
     my_id = me["employee_id"]
     st.success(f"👤 你好，{me['name']}（{my_id}）。固定班別：{me['shift']}；資深：{me['senior']}；新人：{me['junior']}")
 
     prefs_df = load_prefs(year, month)
-    my = prefs_df[prefs_df["nurse_id"] == my_id].copy()
-
-    def to_dateset(df):
-        s = set()
-        if df.empty:
-            return s
-        for r in df.itertuples(index=False):
-            raw = getattr(r, "date", "")
-            if pd.isna(raw) or str(raw).strip()=="":
-                continue
-            dt = pd.to_datetime(raw, errors="coerce")
-            if pd.isna(dt):
-                continue
-            if int(dt.year) == int(year) and int(dt.month) == int(month):
-                s.add(int(dt.day))
-        return s
-
-    must_set = to_dateset(my[my["type"]=="must"])
+
+    must_map, _wish_map = preference_maps(prefs_df, year, month)
+    must_set = must_map.get(my_id.strip(), set())
 
     st.subheader("⛔ 必休（請選取本月日期）")
     options = list(range(1, nd+1))
@@ -320,24 +173,8 @@ if role == "user":
         st.dataframe(wish_df_preview, use_container_width=True, height=240)
 
     if st.button("💾 儲存我的請休（必休 + 想休自動）"):
-        must_new_rows = [{
-            "nurse_id": my_id,
-            "date": f"{year}-{month:02d}-{d:02d}",
-            "type": "must"
-        } for d in sorted(must_days)]
-
-        wish_new_rows = [{
-            "nurse_id": my_id,
-            "date": f"{year}-{month:02d}-{d:02d}",
-            "type": "wish"
-        } for d in range(1, nd+1) if d not in must_days]
-
-        must_new_df = pd.DataFrame(must_new_rows)
-        wish_new_df = pd.DataFrame(wish_new_rows)
-
-        others = prefs_df[prefs_df["nurse_id"] != my_id].copy()
-        merged = pd.concat([others, must_new_df, wish_new_df], ignore_index=True)
-        save_prefs(merged, year, month)
+        # 只寫入自己當月的一列（必休日清單；想休日隱含為其餘天數），同時送出的其他人不受影響
+        store.save_nurse_prefs(my_id, year, month, must_days)
         st.success("已儲存完成！")
 
     st.stop()
@@ -354,113 +191,137 @@ if role != "admin":
 # ================== 管理端畫面 ==================
 st.success("✅ 以護理長（管理者）身份登入")
 
+# 各編輯區是獨立的 fragment：在某一區編輯只重跑那一區（不重跑登入、讀檔與其他表）。
+# 排班用得到的內容發佈到 session_state（以年月為鍵）：加開人力 → 需求表 → 排班。
+# 人員與假日由排班時從資料檔讀取，按「儲存」即生效。
+def published_key(name):
+    return f"admin_{name}_{year}_{month:02d}"
+
 # ---- 1) 人員清單 ----
-st.subheader("👥 人員清單（員工也可自助註冊）")
-users_raw = load_users().copy()
+@st.fragment
+def users_section():
+    st.subheader("👥 人員清單（員工也可自助註冊）")
+    users_view = load_users()
+    users_view["senior"] = users_view["senior"].astype(str).str.upper().isin(["TRUE","1","YES","Y","T"])
+    users_view["junior"] = users_view["junior"].astype(str).str.upper().isin(["TRUE","1","YES","Y","T"])
+
+    users_view = st.data_editor(
+        users_view,
+        use_container_width=True,
+        num_rows="dynamic",
+        height=360,
+        column_config={
+            "employee_id": st.column_config.TextColumn("員工編號（帳號）"),
+            "name":        st.column_config.TextColumn("姓名"),
+            "pwd4":        st.column_config.TextColumn("密碼（身分證末四碼）"),
+            "shift":       st.column_config.TextColumn("固定班別 " + "/".join(shift_codes)),
+            "weekly_cap":  st.column_config.TextColumn("每週上限天（可空白）"),
+            "senior":      st.column_config.CheckboxColumn("資深"),
+            "junior":      st.column_config.CheckboxColumn("新人"),
+        },
+        key="admin_users"
+    )
 
-users_view = users_raw.copy()
-users_view["senior"] = users_view["senior"].astype(str).str.upper().isin(["TRUE","1","YES","Y","T"])
-users_view["junior"] = users_view["junior"].astype(str).str.upper().isin(["TRUE","1","YES","Y","T"])
+    if st.button("💾 儲存人員清單"):
+        users_out = users_view.copy()
+        users_out["senior"] = users_out["senior"].map(lambda v: "TRUE" if bool(v) else "FALSE")
+        users_out["junior"] = users_out["junior"].map(lambda v: "TRUE" if bool(v) else "FALSE")
+        save_users(users_out)
+        st.success("已儲存人員清單。")
 
-users_view = st.data_editor(
-    users_view,
-    use_container_width=True,
-    num_rows="dynamic",
-    height=360,
-    column_config={
-        "employee_id": st.column_config.TextColumn("員工編號（帳號）"),
-        "name":        st.column_config.TextColumn("姓名"),
-        "pwd4":        st.column_config.TextColumn("密碼（身分證末四碼）"),
-        "shift":       st.column_config.TextColumn("固定班別 D/E/N"),
-        "weekly_cap":  st.column_config.TextColumn("每週上限天（可空白）"),
-        "senior":      st.column_config.CheckboxColumn("資深"),
-        "junior":      st.column_config.CheckboxColumn("新人"),
-    },
-    key="admin_users"
-)
-
-if st.button("💾 儲存人員清單"):
-    users_out = users_view.copy()
-    users_out["senior"] = users_out["senior"].map(lambda v: "TRUE" if bool(v) else "FALSE")
-    users_out["junior"] = users_out["junior"].map(lambda v: "TRUE" if bool(v) else "FALSE")
-    save_users(users_out)
-    st.success("已儲存人員清單。")
+users_section()
 
 # ---- 2) 員工請休彙整 ----
 st.subheader("📥 員工請休彙整（本月）")
 prefs_df = load_prefs(year, month)
-st.dataframe(prefs_df, use_container_width=True, height=260)
-
-# ---- 3) 假日清單 ----
-st.subheader("📅 假日清單（例假日/國定假日等）")
-hol_df = load_holidays(year, month)
-hol_df = st.data_editor(
-    hol_df,
+st.dataframe(
+    prefs_df,
     use_container_width=True,
-    num_rows="dynamic",
-    height=180,
-    key="admin_holidays"
-)
-if st.button("💾 儲存假日清單"):
-    save_holidays(hol_df, year, month)
-    st.success("已儲存假日清單。")
-
-holiday_set = set()
-for r in hol_df.itertuples(index=False):
-    raw = getattr(r, "date", "")
-    if pd.isna(raw) or str(raw).strip()=="":
-        continue
-    dt = pd.to_datetime(raw, errors="coerce")
-    if pd.isna(dt):
-        continue
-    if int(dt.year)==int(year) and int(dt.month)==int(month):
-        holiday_set.add(date(int(dt.year), int(dt.month), int(dt.day)))
-
-# ---- 4) 每日加開人力 ----
-st.subheader("📈 每日加開人力（單位；加在 min/max 上）")
-extra_df = load_extra(year, month)
-extra_df = st.data_editor(
-    extra_df,
-    use_container_width=True,
-    num_rows="fixed",
-    height=300,
+    height=260,
     column_config={
-        "day":      st.column_config.NumberColumn("day", min_value=1, max_value=nd, step=1),
-        "D_extra":  st.column_config.NumberColumn("白班加開", min_value=0, max_value=1000, step=1),
-        "E_extra":  st.column_config.NumberColumn("小夜加開", min_value=0, max_value=1000, step=1),
-        "N_extra":  st.column_config.NumberColumn("大夜加開", min_value=0, max_value=1000, step=1),
+        "nurse_id": st.column_config.TextColumn("員工編號"),
+        "must":     st.column_config.TextColumn("必休日"),
+        "wish":     st.column_config.TextColumn("想休日（空白 = 其餘天數；- = 無）"),
     },
-    key="admin_extra"
 )
-if st.button("💾 儲存加開人力"):
-    save_extra(extra_df, year, month)
-    st.success("已儲存每日加開人力。")
+
+# ---- 3) 假日清單 ----
+@st.fragment
+def holidays_section():
+    st.subheader("📅 假日清單（例假日/國定假日等）")
+    hol_df = st.data_editor(
+        load_holidays(year, month),
+        use_container_width=True,
+        num_rows="dynamic",
+        height=180,
+        key="admin_holidays"
+    )
+    if st.button("💾 儲存假日清單"):
+        save_holidays(hol_df, year, month)
+        st.success("已儲存假日清單。")
+
+holidays_section()
+
+# ---- 4) 每日加開人力 ----
+@st.fragment
+def extra_section():
+    st.subheader("📈 每日加開人力（單位；加在 min/max 上）")
+    extra_df = st.data_editor(
+        load_extra(year, month, shift_codes),
+        use_container_width=True,
+        num_rows="fixed",
+        height=300,
+        column_config={
+            "day":      st.column_config.NumberColumn("day", min_value=1, max_value=nd, step=1),
+            **{f"{s}_extra": st.column_config.NumberColumn(
+                   f"{shift_catalogue[s].get('label', s)}加開", min_value=0, max_value=1000, step=1)
+               for s in shift_codes},
+        },
+        key="admin_extra"
+    )
+    if st.button("💾 儲存加開人力"):
+        save_extra(extra_df, year, month)
+        st.success("已儲存每日加開人力。")
+
+    key = published_key("extra")
+    previous = st.session_state.get(key)
+    st.session_state[key] = extra_df
+    if previous is not None and not previous.equals(extra_df):
+        # 需求表依加開人力產生：數字真的變了才整頁重跑一次，讓需求區與排班拿到新值
+        st.rerun()
+
+extra_section()
 
 # ---- 5) 每日三班需求（能力單位） ----
-st.subheader("📋 每日三班需求（能力單位；可再微調）")
-df_demand_auto = seed_demand_from_beds(
-    year, month, total_beds,
-    d_ratio_min, d_ratio_max,
-    e_ratio_min, e_ratio_max,
-    n_ratio_min, n_ratio_max,
-    extra_df=extra_df
-)
-df_demand = st.data_editor(
-    df_demand_auto,
-    use_container_width=True,
-    num_rows="fixed",
-    height=380,
-    column_config={
-        "day":          st.column_config.NumberColumn("day", min_value=1, max_value=nd, step=1),
-        "D_min_units":  st.column_config.NumberColumn("D_min_units", min_value=0, max_value=1000, step=1),
-        "D_max_units":  st.column_config.NumberColumn("D_max_units", min_value=0, max_value=1000, step=1),
-        "E_min_units":  st.column_config.NumberColumn("E_min_units", min_value=0, max_value=1000, step=1),
-        "E_max_units":  st.column_config.NumberColumn("E_max_units", min_value=0, max_value=1000, step=1),
-        "N_min_units":  st.column_config.NumberColumn("N_min_units", min_value=0, max_value=1000, step=1),
-        "N_max_units":  st.column_config.NumberColumn("N_max_units", min_value=0, max_value=1000, step=1),
-    },
-    key="demand_editor"
-)
+@st.fragment
+def demand_section():
+    st.subheader("📋 每日三班需求（能力單位；可再微調）")
+    extra_df = st.session_state.get(published_key("extra"))
+    if extra_df is None:
+        extra_df = load_extra(year, month, shift_codes)
+    df_demand_auto = cached_seed_demand(
+        year, month, total_beds,
+        d_ratio_min, d_ratio_max,
+        e_ratio_min, e_ratio_max,
+        n_ratio_min, n_ratio_max,
+        extra_df=extra_df,
+        catalogue=shift_catalogue
+    )
+    st.session_state[published_key("demand")] = st.data_editor(
+        df_demand_auto,
+        use_container_width=True,
+        num_rows="fixed",
+        height=380,
+        column_config={
+            "day":          st.column_config.NumberColumn("day", min_value=1, max_value=nd, step=1),
+            **{col: st.column_config.NumberColumn(col, min_value=0, max_value=1000, step=1)
+               for s in shift_codes for col in (f"{s}_min_units", f"{s}_max_units")},
+        },
+        key="demand_editor"
+    )
+
+demand_section()
+df_demand = st.session_state[published_key("demand")]
 
 # ---- 6) 排班規則 ----
 st.subheader("⚙️ 排班規則")
@@ -478,1330 +339,107 @@ min_work_stretch    = st.number_input("最小連續上班天數（避免上一
 min_work_days = st.number_input("每人每月最少上班天數", 0, nd, 15, 1)
 max_work_days = st.number_input("每人每月最多上班天數", 0, nd, 22, 1)
 
-# 「半月休假基底」改為 0，代表不強制依 1–15 / 16–月底切半
-MIN_OFF_BEFORE_15 = 0
-MIN_OFF_AFTER_15  = 0
-
-TARGET_OFF_DAYS = 10    # 目標月休 ≈ 10 天（整體）
-MAX_WORK_STREAK  = 5     # 最大連續上班 5 天
-MAX_OFF_STREAK   = 2     # 連續休假盡量不超過 2 天
-
-# ================== 排班主邏輯：initial ==================
-def build_initial_schedule(year, month, users_df, prefs_df, demand_df,
-                           d_avg, e_avg, n_avg):
-    nd = days_in_month(year, month)
-
-    tmp = users_df.copy()
-    for col in ["employee_id","shift","weekly_cap","senior","junior"]:
-        if col not in tmp.columns:
-            tmp[col] = ""
-    tmp["employee_id"] = tmp["employee_id"].map(normalize_id)
-    tmp["shift"] = tmp["shift"].astype(str).str.upper().map(
-        lambda s: s if s in ("D","E","N") else ""
-    )
-    tmp = tmp[(tmp["employee_id"].astype(str).str.len()>0) & (tmp["shift"].isin(["D","E","N"]))]
-
-    def to_bool(x):
-        return str(x).strip().upper() in ("TRUE","1","YES","Y","T")
-
-    def to_wcap(x):
-        try:
-            v = int(float(x))
-            return v if v >= 0 else None
-        except:
-            return None
-
-    role_map   = {r.employee_id: r.shift   for r in tmp.itertuples(index=False)}
-    wcap_map   = {r.employee_id: to_wcap(r.weekly_cap) for r in tmp.itertuples(index=False)}
-    senior_map = {r.employee_id: to_bool(r.senior) for r in tmp.itertuples(index=False)}
-    junior_map = {r.employee_id: to_bool(r.junior) for r in tmp.itertuples(index=False)}
-    id_list    = sorted(role_map.keys(), key=lambda s: s)
-
-    # 偏好 map
-    def build_date_map(df, typ):
-        m = {nid:set() for nid in id_list}
-        if df.empty:
-            return m
-        df2 = df[df["type"]==typ] if "type" in df.columns else pd.DataFrame(columns=["nurse_id","date"])
-        for r in df2.itertuples(index=False):
-            nid = normalize_id(getattr(r,"nurse_id",""))
-            raw = getattr(r,"date","")
-            if nid not in m:
-                continue
-            if pd.isna(raw) or str(raw).strip()=="":
-                continue
-            dt = pd.to_datetime(raw, errors="coerce")
-            if pd.isna(dt):
-                continue
-            if int(dt.year)==int(year) and int(dt.month)==int(month):
-                m[nid].add(int(dt.day))
-        return m
-
-    must_map = build_date_map(prefs_df, "must")
-    wish_map = build_date_map(prefs_df, "wish")
-
-    demand = {}
-    for r in demand_df.itertuples(index=False):
-        d = int(r.day)
-        demand[d] = {
-            "D": (int(r.D_min_units), int(r.D_max_units)),
-            "E": (int(r.E_min_units), int(r.E_max_units)),
-            "N": (int(r.N_min_units), int(r.N_max_units)),
-        }
-
-    sched = {nid: {d:"" for d in range(1, nd+1)} for nid in id_list}
-    assigned_days = {nid: 0 for nid in id_list}
-
-    def week_assigned(nid, w):
-        if w==1: rng = range(1,8)
-        elif w==2: rng = range(8,15)
-        elif w==3: rng = range(15,22)
-        elif w==4: rng = range(22,29)
-        else: rng = range(29, nd+1)
-        return sum(1 for dd in rng if sched[nid][dd] in ("D","E","N"))
-
-    def person_units_on(nid, s):
-        return per_person_units(junior_map.get(nid,False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    # 先標必休 O（不可被後續邏輯改掉）
-    for nid in id_list:
-        for d in must_map[nid]:
-            if 1 <= d <= nd:
-                sched[nid][d] = "O"
-
-    # 選人池
-    def pick_pool(d, s):
-        wk = week_index(d)
-        pool = []
-        for nid in id_list:
-            if role_map[nid] != s:
-                continue
-            if sched[nid][d] != "":
-                continue
-            if not rest_ok(sched[nid].get(d-1,""), s):
-                continue
-            cap = wcap_map[nid]
-            if cap is not None and week_assigned(nid, wk) >= cap:
-                continue
-            wished = 1 if d in wish_map[nid] else 0
-            pool.append((wished, assigned_days[nid], nid))
-        pool.sort()
-        return [nid for (_,_,nid) in pool]
-
-    # 逐日逐班排班
-    for d in range(1, nd+1):
-        for s in ORDER:
-            mn_u, mx_u = demand.get(d,{}).get(s, (0,0))
-            assigned = []
-            units_sum = 0.0
-            senior_cnt = 0
-
-            # 先達到 min_units
-            while units_sum + 1e-9 < mn_u:
-                pool = pick_pool(d, s)
-                if not pool:
-                    break
-
-                # 首位必有資深（避免新人成為唯一）
-                if senior_cnt == 0:
-                    non_j = [nid for nid in pool if not junior_map.get(nid, False)]
-                    if non_j:
-                        pool = non_j
-                    else:
-                        break
-
-                if s == "D":
-                    need_sen = ceil((len(assigned)+1)/3)
-                    cand_sen = [nid for nid in pool if senior_map.get(nid,False)]
-                    pick_list = cand_sen if (senior_cnt < need_sen and cand_sen) else pool
-                else:
-                    pick_list = pool
-
-                if not pick_list:
-                    break
-
-                nid = pick_list[0]
-                sched[nid][d] = s
-                assigned_days[nid] += 1
-                assigned.append(nid)
-                units_sum += person_units_on(nid, s)
-                if senior_map.get(nid,False):
-                    senior_cnt += 1
-
-            # 再往 max_units 補
-            while units_sum + 1e-9 < mx_u:
-                pool = pick_pool(d, s)
-                if not pool:
-                    break
-
-                if senior_cnt == 0:
-                    non_j = [nid for nid in pool if not junior_map.get(nid, False)]
-                    if non_j:
-                        pool = non_j
-                    else:
-                        break
-
-                if s == "D":
-                    need_sen = ceil((len(assigned)+1)/3)
-                    cand_sen = [nid for nid in pool if senior_map.get(nid,False)]
-                    pick_list = cand_sen if (senior_cnt < need_sen and cand_sen) else pool
-                else:
-                    pick_list = pool
-
-                if not pick_list:
-                    break
-
-                nid = pick_list[0]
-                sched[nid][d] = s
-                assigned_days[nid] += 1
-                assigned.append(nid)
-                units_sum += person_units_on(nid, s)
-                if senior_map.get(nid,False):
-                    senior_cnt += 1
-
-        # 其餘沒被排到的人 → O（但不覆蓋原本必休 O）
-        for nid in id_list:
-            if sched[nid][d] == "":
-                sched[nid][d] = "O"
-
-    return sched, demand, role_map, id_list, senior_map, junior_map, wcap_map, must_map, wish_map
-
-# ================== 各種調整函式 ==================
-def cross_shift_balance_with_units(year, month, id_list, sched,
-                                   demand, role_map, senior_map, junior_map,
-                                   d_avg, e_avg, n_avg):
-    nd = days_in_month(year, month)
-
-    def units_of(nid, s):
-        return per_person_units(junior_map.get(nid,False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    for d in range(1, nd+1):
-        actual = {s: sum(units_of(nid,s) for nid in id_list if sched[nid][d]==s)
-                  for s in ORDER}
-        mins = {s: demand.get(d,{}).get(s,(0,0))[0] for s in ORDER}
-
-        changed = True
-        while changed:
-            changed = False
-            shortages = [(s, mins[s]-actual[s]) for s in ORDER
-                         if actual[s] + 1e-9 < mins[s]]
-            if not shortages:
-                break
-            shortages.sort(key=lambda x: -x[1])
-
-            for tgt, _need in shortages:
-                for src in ORDER:
-                    if src == tgt:
-                        continue
-                    if actual[src] - 1e-9 <= mins.get(src,0):
-                        continue
-                    candidates = [nid for nid in id_list
-                                  if sched[nid][d]==src and not junior_map.get(nid,False)]
-                    candidates.sort(key=lambda nid: -units_of(nid, src))
-                    moved = False
-
-                    for mv in candidates:
-                        def senior_ok_after_move(nid_move, from_s, to_s):
-                            if from_s!="D" and to_s!="D":
-                                return True
-                            d_people = [x for x in id_list if sched[x][d]=="D"]
-                            if from_s=="D" and nid_move in d_people:
-                                d_people.remove(nid_move)
-                            if to_s=="D":
-                                d_people.append(nid_move)
-                            total = len(d_people)
-                            if total==0:
-                                return True
-                            sen = sum(1 for x in d_people if senior_map.get(x,False))
-                            return sen >= ceil(total/3)
-
-                        if not senior_ok_after_move(mv, src, tgt):
-                            continue
-                        if not (rest_ok(sched[mv].get(d-1,""), tgt) and
-                                rest_ok(tgt, sched[mv].get(d+1,""))):
-                            continue
-
-                        u_from = units_of(mv, src)
-                        u_to   = units_of(mv, tgt)
-                        sched[mv][d] = tgt
-                        actual[src] -= u_from
-                        actual[tgt] += u_to
-                        changed = True
-                        moved = True
-                        break
-                    if moved:
-                        break
-    return sched
-
-def prefer_off_on_holidays(year, month, sched, demand_df, id_list,
-                           role_map, senior_map, junior_map,
-                           d_avg, e_avg, n_avg, holiday_set):
-    nd = days_in_month(year, month)
-    demand = {int(r.day):{
-                "D":(int(r.D_min_units),int(r.D_max_units)),
-                "E":(int(r.E_min_units),int(r.E_max_units)),
-                "N":(int(r.N_min_units),int(r.N_max_units))}
-              for r in demand_df.itertuples(index=False)}
-
-    def is_hday(d):
-        return is_sunday(year, month, d) or (date(year,month,d) in holiday_set)
-
-    def units_of(nid, s):
-        return per_person_units(junior_map.get(nid,False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    def actual_units(d, s):
-        return sum(units_of(nid,s) for nid in id_list if sched[nid][d]==s)
-
-    def white_senior_ok_if_remove(d, nid):
-        if sched[nid][d] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d]=="D" and x != nid]
-        total = len(d_people)
-        if total==0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x,False))
-        return sen >= ceil(total/3)
-
-    for d in range(1, nd+1):
-        if not is_hday(d):
-            continue
-        for s in ("D","E","N"):
-            mn, _ = demand.get(d,{}).get(s,(0,0))
-
-            changed = True
-            while changed:
-                changed = False
-                cur = actual_units(d, s)
-                if cur <= mn + 1e-9:
-                    break
-
-                cands = [nid for nid in id_list if sched[nid][d]==s]
-                cands.sort(key=lambda nid: (units_of(nid,s),
-                                            not junior_map.get(nid,False)))
-                moved = False
-                for nid in cands:
-                    u = units_of(nid,s)
-                    if cur - u + 1e-9 < mn:
-                        continue
-                    if not white_senior_ok_if_remove(d,nid):
-                        continue
-                    if not (rest_ok(sched[nid].get(d-1,""), "O") and
-                            rest_ok("O", sched[nid].get(d+1,""))):
-                        continue
-                    sched[nid][d] = "O"
-                    changed = True
-                    moved = True
-                    break
-                if not moved:
-                    break
-    return sched
-
-def enforce_weekly_one_off(year, month, sched, demand_df, id_list,
-                           role_map, senior_map, junior_map,
-                           d_avg, e_avg, n_avg, holiday_set):
-    nd = days_in_month(year, month)
-    demand = {int(r.day):{
-                "D":(int(r.D_min_units),int(r.D_max_units)),
-                "E":(int(r.E_min_units),int(r.E_max_units)),
-                "N":(int(r.N_min_units),int(r.N_max_units))}
-              for r in demand_df.itertuples(index=False)}
-
-    def units_of(nid, s):
-        return per_person_units(junior_map.get(nid,False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    def actual_units(d, s):
-        return sum(units_of(nid,s) for nid in id_list if sched[nid][d]==s)
-
-    def white_senior_ok_if_remove(d, nid):
-        if sched[nid][d] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d]=="D" and x != nid]
-        total = len(d_people)
-        if total==0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x,False))
-        return sen >= ceil(total/3)
-
-    def week_range(w):
-        if w==1: return range(1,8)
-        if w==2: return range(8,15)
-        if w==3: return range(15,22)
-        if w==4: return range(22,29)
-        return range(29, nd+1)
-
-    def has_off(nid, w):
-        rng = [d for d in week_range(w) if 1 <= d <= nd]
-        return any(sched[nid][d] == "O" for d in rng)
-
-    for nid in id_list:
-        for w in [1,2,3,4,5]:
-            rng = [d for d in week_range(w) if 1 <= d <= nd]
-            if not rng:
-                continue
-            if has_off(nid, w):
-                continue
-            candidates = sorted(rng, key=lambda d: (0 if is_sunday(year, month, d) else 1,))
-            for d in candidates:
-                cur = sched[nid][d]
-                if cur == "O":
-                    break
-                mn = demand.get(d,{}).get(cur,(0,0))[0]
-                u  = units_of(nid, cur)
-                if actual_units(d, cur) - u + 1e-9 < mn:
-                    continue
-                if not white_senior_ok_if_remove(d, nid):
-                    continue
-                if not (rest_ok(sched[nid].get(d-1,""), "O") and
-                        rest_ok("O", sched[nid].get(d+1,""))):
-                    continue
-                sched[nid][d] = "O"
-                break
-    return sched
-
-def enforce_min_monthly_off(year, month, sched, demand_df, id_list,
-                            role_map, senior_map, junior_map,
-                            d_avg, e_avg, n_avg,
-                            min_off=8, balance=True, holiday_set=None,
-                            target_off=10):
-    nd = days_in_month(year, month)
-    if holiday_set is None:
-        holiday_set = set()
-    if target_off is None:
-        target_off = min_off
-    target_off = max(min_off, target_off)
-
-    demand = {int(r.day):{
-                "D":(int(r.D_min_units),int(r.D_max_units)),
-                "E":(int(r.E_min_units),int(r.E_max_units)),
-                "N":(int(r.N_min_units),int(r.N_max_units))}
-              for r in demand_df.itertuples(index=False)}
-
-    def is_hday(d):
-        return is_sunday(year, month, d) or (date(year,month,d) in holiday_set)
-
-    def units_of(nid, s):
-        return per_person_units(junior_map.get(nid,False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    def actual_units(d, s):
-        return sum(units_of(nid,s) for nid in id_list if sched[nid][d]==s)
-
-    def white_senior_ok_if_remove(d, nid):
-        if sched[nid][d] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d]=="D" and x != nid]
-        total = len(d_people)
-        if total==0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x,False))
-        return sen >= ceil(total/3)
-
-    def off_count(nid):
-        return sum(1 for d in range(1, nd+1) if sched[nid][d]=="O")
-
-    def try_add_one_off(nid):
-        if off_count(nid) >= target_off:
-            return False
-        work_days = [(d, sched[nid][d]) for d in range(1, nd+1)
-                     if sched[nid][d] in ("D","E","N")]
-        if not work_days:
-            return False
-        scored = []
-        for d, s in work_days:
-            mn = demand.get(d,{}).get(s,(0,0))[0]
-            u  = units_of(nid, s)
-            slack = actual_units(d, s) - mn
-            feasible = (slack + 1e-9 >= u) and white_senior_ok_if_remove(d,nid) \
-                       and rest_ok(sched[nid].get(d-1,""), "O") \
-                       and rest_ok("O", sched[nid].get(d+1,""))
-            if feasible:
-                scored.append((1 if is_hday(d) else 2, -slack, d))
-        if not scored:
-            return False
-        scored.sort()
-        chosen_d = scored[0][2]
-        sched[nid][chosen_d] = "O"
-        return True
-
-    # 先確保至少 min_off
-    changed = True
-    while changed:
-        changed = False
-        needs = sorted([nid for nid in id_list if off_count(nid) < min_off],
-                       key=lambda x: off_count(x))
-        if not needs:
-            break
-        for nid in needs:
-            if try_add_one_off(nid):
-                changed = True
-        if not changed:
-            break
-
-    if not balance:
-        return sched
-
-    # 平衡 O，讓大家接近
-    def off_span():
-        cnts = [off_count(n) for n in id_list]
-        return (max(cnts) if cnts else 0) - (min(cnts) if cnts else 0)
-
-    guard = 0
-    while off_span() > 1 and guard < 200:
-        guard += 1
-        nid_low = min(id_list, key=lambda x: off_count(x))
-        if not try_add_one_off(nid_low):
-            break
-
-    return sched
-
-def enforce_min_work_stretch(year, month, sched, demand_df, id_list,
-                             role_map, senior_map, junior_map,
-                             d_avg, e_avg, n_avg, min_stretch=3,
-                             holiday_set=None, must_map=None):
-    nd = days_in_month(year, month)
-    if holiday_set is None:
-        holiday_set = set()
-    if must_map is None:
-        must_map = {}
-
-    demand = {int(r.day):{
-                "D":(int(r.D_min_units),int(r.D_max_units)),
-                "E":(int(r.E_min_units),int(r.E_max_units)),
-                "N":(int(r.N_min_units),int(r.N_max_units))}
-              for r in demand_df.itertuples(index=False)}
-
-    def units_of(nid, s):
-        return per_person_units(junior_map.get(nid,False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    def actual_units(d, s):
-        return sum(units_of(x,s) for x in id_list if sched[x][d]==s)
-
-    def white_senior_ok_if_add(d, nid):
-        if role_map[nid] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d]=="D"] + [nid]
-        total = len(d_people)
-        if total==0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x,False))
-        return sen >= ceil(total/3)
-
-    def white_senior_ok_if_remove(d, nid):
-        if sched[nid][d] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d]=="D" and x != nid]
-        total = len(d_people)
-        if total==0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x,False))
-        return sen >= ceil(total/3)
-
-    def work_streak_before(nid, d):
-        k = 0
-        dd = d-1
-        while dd >= 1 and sched[nid][dd] in ("D","E","N"):
-            k += 1
-            dd -= 1
-        return k
-
-    def try_move_off_forward(nid, d):
-        if d in must_map.get(nid, set()):
-            return False
-
-        s_fixed = role_map[nid]
-        if s_fixed not in ("D","E","N"):
-            return False
-        mn_d, mx_d = demand.get(d,{}).get(s_fixed,(0,0))
-        if actual_units(d, s_fixed) + units_of(nid,s_fixed) > mx_d + 1e-9:
-            return False
-        if not rest_ok(sched[nid].get(d-1,""), s_fixed) or \
-           not rest_ok(s_fixed, sched[nid].get(d+1,"")):
-            return False
-        if not white_senior_ok_if_add(d, nid):
-            return False
-
-        for d2 in range(d+1, nd+1):
-            s2 = sched[nid][d2]
-            if s2 not in ("D","E","N"):
-                continue
-            mn2, _mx2 = demand.get(d2,{}).get(s2,(0,0))
-            if actual_units(d2,s2) - units_of(nid,s2) + 1e-9 < mn2:
-                continue
-            if not white_senior_ok_if_remove(d2, nid):
-                continue
-            if not (rest_ok(sched[nid].get(d2-1,""), "O") and
-                    rest_ok("O", sched[nid].get(d2+1,""))):
-                continue
-            sched[nid][d]  = s_fixed
-            sched[nid][d2] = "O"
-            return True
-        return False
-
-    changed = True
-    guard = 0
-    while changed and guard < 3:
-        guard += 1
-        changed = False
-        for nid in id_list:
-            for d in range(1, nd+1):
-                if d in must_map.get(nid, set()):
-                    continue
-                if sched[nid][d] != "O":
-                    continue
-                if work_streak_before(nid, d) < min_stretch:
-                    if try_move_off_forward(nid, d):
-                        changed = True
-    return sched
-
-def enforce_streak_preferences(year, month, sched, demand_df, id_list,
-                               role_map, senior_map, junior_map,
-                               d_avg, e_avg, n_avg,
-                               max_work_streak=5, max_off_streak=2,
-                               min_monthly_off=8,
-                               min_before=0, min_after=0,
-                               target_off=10,
-                               holiday_set=None, must_map=None):
-    nd = days_in_month(year, month)
-    if holiday_set is None:
-        holiday_set = set()
-    if must_map is None:
-        must_map = {}
-
-    demand = {int(r.day):{
-                "D":(int(r.D_min_units),int(r.D_max_units)),
-                "E":(int(r.E_min_units),int(r.E_max_units)),
-                "N":(int(r.N_min_units),int(r.N_max_units))}
-              for r in demand_df.itertuples(index=False)}
-
-    def units_of(nid, s):
-        return per_person_units(junior_map.get(nid,False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    def actual_units(d, s):
-        return sum(units_of(x,s) for x in id_list if sched[x][d]==s)
-
-    def off_total(nid):
-        return sum(1 for d in range(1, nd+1) if sched[nid][d]=="O")
-
-    def off_before(nid):
-        return sum(1 for d in range(1, min(15, nd)+1) if sched[nid][d]=="O")
-
-    def off_after(nid):
-        return sum(1 for d in range(16, nd+1) if sched[nid][d]=="O")
-
-    def white_senior_ok_if_add(d, nid):
-        if role_map[nid] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d]=="D"] + [nid]
-        total = len(d_people)
-        if total==0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x,False))
-        return sen >= ceil(total/3)
-
-    def white_senior_ok_if_remove(d, nid):
-        if sched[nid][d] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d]=="D" and x != nid]
-        total = len(d_people)
-        if total==0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x,False))
-        return sen >= ceil(total/3)
-
-    # 1) 最大連續上班天數（> max_work_streak 會試圖插 O）
-    for nid in id_list:
-        d = 1
-        while d <= nd:
-            if sched[nid][d] not in ("D","E","N"):
-                d += 1
-                continue
-            start = d
-            while d+1 <= nd and sched[nid][d+1] in ("D","E","N"):
-                d += 1
-            end = d
-            length = end - start + 1
-            if length > max_work_streak:
-                for mid in range(start+1, end):
-                    if mid in must_map.get(nid,set()):
-                        continue
-                    s_mid = sched[nid][mid]
-                    mn = demand.get(mid,{}).get(s_mid,(0,0))[0]
-                    u  = units_of(nid, s_mid)
-                    if actual_units(mid, s_mid) - u + 1e-9 < mn:
-                        continue
-                    if not white_senior_ok_if_remove(mid, nid):
-                        continue
-                    if off_total(nid) + 1 > target_off + 2:
-                        continue
-                    if not (rest_ok(sched[nid].get(mid-1,""), "O") and
-                            rest_ok("O", sched[nid].get(mid+1,""))):
-                        continue
-                    sched[nid][mid] = "O"
-                    break
-            d += 1
-
-    # 2) 限制連續休假天數（> max_off_streak 時嘗試插上班）
-    for nid in id_list:
-        d = 1
-        while d <= nd:
-            if sched[nid][d] != "O":
-                d += 1
-                continue
-            start = d
-            while d+1 <= nd and sched[nid][d+1] == "O":
-                d += 1
-            end = d
-            length = end - start + 1
-            if length > max_off_streak:
-                s_fixed = role_map[nid]
-                if s_fixed not in ("D","E","N"):
-                    d += 1
-                    continue
-
-                for mid in range(start+1, end):
-                    if mid in must_map.get(nid,set()):
-                        continue
-                    if mid <= 15:
-                        if min_before > 0 and off_before(nid) - 1 < min_before:
-                            continue
-                    else:
-                        if min_after > 0 and off_after(nid) - 1 < min_after:
-                            continue
-                    if off_total(nid) - 1 < min_monthly_off:
-                        continue
-
-                    mn, mx = demand.get(mid,{}).get(s_fixed,(0,0))
-                    if actual_units(mid, s_fixed) + units_of(nid,s_fixed) > mx + 1e-9:
-                        continue
-                    if not white_senior_ok_if_add(mid, nid):
-                        continue
-                    if not (rest_ok(sched[nid].get(mid-1,""), s_fixed) and
-                            rest_ok(s_fixed, sched[nid].get(mid+1,""))):
-                        continue
-                    sched[nid][mid] = s_fixed
-                    break
-            d += 1
-
-    return sched
-
-def hard_break_long_work_streaks(year, month, sched, demand_df, id_list,
-                                 role_map, senior_map, junior_map,
-                                 d_avg, e_avg, n_avg,
-                                 max_work_streak=5,
-                                 min_monthly_off=8,
-                                 must_map=None):
-    """
-    更強制版：只要某人連續上班 > max_work_streak，就盡量在中間插 O
-    只確保：
-      1) 當日能力 >= min_units
-      2) 白班資深比例維持 >= 1/3
-      3) 這個人月休最後 >= min_monthly_off
-    """
-    nd = days_in_month(year, month)
-    if must_map is None:
-        must_map = {}
-
-    demand = {int(r.day): {
-                "D": (int(r.D_min_units), int(r.D_max_units)),
-                "E": (int(r.E_min_units), int(r.E_max_units)),
-                "N": (int(r.N_min_units), int(r.N_max_units)),
-              } for r in demand_df.itertuples(index=False)}
-
-    def units_of(nid, s):
-        return per_person_units(junior_map.get(nid, False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    def actual_units(d, s):
-        return sum(units_of(x, s) for x in id_list if sched[x][d] == s)
-
-    def off_total(nid):
-        return sum(1 for d in range(1, nd + 1) if sched[nid][d] == "O")
-
-    def white_senior_ok_if_to_O(d, nid):
-        """把某人從 D 變成 O 時，白班資深比例是否仍 >= 1/3"""
-        if sched[nid][d] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d] == "D" and x != nid]
-        total = len(d_people)
-        if total == 0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x, False))
-        return sen >= ceil(total / 3)
-
-    for nid in id_list:
-        d = 1
-        while d <= nd:
-            if sched[nid][d] not in ("D", "E", "N"):
-                d += 1
-                continue
-
-            start = d
-            while d + 1 <= nd and sched[nid][d + 1] in ("D", "E", "N"):
-                d += 1
-            end = d
-            length = end - start + 1
-
-            if length > max_work_streak:
-                cur_off = off_total(nid)
-                needed_breaks = ceil(length / max_work_streak) - 1
-
-                candidates = list(range(start + 1, end))
-                score_list = []
-                for day in candidates:
-                    if day in must_map.get(nid, set()):
-                        continue
-                    s_code = sched[nid][day]
-                    mn, _mx = demand.get(day, {}).get(s_code, (0, 0))
-                    u = units_of(nid, s_code)
-                    slack = actual_units(day, s_code) - u - mn
-                    score_list.append((slack, day, s_code, u))
-
-                score_list.sort(reverse=True, key=lambda x: x[0])
-
-                used = 0
-                for slack, day, s_code, u in score_list:
-                    if used >= needed_breaks:
-                        break
-                    if slack < -1e-9:
-                        continue
-                    if not white_senior_ok_if_to_O(day, nid):
-                        continue
-                    if cur_off + 1 < min_monthly_off:
-                        pass
-                    sched[nid][day] = "O"
-                    cur_off += 1
-                    used += 1
-
-            d += 1
-
-    return sched
-
-def smooth_short_work_segments(year, month, sched, demand_df, id_list,
-                               role_map, senior_map, junior_map,
-                               d_avg, e_avg, n_avg,
-                               min_stretch=3,
-                               min_monthly_off=8,
-                               min_before=0,
-                               min_after=0,
-                               holiday_set=None,
-                               must_map=None):
-    nd = days_in_month(year, month)
-    if holiday_set is None:
-        holiday_set = set()
-    if must_map is None:
-        must_map = {}
-
-    demand = {int(r.day):{
-                "D":(int(r.D_min_units),int(r.D_max_units)),
-                "E":(int(r.E_min_units),int(r.E_max_units)),
-                "N":(int(r.N_min_units),int(r.N_max_units))}
-              for r in demand_df.itertuples(index=False)}
-
-    def units_of(nid, s):
-        return per_person_units(junior_map.get(nid,False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    def actual_units(d, s):
-        return sum(units_of(x,s) for x in id_list if sched[x][d]==s)
-
-    def off_total(nid):
-        return sum(1 for d in range(1, nd+1) if sched[nid][d]=="O")
-
-    def off_before(nid):
-        return sum(1 for d in range(1, min(15, nd)+1) if sched[nid][d]=="O")
-
-    def off_after(nid):
-        return sum(1 for d in range(16, nd+1) if sched[nid][d]=="O")
-
-    def white_senior_ok_if_add(d, nid):
-        if role_map[nid] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d]=="D"] + [nid]
-        total = len(d_people)
-        if total==0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x,False))
-        return sen >= ceil(total/3)
-
-    for nid in id_list:
-        d = 1
-        while d <= nd:
-            if sched[nid][d] not in ("D","E","N"):
-                d += 1
-                continue
-            start = d
-            while d+1 <= nd and sched[nid][d+1] in ("D","E","N"):
-                d += 1
-            end = d
-            length = end - start + 1
-            if length < min_stretch:
-                extended = True
-                while length < min_stretch and extended:
-                    extended = False
-                    # 左邊
-                    ld = start - 1
-                    if ld >= 1 and sched[nid][ld] == "O" and ld not in must_map.get(nid,set()):
-                        if off_total(nid) - 1 >= min_monthly_off:
-                            if (ld <= 15 and (min_before == 0 or off_before(nid) - 1 >= min_before)) or \
-                               (ld >= 16 and (min_after == 0 or off_after(nid) - 1 >= min_after)):
-                                s_fixed = role_map[nid]
-                                if s_fixed in ("D","E","N"):
-                                    mn, mx = demand.get(ld,{}).get(s_fixed,(0,0))
-                                    if actual_units(ld, s_fixed) + units_of(nid,s_fixed) <= mx + 1e-9:
-                                        if white_senior_ok_if_add(ld, nid):
-                                            if rest_ok(sched[nid].get(ld-1,""), s_fixed) and \
-                                               rest_ok(s_fixed, sched[nid].get(ld+1,"")):
-                                                sched[nid][ld] = s_fixed
-                                                start = ld
-                                                extended = True
-                    # 右邊
-                    rd = end + 1
-                    if length < min_stretch and rd <= nd and sched[nid][rd] == "O" and rd not in must_map.get(nid,set()):
-                        if off_total(nid) - 1 >= min_monthly_off:
-                            if (rd <= 15 and (min_before == 0 or off_before(nid) - 1 >= min_before)) or \
-                               (rd >= 16 and (min_after == 0 or off_after(nid) - 1 >= min_after)):
-                                s_fixed = role_map[nid]
-                                if s_fixed in ("D","E","N"):
-                                    mn, mx = demand.get(rd,{}).get(s_fixed,(0,0))
-                                    if actual_units(rd, s_fixed) + units_of(nid,s_fixed) <= mx + 1e-9:
-                                        if white_senior_ok_if_add(rd, nid):
-                                            if rest_ok(sched[nid].get(rd-1,""), s_fixed) and \
-                                               rest_ok(s_fixed, sched[nid].get(rd+1,"")):
-                                                sched[nid][rd] = s_fixed
-                                                end = rd
-                                                extended = True
-                    length = end - start + 1
-            d += 1
-
-    return sched
-
-def ensure_no_seven_consecutive_work(year, month, sched, id_list, must_map=None):
-    """
-    最後防線：任何人連續上班 >= 7 天，就一定拆開，插入 O
-    （這裡不再看 min_units / 資深比例，只優先符合勞基法不連七）。
-    """
-    if must_map is None:
-        must_map = {}
-    nd = days_in_month(year, month)
-
-    for nid in id_list:
-        d = 1
-        while d <= nd:
-            if sched[nid][d] not in ("D", "E", "N"):
-                d += 1
-                continue
-
-            start = d
-            while d + 1 <= nd and sched[nid][d + 1] in ("D", "E", "N"):
-                d += 1
-            end = d
-            length = end - start + 1
-
-            if length >= 7:
-                needed_breaks = (length - 1) // 6
-
-                insert_points = []
-                base = start + 5
-                while base <= end and len(insert_points) < needed_breaks:
-                    insert_points.append(base)
-                    base += 6
-
-                for day in insert_points:
-                    choose = None
-                    for delta in range(0, 3):
-                        for cand in [day - delta, day + delta]:
-                            if cand < start or cand > end:
-                                continue
-                            if cand < 1 or cand > nd:
-                                continue
-                            if cand in must_map.get(nid, set()):
-                                continue
-                            if sched[nid][cand] in ("D", "E", "N"):
-                                choose = cand
-                                break
-                        if choose is not None:
-                            break
-
-                    if choose is not None:
-                        sched[nid][choose] = "O"
-
-            d += 1
-
-    return sched
-
-def enforce_workday_limits(year, month, sched, demand_df, id_list,
-                           role_map, senior_map, junior_map,
-                           d_avg, e_avg, n_avg,
-                           min_work_days, max_work_days,
-                           min_monthly_off, max_work_streak,
-                           holiday_set=None, must_map=None):
-    """
-    限制每個人「本月總上班天數」介於 [min_work_days, max_work_days]：
-      - 若超過 max_work_days：找幾天上班改成 O
-      - 若低於 min_work_days：找幾天 O 改成該人的固定班別
-    並且：
-      - 不打破每日 min_units
-      - 白班仍維持資深 >= 1/3
-      - 不把月休壓到 min_monthly_off 以下
-      - 不製造 > max_work_streak 或 >=7 天連班
-    """
-    nd = days_in_month(year, month)
-
-    # 防呆：若設定顛倒就互換
-    if min_work_days > max_work_days:
-        min_work_days, max_work_days = max_work_days, min_work_days
-
-    # 需求表轉成好查的 dict
-    demand = {
-        int(r.day): {
-            "D": (int(r.D_min_units), int(r.D_max_units)),
-            "E": (int(r.E_min_units), int(r.E_max_units)),
-            "N": (int(r.N_min_units), int(r.N_max_units)),
-        }
-        for r in demand_df.itertuples(index=False)
-    }
-
-    if holiday_set is None:
-        holiday_set = set()
-    if must_map is None:
-        must_map = {nid: set() for nid in id_list}
-
-    def is_hday(d):
-        return is_sunday(year, month, d) or (date(year, month, d) in holiday_set)
-
-    def units_of(nid, s):
-        return per_person_units(junior_map.get(nid, False),
-                                s, d_avg, e_avg, n_avg, 4.0)
-
-    def actual_units(d, s):
-        return sum(units_of(x, s) for x in id_list if sched[x][d] == s)
-
-    def off_total(nid):
-        return sum(1 for d in range(1, nd + 1) if sched[nid][d] == "O")
-
-    def work_total(nid):
-        return sum(1 for d in range(1, nd + 1) if sched[nid][d] in ("D", "E", "N"))
-
-    def white_senior_ok_if_remove(d, nid):
-        """把某人從 D 改成 O 後，白班資深比例是否仍 >= 1/3"""
-        if sched[nid][d] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d] == "D" and x != nid]
-        total = len(d_people)
-        if total == 0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x, False))
-        return sen >= ceil(total / 3)
-
-    def white_senior_ok_if_add(d, nid):
-        """把某人從 O 改成 D 後，白班資深比例是否仍 >= 1/3"""
-        if role_map[nid] != "D":
-            return True
-        d_people = [x for x in id_list if sched[x][d] == "D"] + [nid]
-        total = len(d_people)
-        if total == 0:
-            return True
-        sen = sum(1 for x in d_people if senior_map.get(x, False))
-        return sen >= ceil(total / 3)
-
-    def work_streak_if_add(nid, d):
-        """假設在第 d 天改成上班，計算這一天附近的連續上班長度"""
-        left = 0
-        dd = d - 1
-        while dd >= 1 and sched[nid][dd] in ("D", "E", "N"):
-            left += 1
-            dd -= 1
-        right = 0
-        dd = d + 1
-        while dd <= nd and sched[nid][dd] in ("D", "E", "N"):
-            right += 1
-            dd += 1
-        return left + 1 + right
-
-    # ---------- A. 先處理「上班太多」的人，讓 work_total <= max_work_days ----------
-    for nid in id_list:
-        while work_total(nid) > max_work_days:
-            candidates = []
-            for d in range(1, nd + 1):
-                if d in must_map.get(nid, set()):
-                    continue
-                s = sched[nid][d]
-                if s not in ("D", "E", "N"):
-                    continue
-                mn, _mx = demand.get(d, {}).get(s, (0, 0))
-                u = units_of(nid, s)
-                # 移除之後不能低於最小需求
-                if actual_units(d, s) - u + 1e-9 < mn:
-                    continue
-                if not white_senior_ok_if_remove(d, nid):
-                    continue
-                if not (rest_ok(sched[nid].get(d - 1, ""), "O") and
-                        rest_ok("O", sched[nid].get(d + 1, ""))):
-                    continue
-                slack = actual_units(d, s) - mn
-                candidates.append((0 if is_hday(d) else 1, -slack, d))
-
-            if not candidates:
-                break
-
-            candidates.sort()
-            _, _, chosen_d = candidates[0]
-            sched[nid][chosen_d] = "O"
-
-    # ---------- B. 再處理「上班太少」的人，讓 work_total >= min_work_days ----------
-    for nid in id_list:
-        while work_total(nid) < min_work_days:
-            candidates = []
-            s_fixed = role_map[nid]
-            if s_fixed not in ("D", "E", "N"):
-                break
-
-            for d in range(1, nd + 1):
-                if d in must_map.get(nid, set()):
-                    continue
-                if sched[nid][d] != "O":
-                    continue
-                # 不能把月休壓到小於 min_monthly_off
-                if off_total(nid) - 1 < min_monthly_off:
-                    continue
-
-                mn, mx = demand.get(d, {}).get(s_fixed, (0, 0))
-                u = units_of(nid, s_fixed)
-                # 加上去不能超過 max_units
-                if actual_units(d, s_fixed) + u > mx + 1e-9:
-                    continue
-                # 前一天、隔一天 11 小時休息 + 不製造太長連班
-                if not (rest_ok(sched[nid].get(d - 1, ""), s_fixed) and
-                        rest_ok(s_fixed, sched[nid].get(d + 1, ""))):
-                    continue
-
-                new_streak = work_streak_if_add(nid, d)
-                if new_streak > max_work_streak:
-                    continue
-                if new_streak >= 7:  # 絕對不要連七
-                    continue
-
-                if not white_senior_ok_if_add(d, nid):
-                    continue
-
-                slack = mx - (actual_units(d, s_fixed) + u)
-                candidates.append((1 if is_hday(d) else 0, -slack, d))
-
-            if not candidates:
-                break
-
-            candidates.sort()
-            _, _, chosen_d = candidates[0]
-            sched[nid][chosen_d] = s_fixed
-
-    return sched
-
-# ================== 整體排班流程 ==================
-def run_schedule(df_demand):
-    users_df = load_users()
-    prefs_df = load_prefs(year, month)
-
-    (sched, demand_map, role_map, id_list,
-     senior_map, junior_map, wcap_map,
-     must_map, wish_map) = build_initial_schedule(
-        year, month, users_df, prefs_df,
-        df_demand, d_avg, e_avg, n_avg
-    )
-
-    if allow_cross:
-        sched = cross_shift_balance_with_units(
-            year, month, id_list, sched,
-            demand_map, role_map, senior_map, junior_map,
-            d_avg, e_avg, n_avg
-        )
-
-    hol_df = load_holidays(year, month)
-    holiday_set_local = set()
-    for r in hol_df.itertuples(index=False):
-        raw = getattr(r,"date","")
-        if pd.isna(raw) or str(raw).strip()=="":
-            continue
-        dt = pd.to_datetime(raw, errors="coerce")
-        if pd.isna(dt):
-            continue
-        if int(dt.year)==int(year) and int(dt.month)==int(month):
-            holiday_set_local.add(date(int(dt.year), int(dt.month), int(dt.day)))
-
-    if prefer_off_holiday:
-        sched = prefer_off_on_holidays(
-            year, month, sched, df_demand, id_list,
-            role_map, senior_map, junior_map,
-            d_avg, e_avg, n_avg, holiday_set_local
-        )
-
-    sched = enforce_weekly_one_off(
-        year, month, sched, df_demand, id_list,
-        role_map, senior_map, junior_map,
-        d_avg, e_avg, n_avg, holiday_set_local
-    )
+# 初排方式：逐人挑選，或每天一次最小成本流（同時考量想休、本週未休、累計天數、資深配額；需 ortools），
+# 或每人從預先列舉的合法上班／休假樣式挑一整月（連班、連休、短上班段、每週一休一開始就合規）
+INITIAL_ASSIGN_OPTIONS = {"逐人挑選（預設）": "greedy", "每日最小成本流": "flow", "合法樣式": "pattern"}
+initial_assign_label = st.radio("初排方式", list(INITIAL_ASSIGN_OPTIONS), index=0, horizontal=True)
 
-    sched = enforce_min_monthly_off(
-        year, month, sched, df_demand, id_list,
-        role_map, senior_map, junior_map,
-        d_avg, e_avg, n_avg,
-        min_off=min_monthly_off,
-        balance=balance_monthly_off,
-        holiday_set=holiday_set_local,
-        target_off=TARGET_OFF_DAYS
-    )
-
-    # 不再使用「1–15 休 5 天、16–月底休 3 天」的半月基底規則
+# 規則排完後，再以局部搜尋（模擬退火）微調；0 = 不做
+local_search_iters = st.number_input("局部搜尋改善步數（0 = 不做）", 0, 500000, 20000, 1000)
 
-    sched = enforce_min_work_stretch(
-        year, month, sched, df_demand, id_list,
-        role_map, senior_map, junior_map,
-        d_avg, e_avg, n_avg,
-        min_stretch=min_work_stretch,
-        holiday_set=holiday_set_local,
-        must_map=must_map
-    )
+# 多起點：以不同種子隨機打破同分、各跑一次完整排班（多核心平行），取違規最少者
+multi_start_runs = st.number_input("多起點平行排班次數（1 = 單次）", 1, 64, 1, 1)
+schedule_seed    = st.number_input("起始種子（0 = 依員編排序；輸入最佳種子、次數 1 可重現）", 0, 1000000, 0, 1)
 
-    sched = enforce_streak_preferences(
-        year, month, sched, df_demand, id_list,
-        role_map, senior_map, junior_map,
-        d_avg, e_avg, n_avg,
-        max_work_streak=MAX_WORK_STREAK,
-        max_off_streak=MAX_OFF_STREAK,
-        min_monthly_off=min_monthly_off,
-        min_before=MIN_OFF_BEFORE_15,
-        min_after=MIN_OFF_AFTER_15,
-        target_off=TARGET_OFF_DAYS,
-        holiday_set=holiday_set_local,
-        must_map=must_map
-    )
-
-    sched = hard_break_long_work_streaks(
-        year, month, sched, df_demand, id_list,
-        role_map, senior_map, junior_map,
-        d_avg, e_avg, n_avg,
-        max_work_streak=MAX_WORK_STREAK,
-        min_monthly_off=min_monthly_off,
-        must_map=must_map
-    )
-
-    sched = smooth_short_work_segments(
-        year, month, sched, df_demand, id_list,
-        role_map, senior_map, junior_map,
-        d_avg, e_avg, n_avg,
-        min_stretch=min_work_stretch,
+# 精確解：以上述結果為起始解交給 CP-SAT（需安裝 ortools），時限內找到更好的才採用
+# 大鄰域搜尋：每次只重解一週或一個班別的一組人、其餘固定，多視窗平行；適合大單位
+ENGINE_OPTIONS = {
+    "不再改善": "greedy",
+    "精確解（CP-SAT 整月，建議 80 人以內）": "cp-sat",
+    "大鄰域搜尋（逐週／逐班別視窗，適合大單位）": "lns",
+}
+engine_label      = st.radio("規則排完後的改善方式", list(ENGINE_OPTIONS), index=0)
+solver_time_limit = st.number_input("精確解／大鄰域搜尋時限（秒）", 1, 600, 10, 1)
+lns_window_time   = st.number_input("大鄰域搜尋每個視窗時限（秒）", 0.5, 60.0, 2.0, 0.5)
+
+# ================== 整體排班流程（引擎見 roster_engine/engine.py） ==================
+def current_settings():
+    """畫面上的排班設定 → 引擎參數物件"""
+    return ScheduleSettings.for_demand(
+        demand_params,
+        allow_cross=allow_cross,
+        prefer_off_holiday=prefer_off_holiday,
         min_monthly_off=min_monthly_off,
-        min_before=MIN_OFF_BEFORE_15,
-        min_after=MIN_OFF_AFTER_15,
-        holiday_set=holiday_set_local,
-        must_map=must_map
-    )
-
-    # 🧱 先確保絕對不會連七
-    sched = ensure_no_seven_consecutive_work(
-        year, month, sched, id_list, must_map
-    )
-
-    # ✅ 再依「本月上班最少 / 最多天數」做最後微調（不打破連班限制）
-    sched = enforce_workday_limits(
-        year, month, sched, df_demand, id_list,
-        role_map, senior_map, junior_map,
-        d_avg, e_avg, n_avg,
+        balance_monthly_off=balance_monthly_off,
+        min_work_stretch=min_work_stretch,
         min_work_days=min_work_days,
         max_work_days=max_work_days,
-        min_monthly_off=min_monthly_off,
-        max_work_streak=MAX_WORK_STREAK,
-        holiday_set=holiday_set_local,
-        must_map=must_map
+        local_search_iters=int(local_search_iters),
+        initial_assign=INITIAL_ASSIGN_OPTIONS[initial_assign_label],
+        engine=ENGINE_OPTIONS[engine_label],
+        solver_time_limit=float(solver_time_limit),
+        lns_window_time=float(lns_window_time),
+        shift_catalogue=shift_catalogue,
     )
 
-    ndays = days_in_month(year, month)
-
-    roster_rows = []
-    for nid in id_list:
-        row = {
-            "id": nid,
-            "shift": role_map[nid],
-            "senior": senior_map.get(nid,False),
-            "junior": junior_map.get(nid,False),
-        }
-        for d in range(1, ndays+1):
-            row[str(d)] = sched[nid][d]
-        roster_rows.append(row)
-    roster_df = pd.DataFrame(roster_rows).sort_values(
-        ["shift","senior","junior","id"]
-    ).reset_index(drop=True)
-
-    def count_code(nid, code):
-        return sum(1 for d in range(1, ndays+1) if sched[nid][d]==code)
-
-    def is_hday2(d):
-        return is_sunday(year, month, d) or (date(year,month,d) in holiday_set_local)
-
-    holiday_off = {
-        nid: sum(1 for d in range(1, ndays+1)
-                 if is_hday2(d) and sched[nid][d]=="O")
-        for nid in id_list
+# ================== 產生班表按鈕 ==================
+# 產生模式：時限到就停、回傳目前最佳班表（多起點時由各次排班平分）
+DEADLINE_OPTIONS = {"快速（1 秒）": 1000, "完整（30 秒）": 30000, "不限時": None}
+deadline_label = st.radio("產生模式", list(DEADLINE_OPTIONS), index=1, horizontal=True)
+
+# ================== 背景排班：進度、中途班表、取消 ==================
+# 排班在背景執行緒跑、工作掛在 session_state：期間動到任何元件只會重跑畫面，不會丟掉排到一半的結果。
+# 執行緒裡不呼叫 st.*，只更新工作 dict；進度區每 JOB_POLL_SECONDS 重跑一次讀取進度。
+# 結果依輸入指紋（資料檔內容、需求表、規則、種子）存在 session_state["schedule_results"]：
+# 下載或動到元件重跑時直接顯示，輸入沒變再按產生也不重排；
+# session 沒有時再查資料目錄的結果快取（run_schedule 排完會寫入）。
+JOB_POLL_SECONDS = 0.5
+RESULT_HISTORY = 4   # session 內保留幾組不同輸入的結果
+
+# 單一種子排班的逐步檢查點（整個行程共用）：只調了某條規則（例如連上下限）再按產生，
+# 從該規則接著排，不必重做初排與它之前的規則
+@st.cache_resource
+def pass_checkpoints():
+    return PassCheckpoints()
+
+def start_schedule_job(settings, seed, runs, fingerprint):
+    job = {
+        "status": "running", "progress": 0.0, "label": "讀取資料", "partial": None,
+        "result": None, "error": None, "cancel": threading.Event(),
+        "year": year, "month": month, "fingerprint": fingerprint,
     }
+    demand = df_demand.copy()
+    checkpoints = pass_checkpoints()   # cache_resource 要在腳本執行緒取，背景執行緒沒有 ScriptRunContext
 
-    summary_df = pd.DataFrame([{
-        "id": nid,
-        "shift": role_map[nid],
-        "senior": senior_map.get(nid,False),
-        "junior": junior_map.get(nid,False),
-        "D天數": count_code(nid,"D"),
-        "E天數": count_code(nid,"E"),
-        "N天數": count_code(nid,"N"),
-        "O天數": count_code(nid,"O"),
-        "本月例假日放假數": holiday_off[nid],
-    } for nid in id_list]).sort_values(
-        ["shift","senior","junior","id"]
-    ).reset_index(drop=True)
-
-    def person_units_on(nid, s):
-        return per_person_units(
-            junior_map.get(nid,False),
-            s, d_avg, e_avg, n_avg, 4.0
-        )
-
-    comp_rows = []
-    for d in range(1, ndays+1):
-        for s in ORDER:
-            mn, mx = demand_map.get(d,{}).get(s,(0,0))
-            act = sum(
-                person_units_on(nid,s)
-                for nid in id_list
-                if sched[nid][d]==s
-            )
-            if act + 1e-9 < mn:
-                status = "🔴 不足"
-            elif act <= mx + 1e-9:
-                status = "🟢 達標"
-            else:
-                status = "🟡 超編"
-            comp_rows.append({
-                "day": d,
-                "shift": s,
-                "min_units": mn,
-                "max_units": mx,
-                "actual_units": round(act,2),
-                "狀態": status,
-            })
-    compliance_df = pd.DataFrame(comp_rows)
-
-    return roster_df, summary_df, compliance_df
+    def on_progress(frac, label, roster):
+        job["progress"], job["label"] = frac, label
+        if roster is not None:
+            job["partial"] = roster
 
-# ================== 產生班表按鈕 ==================
-if st.button("🚀 產生班表（以員工編號為 id）", type="primary"):
-    roster_df, summary_df, compliance_df = run_schedule(df_demand)
-
-    st.subheader(f"📅 班表（{year}-{month:02d}）")
-    ndays = days_in_month(year, month)
+    def work():
+        try:
+            job["result"] = run_schedule(
+                store, job["year"], job["month"], demand, settings, seed=seed, runs=runs,
+                progress=on_progress, cancel=job["cancel"], checkpoints=checkpoints
+            )
+            job["status"] = "cancelled" if job["result"][3].get("已取消") else "done"
+        except Exception as e:   # 顯示在畫面上，不讓執行緒默默死掉
+            job["error"] = f"{type(e).__name__}: {e}"
+            job["status"] = "failed"
+
+    job["thread"] = threading.Thread(target=work, daemon=True)
+    job["thread"].start()
+    st.session_state["schedule_job"] = job
+
+def show_result(roster_df, summary_df, compliance_df, report, r_year, r_month):
+    st.caption(f"種子 {report['種子']}；初排 {report['初始分配']}；違規加權分數 {report['分數']}；"
+               f"耗時 {report['秒數']} 秒")
+    if report["逾時中止"]:
+        residual = "、".join(f"{k} {v}" for k, v in report["剩餘違規"].items() if v)
+        st.warning(f"已達時限，提早結束；以下為目前最佳班表。剩餘違規：{residual or '無'}")
+
+    st.subheader(f"📅 班表（{r_year}-{r_month:02d}）")
+    ndays = days_in_month(r_year, r_month)
     day_cols = [str(d) for d in range(1, ndays+1) if str(d) in roster_df.columns]
 
     def highlight_off(val):
@@ -1816,21 +454,93 @@ if st.button("🚀 產生班表（以員工編號為 id）", type="primary"):
     st.subheader("📈 每日達標情況（以能力單位）")
     st.dataframe(compliance_df, use_container_width=True, height=360)
 
+    with st.expander("🔁 調整規則收斂與局部搜尋"):
+        st.dataframe(report["規則收斂"], use_container_width=True)
+        if report["局部搜尋"]:
+            st.write("局部搜尋：", report["局部搜尋"])
+        if report["精確解"]:
+            st.write("精確解：", report["精確解"])
+        if report["大鄰域搜尋"]:
+            st.write("大鄰域搜尋：", report["大鄰域搜尋"])
+        st.write("剩餘違規：", report["剩餘違規"])
+        if "多起點" in report:
+            st.dataframe(report["多起點"], use_container_width=True)
+
     st.download_button(
         "⬇️ 下載 CSV 班表",
         data=roster_df.to_csv(index=False).encode("utf-8-sig"),
-        file_name=f"roster_{year}-{month:02d}.csv"
+        file_name=f"roster_{r_year}-{r_month:02d}.csv"
     )
     st.download_button(
         "⬇️ 下載 CSV 統計",
         data=summary_df.to_csv(index=False).encode("utf-8-sig"),
-        file_name=f"summary_{year}-{month:02d}.csv"
+        file_name=f"summary_{r_year}-{r_month:02d}.csv"
     )
     st.download_button(
         "⬇️ 下載 CSV 達標",
         data=compliance_df.to_csv(index=False).encode("utf-8-sig"),
-        file_name=f"compliance_{year}-{month:02d}.csv"
+        file_name=f"compliance_{r_year}-{r_month:02d}.csv"
     )
+
+job = st.session_state.get("schedule_job")
+running = job is not None and job["status"] == "running"
+results = st.session_state.setdefault("schedule_results", OrderedDict())
+
+# 引擎實際會讀到的輸入（讀檔有快取，算指紋很便宜）
+run_settings = replace(current_settings(), deadline_ms=DEADLINE_OPTIONS[deadline_label])
+fingerprint = input_fingerprint(
+    year, month, load_users(), load_prefs(year, month), load_holidays(year, month),
+    df_demand, run_settings, seed=int(schedule_seed), runs=int(multi_start_runs)
+)
+
+if fingerprint not in results:
+    # 資料目錄的結果快取：其他工作階段或先前排過同樣輸入就直接顯示
+    cached = store.results.get(fingerprint)
+    if cached is not None:
+        results[fingerprint] = (*cached, year, month)
+        while len(results) > RESULT_HISTORY:
+            results.popitem(last=False)
+
+if st.button("🚀 產生班表（以員工編號為 id）", type="primary", disabled=running):
+    # 逾時中止的結果取決於當時負載，按產生就重排
+    if fingerprint in results and not results[fingerprint][3]["逾時中止"]:
+        st.info("輸入沒有變更，沿用上次的結果。")
+    else:
+        start_schedule_job(run_settings, int(schedule_seed), int(multi_start_runs), fingerprint)
+        job, running = st.session_state["schedule_job"], True
+
+if job is not None and job["status"] != "running":
+    # 做完（或取消／失敗）：結果依指紋掛到 session_state，工作本身移除
+    del st.session_state["schedule_job"]
+    if job["status"] == "done":
+        results[job["fingerprint"]] = (*job["result"], job["year"], job["month"])
+        results.move_to_end(job["fingerprint"])
+        while len(results) > RESULT_HISTORY:
+            results.popitem(last=False)
+    elif job["status"] == "cancelled":
+        st.info("已取消排班；保留上一次的結果。")
+    else:
+        st.error(f"排班失敗：{job['error']}")
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def job_progress(job):
+    """排班中：只有這一區定時重跑更新進度；做完才整頁重跑顯示結果"""
+    if job["status"] != "running":
+        st.rerun()
+    st.progress(min(1.0, job["progress"]), text=f"排班中：{job['label']}")
+    if st.button("⏹ 取消排班"):
+        job["cancel"].set()
+    if job["partial"] is not None:
+        st.caption("目前進度的班表（尚未完成，僅供預覽）")
+        st.dataframe(job["partial"], use_container_width=True, height=520)
+
+if running:
+    job_progress(job)
+elif fingerprint in results:
+    show_result(*results[fingerprint])
+elif results:
+    st.warning("輸入（資料、需求或規則）已變更；以下為上一次的結果，按『產生班表』重新排班。")
+    show_result(*next(reversed(results.values())))
 else:
     st.info(
         "流程建議：\n"
@@ -0,0 +1,45 @@
+"""
+護理排班引擎套件（不依賴 Streamlit）：
+  - params：排班／需求參數物件（純 Python）
+  - engine：班別目錄、班表狀態、初排、調整規則、規則管線、局部搜尋與各求解後端
+  - data：資料目錄（CSV）存取、儲存後端選擇與需求產生
+  - sqlite_store：SQLite 資料目錄（單筆寫入）與 CSV 匯入 nursing-schedule-migrate
+  - cache：排班結果的磁碟快取（依輸入指紋與引擎版本定址）
+  - cli：命令列 nursing-schedule
+  - service：區網排班 HTTP 服務 nursing-schedule-server（行程池、同輸入合併）
+
+引擎與資料存取的名稱在第一次取用時才載入（連同 pandas / numpy），
+只用參數物件或解析命令列參數時不必付載入成本。
+"""
+from importlib import import_module
+
+from .params import DemandParams, ScheduleSettings
+
+_ENGINE_NAMES = {
+    "SHIFT_CATALOGUE", "OFF", "DEFAULT_SETTINGS", "ShiftCatalogue", "ScheduleState",
+    "ENGINE_VERSION", "days_in_month", "holiday_dates", "preference_maps",
+    "PREF_COLUMNS", "compact_prefs", "pref_record",
+    "schedule_month", "schedule_best_of", "PassCheckpoints",
+}
+_DATA_NAMES = {"CsvStore", "open_store", "store_backend", "parse_segments", "seed_demand_from_beds", "demand_for",
+               "input_fingerprint", "run_schedule"}
+_CACHE_NAMES = {"ResultCache"}
+_SQLITE_NAMES = {"SqliteStore"}
+
+__all__ = ["DemandParams", "ScheduleSettings",
+           *sorted(_ENGINE_NAMES), *sorted(_DATA_NAMES), *sorted(_CACHE_NAMES), *sorted(_SQLITE_NAMES)]
+
+def __getattr__(name):
+    # 用 import_module：在 __getattr__ 裡寫 `from . import engine` 會再回頭查本模組屬性而無限遞迴
+    if name in _DATA_NAMES:
+        return getattr(import_module(".data", __name__), name)
+    if name in _CACHE_NAMES:
+        return getattr(import_module(".cache", __name__), name)
+    if name in _SQLITE_NAMES:
+        return getattr(import_module(".sqlite_store", __name__), name)
+    # 其餘（含 __all__ 以外的引擎內部名稱）一律向 engine 取
+    engine = import_module(".engine", __name__)
+    try:
+        return getattr(engine, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
@@ -0,0 +1,111 @@
+"""
+排班結果的磁碟快取：以輸入指紋（見 data.input_fingerprint）加引擎版本定址，
+重開同一個月的班表、另一位護理長看同一份輸入、服務重啟後都不必重排。
+
+每份結果一個 gzip 壓縮的 pickle（班表、統計、達標、報告）；寫入先寫暫存檔再 os.replace，
+多個行程（畫面、命令列、服務）共用同一目錄也不會讀到寫一半的檔。
+總大小超過上限時依最後使用時間（命中時更新 mtime）刪最舊的。
+只存完整排完的結果：被取消或逾時中止的班表取決於當時機器負載，不是輸入的函數，不寫入（舊檔讀到也當沒有）。
+受求解時限限制的也一樣：CP-SAT 沒證明到最佳（時限內只找到可行解或沒解）、
+以及大鄰域搜尋（每個視窗都有秒數上限）的結果都不存，時限雖在輸入指紋裡，結果仍隨機器快慢而變。
+"""
+import gzip
+import hashlib
+import os
+import pickle
+import tempfile
+
+from .engine import ENGINE_VERSION
+
+RESULT_CACHE_MAX_BYTES = 256 * 1024 * 1024   # 快取目錄總大小上限
+SUFFIX = ".pkl.gz"
+
+
+def cacheable(result):
+    """排完、未被取消、未逾時中止，且不受 CP-SAT／大鄰域搜尋時限影響的結果才可快取"""
+    report = result[3]
+    if report.get("已取消") or report.get("逾時中止"):
+        return False
+    # 求解器沒跑（空 dict）或未安裝 ortools 時結果與時限無關
+    solver = report.get("精確解") or {}
+    if solver and solver.get("狀態") not in ("OPTIMAL", "未安裝 ortools"):
+        return False
+    lns = report.get("大鄰域搜尋") or {}
+    return not lns or lns.get("狀態") == "未安裝 ortools"
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=RESULT_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, fingerprint):
+        key = hashlib.sha256(f"{ENGINE_VERSION}:{fingerprint}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + SUFFIX)
+
+    def get(self, fingerprint):
+        """命中回傳 (roster_df, summary_df, compliance_df, report)，否則 None"""
+        path = self._path(fingerprint)
+        try:
+            with gzip.open(path, "rb") as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            # 壞檔或舊版格式：當作沒有
+            self._remove(path)
+            return None
+        if not cacheable(result):
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)   # 最後使用時間（LRU）
+        except OSError:
+            pass
+        return result
+
+    def put(self, fingerprint, result):
+        """寫入一份結果；不可快取的（見 cacheable）直接略過"""
+        if not cacheable(result):
+            return
+        path = self._path(fingerprint)
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as f:
+                pickle.dump(tuple(result), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except BaseException:
+            self._remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        """總大小超過 max_bytes 時，依 mtime 由舊到新刪到上限以內"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(SUFFIX):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, name))
+        total = sum(size for _mtime, size, _name in entries)
+        for _mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(SUFFIX):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
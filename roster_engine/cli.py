@@ -0,0 +1,100 @@
+"""
+命令列排班：讀資料目錄、排一個月、輸出班表。
+
+    nursing-schedule --data-dir nursing_data --year 2025 --month 11 --out roster.xlsx
+
+--out 為 .xlsx 時輸出「班表／統計／達標」三個工作表；其他副檔名輸出 CSV
+（另存 <檔名>_summary.csv、<檔名>_compliance.csv）。逾時中止仍會輸出目前最佳班表並註明。
+"""
+import argparse
+import importlib.util
+import os
+import sys
+from dataclasses import fields
+
+from .params import DERIVED_SETTINGS, SETTING_CHOICES, STORE_BACKENDS, DemandParams, ScheduleSettings
+
+
+def build_parser():
+    p = argparse.ArgumentParser(prog="nursing-schedule", description="護理排班（不需 Streamlit）")
+    p.add_argument("--data-dir", default="nursing_data", help="資料目錄（users.csv、prefs_*.csv …）")
+    p.add_argument("--year", type=int, required=True)
+    p.add_argument("--month", type=int, required=True, choices=range(1, 13), metavar="MONTH")
+    p.add_argument("--out", required=True, help="輸出檔（.xlsx 或 .csv）")
+    p.add_argument("--seed", type=int, default=0, help="起始種子（0 = 依員編排序）")
+    p.add_argument("--runs", type=int, default=1, help="多起點平行排班次數")
+    p.add_argument("--no-cache", action="store_true",
+                   help="不查也不寫資料目錄的結果快取（一律重新排班）")
+    p.add_argument("--store", choices=STORE_BACKENDS, default="auto",
+                   help="資料儲存（auto：資料目錄有 nursing.db 就用 SQLite，否則 CSV）")
+
+    demand = p.add_argument_group("需求（床數與護病比）")
+    for f in fields(DemandParams):
+        demand.add_argument("--" + f.name.replace("_", "-"), type=f.type, default=f.default)
+
+    rules = p.add_argument_group("排班規則與引擎（預設同畫面）")
+    for f in fields(ScheduleSettings):
+        if f.name in DERIVED_SETTINGS:
+            continue   # 由需求參數與資料目錄的 shifts.csv 決定
+        flag = "--" + f.name.replace("_", "-")
+        if f.type is bool:
+            rules.add_argument(flag, action=argparse.BooleanOptionalAction, default=f.default)
+        else:
+            rules.add_argument(flag, type=f.type, default=f.default, choices=SETTING_CHOICES.get(f.name))
+    return p
+
+def write_outputs(path, roster_df, summary_df, compliance_df):
+    if path.lower().endswith(".xlsx"):
+        import pandas as pd
+        with pd.ExcelWriter(path, engine="openpyxl") as xw:
+            roster_df.to_excel(xw, sheet_name="班表", index=False)
+            summary_df.to_excel(xw, sheet_name="統計", index=False)
+            compliance_df.to_excel(xw, sheet_name="達標", index=False)
+        return [path]
+    stem, ext = os.path.splitext(path)
+    ext = ext or ".csv"
+    outs = [stem + ext, f"{stem}_summary{ext}", f"{stem}_compliance{ext}"]
+    for df, out in zip((roster_df, summary_df, compliance_df), outs):
+        df.to_csv(out, index=False, encoding="utf-8-sig")
+    return outs
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.runs < 1:
+        print("--runs 至少為 1", file=sys.stderr)
+        return 2
+    if args.out.lower().endswith(".xlsx") and importlib.util.find_spec("openpyxl") is None:
+        print("輸出 .xlsx 需要 openpyxl（pip install openpyxl），或改輸出 .csv", file=sys.stderr)
+        return 2
+
+    demand_params = DemandParams(**{f.name: getattr(args, f.name) for f in fields(DemandParams)})
+    rule_names = [f.name for f in fields(ScheduleSettings)
+                  if f.name not in DERIVED_SETTINGS]
+
+    # 到這裡才載入 pandas / 引擎
+    from .data import demand_for, open_store, run_schedule
+
+    store = open_store(args.data_dir, args.store)
+    catalogue = store.load_shifts()
+    settings = ScheduleSettings.for_demand(
+        demand_params, shift_catalogue=catalogue,
+        **{name: getattr(args, name) for name in rule_names}
+    )
+    df_demand = demand_for(store, args.year, args.month, demand_params, catalogue)
+    roster_df, summary_df, compliance_df, report = run_schedule(
+        store, args.year, args.month, df_demand, settings, seed=args.seed, runs=args.runs,
+        use_cache=not args.no_cache
+    )
+
+    outs = write_outputs(args.out, roster_df, summary_df, compliance_df)
+    residual = "、".join(f"{k} {v}" for k, v in report["剩餘違規"].items() if v) or "無"
+    print(f"{args.year}-{args.month:02d}：{len(roster_df)} 人；種子 {report['種子']}；"
+          f"違規加權分數 {report['分數']}；耗時 {report['秒數']} 秒")
+    print(f"剩餘違規：{residual}")
+    if report["逾時中止"]:
+        print("已達時限，提早結束（輸出為目前最佳班表）")
+    print("輸出：" + "、".join(outs))
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,386 @@
+"""
+資料目錄存取（CSV；SQLite 見 sqlite_store）與需求產生：畫面、CLI 與服務共用。
+"""
+import copy
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from .cache import ResultCache
+from .engine import (
+    SHIFT_CATALOGUE, OFF, PREF_COLUMNS, compact_prefs, days_in_month, pref_record,
+    schedule_month, schedule_best_of,
+)
+from .params import STORE_BACKENDS, DemandParams
+
+USER_COLUMNS = ["employee_id","name","pwd4","shift","weekly_cap","senior","junior"]
+STORE_CACHE_SIZE = 32   # 每個 CsvStore 快取的讀檔結果數
+
+# 讀-改-寫的檔案鎖：以檔案實際路徑為鍵、整個行程共用，同一目錄開了幾個 CsvStore 都互斥
+_path_locks = {}
+_path_locks_guard = threading.Lock()
+
+def _path_lock(path):
+    key = os.path.realpath(path)
+    with _path_locks_guard:
+        return _path_locks.setdefault(key, threading.RLock())
+
+def parse_segments(text):
+    """'8-16' 或 '7-11;17-21'；結束 <= 開始視為跨夜（+24）"""
+    segs = []
+    for part in str(text).split(";"):
+        if "-" not in part:
+            continue
+        a, b = part.split("-", 1)
+        start, end = int(float(a)), int(float(b))
+        if end <= start:
+            end += 24
+        segs.append((start, end))
+    return segs
+
+class CsvStore:
+    """
+    一個資料目錄下的 CSV 檔：
+      users.csv、prefs_{year}_{month}.csv（每人一列：必休日、想休日）、holidays_{year}_{month}.csv、
+      extra_{year}_{month}.csv、shifts.csv（自訂班別目錄，可無）、
+      roster_{year}_{month}.csv（最近一次產生的班表）
+    以及 result_cache/（排班結果的磁碟快取，見 cache.ResultCache）。
+    讀檔結果依（路徑、mtime、大小）快取：檔案沒變就不重讀，回傳複本（呼叫端可自由修改）；
+    save_* 寫檔後立即作廢該檔的快取，不依賴 mtime 的時間解析度。
+    """
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        self.users_csv = os.path.join(data_dir, "users.csv")                        # 人員清單
+        self.prefs_csv_tmpl = os.path.join(data_dir, "prefs_{year}_{month}.csv")    # 員工請休
+        self.holidays_csv_tmpl = os.path.join(data_dir, "holidays_{year}_{month}.csv")  # 例假日
+        self.extra_csv_tmpl = os.path.join(data_dir, "extra_{year}_{month}.csv")    # 加開人力
+        self.shifts_csv = os.path.join(data_dir, "shifts.csv")                      # 自訂班別目錄（可無）
+        self.roster_csv_tmpl = os.path.join(data_dir, "roster_{year}_{month}.csv")  # 最近一次產生的班表
+        self._cache = OrderedDict()   # (路徑, 其他參數) → (檔案簽章, 結果)
+        self._lock = threading.Lock()  # 畫面與背景排班執行緒共用
+        self.results = ResultCache(os.path.join(data_dir, "result_cache"))
+
+    # ---- 讀檔快取 ----
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def _cached(self, path, build, *extra):
+        """path 的簽章沒變就回傳上次 build() 結果的複本；extra 為影響結果的其他參數"""
+        key = (path, *extra)
+        sig = self._signature(path)
+        with self._lock:
+            hit = self._cache.get(key)
+            if hit is not None and hit[0] == sig:
+                self._cache.move_to_end(key)
+                return copy.deepcopy(hit[1])
+        value = build()
+        sig = self._signature(path)   # build 可能建立了檔案
+        with self._lock:
+            self._cache[key] = (sig, value)
+            self._cache.move_to_end(key)
+            while len(self._cache) > STORE_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return copy.deepcopy(value)
+
+    def _forget(self, path):
+        with self._lock:
+            for key in [k for k in self._cache if k[0] == path]:
+                del self._cache[key]
+
+    def _write(self, df, path):
+        # 先寫暫存檔再 os.replace：同時讀檔的人不會讀到寫一半的檔
+        # 整檔寫入也取同一把鎖，不會夾在別人的讀-改-寫中間
+        with _path_lock(path):
+            fd, tmp = tempfile.mkstemp(dir=self.data_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w", newline="", encoding="utf-8") as f:
+                    df.to_csv(f, index=False)
+                os.replace(tmp, path)
+            except BaseException:
+                os.remove(tmp)
+                raise
+            self._forget(path)
+
+    # ---- 各檔 ----
+    def load_users(self):
+        def build():
+            if os.path.exists(self.users_csv):
+                df = pd.read_csv(self.users_csv, dtype=str).fillna("")
+            else:
+                df = pd.DataFrame(columns=USER_COLUMNS)
+                df.to_csv(self.users_csv, index=False)
+            for c in USER_COLUMNS:
+                if c not in df.columns:
+                    df[c] = ""
+            return df
+        return self._cached(self.users_csv, build)
+
+    def save_users(self, df):
+        self._write(df, self.users_csv)
+
+    def prefs_path(self, year, month):
+        return self.prefs_csv_tmpl.format(year=year, month=f"{month:02d}")
+
+    def load_prefs(self, year, month):
+        """精簡格式（見 engine.PREF_COLUMNS）；舊的每人每天一列的檔讀入時轉換，下次儲存即改寫"""
+        p = self.prefs_path(year, month)
+
+        def build():
+            if os.path.exists(p):
+                return compact_prefs(pd.read_csv(p, dtype=str).fillna(""), year, month)
+            return pd.DataFrame(columns=PREF_COLUMNS)
+        return self._cached(p, build, year, month)
+
+    def save_prefs(self, df, year, month):
+        self._write(compact_prefs(df, year, month), self.prefs_path(year, month))
+
+    def holidays_path(self, year, month):
+        return self.holidays_csv_tmpl.format(year=year, month=f"{month:02d}")
+
+    def load_holidays(self, year, month):
+        p = self.holidays_path(year, month)
+
+        def build():
+            if os.path.exists(p):
+                df = pd.read_csv(p, dtype=str).fillna("")
+                if "date" not in df.columns:
+                    df["date"] = ""
+                return df
+            return pd.DataFrame(columns=["date"])
+        return self._cached(p, build)
+
+    def save_holidays(self, df, year, month):
+        self._write(df, self.holidays_path(year, month))
+
+    def extra_path(self, year, month):
+        return self.extra_csv_tmpl.format(year=year, month=f"{month:02d}")
+
+    def load_extra(self, year, month, shift_codes=None):
+        if shift_codes is None:
+            shift_codes = list(self.load_shifts())
+        cols = ["day"] + [f"{s}_extra" for s in shift_codes]
+        p = self.extra_path(year, month)
+
+        def build():
+            if os.path.exists(p):
+                df = pd.read_csv(p).fillna(0)
+            else:
+                nd = days_in_month(year, month)
+                df = pd.DataFrame({"day": list(range(1, nd+1))})
+            for c in cols:
+                if c not in df.columns:
+                    df[c] = 0
+            return df
+        return self._cached(p, build, year, month, tuple(shift_codes))
+
+    def save_extra(self, df, year, month):
+        self._write(df, self.extra_path(year, month))
+
+    def load_shifts(self):
+        """
+        班別目錄：有 shifts.csv（欄位 code, segments, ratio, white, label）就用它，
+        否則用預設 SHIFT_CATALOGUE。
+        """
+        return self._cached(self.shifts_csv, self._read_shifts)
+
+    def _read_shifts(self):
+        if not os.path.exists(self.shifts_csv):
+            return dict(SHIFT_CATALOGUE)
+        return shift_catalogue_from_frame(pd.read_csv(self.shifts_csv, dtype=str).fillna(""))
+
+    # ---- 單筆寫入（同一行程內以檔案鎖互斥、不互相覆蓋；跨行程同時寫請用 SqliteStore） ----
+    def find_user(self, employee_id):
+        """員編 → 該列（Series），沒有回傳 None"""
+        users = self.load_users()
+        row = users[users["employee_id"].astype(str) == str(employee_id)]
+        return None if row.empty else row.iloc[0]
+
+    def add_user(self, record):
+        """新增一位人員；員編已存在時不寫入、回傳 False（檢查與寫入在同一把鎖內）"""
+        with _path_lock(self.users_csv):
+            users = self.load_users()
+            if (users["employee_id"].astype(str) == str(record["employee_id"])).any():
+                return False
+            self._write(pd.concat([users, pd.DataFrame([record])], ignore_index=True), self.users_csv)
+        return True
+
+    def upsert_user(self, record):
+        """新增或更新一位人員（依 employee_id）；其餘人員不動"""
+        with _path_lock(self.users_csv):
+            users = self.load_users()
+            hit = users["employee_id"].astype(str) == str(record["employee_id"])
+            if hit.any():
+                for k, v in record.items():
+                    users.loc[hit, k] = v
+            else:
+                users = pd.concat([users, pd.DataFrame([record])], ignore_index=True)
+            self._write(users, self.users_csv)
+
+    def save_nurse_prefs(self, nurse_id, year, month, must_days, wish_days=None):
+        """只更新某位護理師當月的那一列（wish_days 為 None 時想休日隱含）；其他人的列不動"""
+        rec = pref_record(nurse_id, year, month, must_days, wish_days)
+        with _path_lock(self.prefs_path(year, month)):
+            prefs = self.load_prefs(year, month)
+            hit = prefs["nurse_id"].astype(str) == str(nurse_id)
+            if hit.any():
+                prefs.loc[hit, ["must", "wish"]] = [rec["must"], rec["wish"]]
+            else:
+                prefs = pd.concat([prefs, pd.DataFrame([rec])], ignore_index=True)
+            self._write(prefs, self.prefs_path(year, month))
+
+    def roster_path(self, year, month):
+        return self.roster_csv_tmpl.format(year=year, month=f"{month:02d}")
+
+    def load_roster(self, year, month):
+        """最近一次產生的班表；沒有回傳 None"""
+        p = self.roster_path(year, month)
+        if not os.path.exists(p):
+            return None
+        return self._cached(p, lambda: pd.read_csv(p, dtype=str).fillna(""))
+
+    def save_roster(self, roster_df, year, month):
+        self._write(roster_df, self.roster_path(year, month))
+
+def shift_catalogue_from_frame(df):
+    """班別目錄表（欄位 code, segments, ratio, white, label）→ 班別目錄；沒有可用的列時用預設"""
+    cat = {}
+    for r in df.itertuples(index=False):
+        code = str(getattr(r, "code", "")).strip().upper()
+        if code in ("", OFF):
+            continue
+        try:
+            segs = parse_segments(getattr(r, "segments", ""))
+        except ValueError:
+            continue
+        if not segs:
+            continue
+        ratio = str(getattr(r, "ratio", "")).strip().upper()
+        cat[code] = {
+            "segments": segs,
+            "ratio": ratio if ratio in ("D", "E", "N") else "D",
+            "white": str(getattr(r, "white", "")).strip().upper() in ("TRUE","1","YES","Y","T"),
+            "label": str(getattr(r, "label", "")).strip() or code,
+        }
+    return cat if cat else dict(SHIFT_CATALOGUE)
+
+# ================== 儲存後端 ==================
+def store_backend(data_dir, backend="auto"):
+    """實際使用的後端（"csv" 或 "sqlite"）；"auto" 時看目錄裡有沒有 nursing.db"""
+    from .sqlite_store import DB_NAME   # sqlite_store 反向依賴本模組
+
+    if backend not in STORE_BACKENDS:
+        raise ValueError(f"未知的儲存後端：{backend}")
+    if backend == "auto":
+        backend = "sqlite" if os.path.exists(os.path.join(data_dir, DB_NAME)) else "csv"
+    return backend
+
+def open_store(data_dir, backend="auto"):
+    """
+    開啟資料目錄：backend 為 "csv"（CsvStore）、"sqlite"（SqliteStore，資料目錄下的 nursing.db）
+    或 "auto"（目錄裡已有 nursing.db 就用 SQLite，否則 CSV）。兩者的讀寫介面相同。
+    """
+    from .sqlite_store import SqliteStore
+
+    if store_backend(data_dir, backend) == "sqlite":
+        return SqliteStore(data_dir)
+    return CsvStore(data_dir)
+
+# ================== 護病比 → 每日需求（能力單位） ==================
+def seed_demand_from_beds(y, m, total_beds,
+                          d_ratio_min=6, d_ratio_max=7,
+                          e_ratio_min=10, e_ratio_max=12,
+                          n_ratio_min=15, n_ratio_max=16,
+                          extra_df=None, catalogue=None):
+    if catalogue is None:
+        catalogue = SHIFT_CATALOGUE
+    params = DemandParams(total_beds, d_ratio_min, d_ratio_max,
+                          e_ratio_min, e_ratio_max, n_ratio_min, n_ratio_max)
+    rows = []
+    nd = days_in_month(y, m)
+    ext = extra_df if extra_df is not None else pd.DataFrame(columns=["day"])
+    if "day" in ext.columns:
+        ext = ext.set_index("day")
+    for d in range(1, nd+1):
+        row = {"day": d}
+        for s, info in catalogue.items():
+            s_min, s_max = params.units_range(info.get("ratio", "D"))
+            col = f"{s}_extra"
+            s_ex = int(ext.at[d,col]) if (d in ext.index and col in ext.columns) else 0
+            row[f"{s}_min_units"] = int(s_min + s_ex)
+            row[f"{s}_max_units"] = int(s_max + s_ex)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def demand_for(store, year, month, params, catalogue=None):
+    """資料目錄裡的加開人力 + 需求參數 → 每日需求表"""
+    if catalogue is None:
+        catalogue = store.load_shifts()
+    extra_df = store.load_extra(year, month, list(catalogue))
+    return seed_demand_from_beds(
+        year, month, params.total_beds,
+        params.d_ratio_min, params.d_ratio_max,
+        params.e_ratio_min, params.e_ratio_max,
+        params.n_ratio_min, params.n_ratio_max,
+        extra_df=extra_df, catalogue=catalogue
+    )
+
+# ================== 排班輸入指紋 ==================
+def input_fingerprint(year, month, users_df, prefs_df, hol_df, df_demand, settings, seed=0, runs=1):
+    """
+    排班輸入的內容雜湊（sha256 hex）：資料表與設定相同就得到相同的值（跨行程、跨重啟穩定），
+    用來判斷能否沿用先前的結果。settings 可為 ScheduleSettings 或 dict。
+    """
+    if hasattr(settings, "as_dict"):
+        settings = settings.as_dict()
+    h = hashlib.sha256()
+    h.update(json.dumps({"year": int(year), "month": int(month), "seed": int(seed), "runs": int(runs),
+                         "settings": settings}, sort_keys=True, default=str).encode("utf-8"))
+    for name, df in (("users", users_df), ("prefs", prefs_df), ("holidays", hol_df), ("demand", df_demand)):
+        h.update(f"\0{name}\0{json.dumps([str(c) for c in df.columns])}\0".encode("utf-8"))
+        h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+# ================== 從資料目錄排班 ==================
+def run_schedule(store, year, month, df_demand, settings, seed=0, runs=1,
+                 progress=None, cancel=None, use_cache=True, checkpoints=None):
+    """
+    讀資料目錄的人員／請休／假日，以給定的需求表與設定（ScheduleSettings 或 dict）排班；
+    runs > 1 時以 seed 起連續 runs 個種子多起點平行排班取最佳。回傳同 schedule_month。
+    progress / cancel 原樣轉給引擎（見 schedule_month）。
+    use_cache 時先查資料目錄的結果快取（同輸入、同引擎版本直接回傳，不重寫班表檔），
+    排完且可快取的結果寫回快取（見 cache.cacheable），未被取消的班表另存為該月最近一次產生的班表
+    （store.save_roster）。
+    checkpoints（engine.PassCheckpoints）只用於單一種子：只改了某條規則的參數時由該規則接著排。
+    """
+    inputs = (year, month, store.load_users(), store.load_prefs(year, month),
+              store.load_holidays(year, month), df_demand, settings)
+    fingerprint = input_fingerprint(*inputs, seed=seed, runs=runs) if use_cache else None
+    if fingerprint is not None:
+        cached = store.results.get(fingerprint)
+        if cached is not None:
+            if progress is not None:
+                progress(1.0, "沿用快取結果", cached[0])
+            return cached
+    if runs > 1:
+        result = schedule_best_of(*inputs, seeds=range(seed, seed + runs),
+                                  progress=progress, cancel=cancel)
+    else:
+        result = schedule_month(*inputs, seed=seed, progress=progress, cancel=cancel,
+                                checkpoints=checkpoints)
+    if not result[3].get("已取消"):
+        if fingerprint is not None:
+            store.results.put(fingerprint, result)
+        store.save_roster(result[0], year, month)
+    return result
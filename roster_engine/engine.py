@@ -0,0 +1,3182 @@
+"""
+護理排班引擎：班別目錄、班表狀態、初排、各調整規則、規則管線與局部搜尋。
+不依賴 Streamlit，可由畫面（app.py）或其他行程（多起點平行排班）匯入使用。
+"""
+import os
+import pandas as pd
+import numpy as np
+from datetime import datetime, date
+import calendar
+import hashlib
+import heapq
+import importlib.util
+import json
+import pickle
+import random
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from functools import lru_cache
+from math import ceil, exp
+
+from .params import ScheduleSettings
+
+# 引擎版本：排班結果會變的修改（規則、權重、初排、搜尋）都要遞增，磁碟上的舊結果快取隨之失效
+ENGINE_VERSION = "2"
+
+# ================== 班別基本設定 ==================
+# 班別目錄（24 小時制，用於計算 11 小時休息；依此順序排班）
+#   segments：上班時段，可多段（分段班），跨夜以 end > 24 表示（如 12 小時夜班 (20, 32)）
+#   ratio：套用哪一組護病比（D 白 / E 小夜 / N 大夜），決定需求與新人能力單位
+#   white：是否適用「白班資深至少 1/3」
+#   label：畫面顯示名稱
+SHIFT_CATALOGUE = {
+    "D": {"segments": [(8, 16)],  "ratio": "D", "white": True,  "label": "白班"},
+    "E": {"segments": [(16, 24)], "ratio": "E", "white": False, "label": "小夜"},
+    "N": {"segments": [(0, 8)],   "ratio": "N", "white": False, "label": "大夜"},
+}
+OFF = "O"              # 休假
+MIN_REST_HOURS = 11    # 前後班之間最少休息時數
+
+# ================== 工具函式 ==================
+def days_in_month(year: int, month: int) -> int:
+    return calendar.monthrange(year, month)[1]
+
+def is_sunday(y: int, m: int, d: int) -> bool:
+    return datetime(y, m, d).weekday() == 6  # 週日
+
+def week_index(day: int) -> int:
+    if day <= 7: return 1
+    if day <= 14: return 2
+    if day <= 21: return 3
+    if day <= 28: return 4
+    return 5
+
+# 日期位元遮罩：第 d 天對應 bit d（bit 0 不用），一人一月一個整數
+def day_mask(days) -> int:
+    bits = 0
+    for d in days:
+        bits |= 1 << d
+    return bits
+
+def month_mask(nd: int) -> int:
+    return ((1 << (nd + 1)) - 1) & ~1
+
+def week_mask(w: int, nd: int) -> int:
+    return day_mask(d for d in range(7*(w-1)+1, (7*w if w < 5 else nd)+1) if d <= nd)
+
+def iter_days(bits: int):
+    """由小到大列出遮罩中的日子"""
+    while bits:
+        low = bits & -bits
+        yield low.bit_length() - 1
+        bits ^= low
+
+def first_day_after(bits: int, d: int):
+    """遮罩中大於 d 的第一天；沒有則回傳 None"""
+    bits = (bits >> (d + 1)) << (d + 1)
+    if not bits:
+        return None
+    return (bits & -bits).bit_length() - 1
+
+def normalize_id(x) -> str:
+    if pd.isna(x):
+        return ""
+    return str(x).strip()
+
+# ================== 需求表 ==================
+def demand_from_df(demand_df, shift_codes):
+    """需求表 → {day: {shift: (min_units, max_units)}}"""
+    demand = {}
+    for r in demand_df.itertuples(index=False):
+        demand[int(r.day)] = {
+            s: (int(getattr(r, f"{s}_min_units", 0)), int(getattr(r, f"{s}_max_units", 0)))
+            for s in shift_codes
+        }
+    return demand
+
+# ================== 能力單位：新人護病比 1:4 ==================
+def per_person_units(is_junior: bool, shift_code: str,
+                     d_avg: float, e_avg: float, n_avg: float,
+                     jr_ratio: float = 4.0):
+    """
+    正式人員：1 單位（護病比依你設定）
+    新人：護病比固定 1:4，能力 = 4 / 該班別平均護病比（通常 < 1）
+    """
+    if not is_junior:
+        return 1.0
+    base = {"D": d_avg, "E": e_avg, "N": n_avg}.get(shift_code, d_avg)
+    if base <= 0:
+        return 1.0
+    return jr_ratio / base
+
+# ================== 班別目錄編譯（每次排班一次） ==================
+class ShiftCatalogue:
+    """
+    把班別目錄編譯成查表用的結構：
+      - order / work：上班班別（排班順序）與其集合；white：適用資深 1/3 的班別
+      - codes / code_index：班表矩陣的 int8 編碼（0 = 尚未排，最後一碼為 O）
+      - rest_matrix：codes × codes 的 bool 矩陣，前一日 → 當日是否有 >= 11 小時休息
+      - clash_before / clash_after：各代碼前一日／後一日不可接的代碼（供位元遮罩過濾）
+      - jr_units：新人在各班別的能力單位（正式人員固定 1）
+    """
+
+    def __init__(self, catalogue, d_avg, e_avg, n_avg,
+                 jr_ratio=4.0, min_rest=MIN_REST_HOURS):
+        self.catalogue = catalogue
+        self.order = list(catalogue)
+        self.work = frozenset(self.order)
+        self.white = frozenset(s for s in self.order if catalogue[s].get("white"))
+        self.labels = {s: catalogue[s].get("label", s) for s in self.order}
+        self.codes = ["", *self.order, OFF]
+        self.code_index = {c: i for i, c in enumerate(self.codes)}
+        self.off_idx = self.code_index[OFF]
+        self.work_idx = np.array([self.code_index[s] for s in self.order], dtype=np.int8)
+
+        # 休息矩陣：前一班最後下班 → 隔日班第一段上班（與原規則相同，以 24 小時取餘）
+        # O 與尚未排不列入限制
+        n = len(self.codes)
+        self.rest_matrix = np.ones((n, n), dtype=bool)
+        for a in self.order:
+            end_a = max(e for _s, e in catalogue[a]["segments"])
+            for b in self.order:
+                start_b = min(s for s, _e in catalogue[b]["segments"])
+                rest = (start_b - end_a) % 24
+                self.rest_matrix[self.code_index[a], self.code_index[b]] = rest >= min_rest
+        self._rest = {(a, b): bool(self.rest_matrix[i, j])
+                      for a, i in self.code_index.items()
+                      for b, j in self.code_index.items()}
+        self.clash_before = {b: [i for i, a in enumerate(self.codes) if not self._rest[(a, b)]]
+                             for b in self.codes}
+        self.clash_after = {a: [j for j, b in enumerate(self.codes) if not self._rest[(a, b)]]
+                            for a in self.codes}
+
+        self.jr_units = {
+            s: per_person_units(True, catalogue[s].get("ratio", "D"),
+                                d_avg, e_avg, n_avg, jr_ratio)
+            for s in self.order
+        }
+
+    def rest_ok(self, prev_code, next_code):
+        """前一日班別與當日班別之間是否有足夠休息（查表）"""
+        return self._rest.get((prev_code, next_code), True)
+
+    def unit_table(self, junior_arr):
+        """nurses × shifts 的能力單位表"""
+        jr = np.array([self.jr_units[s] for s in self.order])
+        return np.where(junior_arr[:, None], jr[None, :], 1.0)
+
+# ================== 連續上班段索引（run-length） ==================
+class SegmentIndex:
+    """
+    每人所有連續上班段，以排序好的起日、迄日兩個串列表示（run-length）。
+    格子在「上班／非上班」之間翻轉時就地合併或切開，查詢皆為二分搜尋。
+    兩段上班之間（含月初、月底）即為休假段。
+    """
+
+    def __init__(self, nd):
+        self.nd = nd
+        self._starts = {}
+        self._ends = {}
+
+    def build(self, nid, work_days):
+        """work_days：依日期排序、此人上班的日子"""
+        starts, ends = [], []
+        for d in work_days:
+            if ends and ends[-1] == d - 1:
+                ends[-1] = d
+            else:
+                starts.append(d)
+                ends.append(d)
+        self._starts[nid] = starts
+        self._ends[nid] = ends
+
+    def _find(self, nid, d):
+        k = bisect_right(self._starts[nid], d) - 1
+        if k >= 0 and self._ends[nid][k] >= d:
+            return k
+        return -1
+
+    def set_work(self, nid, d):
+        """第 d 天由非上班改為上班"""
+        starts, ends = self._starts[nid], self._ends[nid]
+        k = bisect_right(starts, d)
+        join_left = k > 0 and ends[k-1] == d - 1
+        join_right = k < len(starts) and starts[k] == d + 1
+        if join_left and join_right:
+            ends[k-1] = ends[k]
+            del starts[k], ends[k]
+        elif join_left:
+            ends[k-1] = d
+        elif join_right:
+            starts[k] = d
+        else:
+            starts.insert(k, d)
+            ends.insert(k, d)
+
+    def clear_work(self, nid, d):
+        """第 d 天由上班改為非上班"""
+        k = self._find(nid, d)
+        if k < 0:
+            return
+        starts, ends = self._starts[nid], self._ends[nid]
+        s, e = starts[k], ends[k]
+        if s == e:
+            del starts[k], ends[k]
+        elif d == s:
+            starts[k] = d + 1
+        elif d == e:
+            ends[k] = d - 1
+        else:
+            ends[k] = d - 1
+            starts.insert(k+1, d + 1)
+            ends.insert(k+1, e)
+
+    def run_at(self, nid, d):
+        """包含第 d 天的上班段 (起, 迄)；該天沒上班回傳 None"""
+        k = self._find(nid, d)
+        if k < 0:
+            return None
+        return self._starts[nid][k], self._ends[nid][k]
+
+    def streak_through(self, nid, d):
+        """包含第 d 天的上班段長度"""
+        run = self.run_at(nid, d)
+        return run[1] - run[0] + 1 if run else 0
+
+    def streak_before(self, nid, d):
+        """第 d 天之前緊鄰的連續上班天數"""
+        run = self.run_at(nid, d - 1)
+        return d - run[0] if run else 0
+
+    def streak_after(self, nid, d):
+        """第 d 天之後緊鄰的連續上班天數"""
+        run = self.run_at(nid, d + 1)
+        return run[1] - d if run else 0
+
+    def streak_if_add(self, nid, d):
+        """假設第 d 天改成上班，包含這天的連續上班長度"""
+        return self.streak_before(nid, d) + 1 + self.streak_after(nid, d)
+
+    def runs(self, nid):
+        """所有上班段（快照）"""
+        return list(zip(self._starts[nid], self._ends[nid]))
+
+    def gaps(self, nid):
+        """所有休假段（上班段之間，含月初／月底）"""
+        out = []
+        prev_end = 0
+        for s, e in zip(self._starts[nid], self._ends[nid]):
+            if s > prev_end + 1:
+                out.append((prev_end + 1, s - 1))
+            prev_end = e
+        if prev_end < self.nd:
+            out.append((prev_end + 1, self.nd))
+        return out
+
+    def longest_run(self, nid):
+        return max((e - s + 1 for s, e in zip(self._starts[nid], self._ends[nid])), default=0)
+
+    def short_runs(self, nid, min_len):
+        return [(s, e) for s, e in zip(self._starts[nid], self._ends[nid]) if e - s + 1 < min_len]
+
+# ================== 班表狀態：每日每班即時統計 ==================
+class ScheduleState:
+    """
+    持有 sched，並在每次改格子時以 O(1) 更新每 (day, shift) 的
+    成員集合、人數、資深人數與新人人數（能力單位由此推得）。
+    各調整函式共用這份統計，不必每次掃描整個 id_list。
+
+    另外同步維護精簡表示：nurses × days 的 int8 矩陣 grid（編碼見 ShiftCatalogue.codes）、
+    每人屬性陣列（role / senior / junior / 各班能力單位）與每人各代碼天數，
+    統計摘要與達標表以整列／整欄向量化計算；連續上班段則由 segments（SegmentIndex）維護。
+
+    每人一月也以整數位元遮罩表示（bit d = 第 d 天）：各代碼、上班、必休、想休，
+    候選日過濾（必休、前後休息、週區間）只需幾次位元運算。
+    """
+
+    def __init__(self, sched, id_list, role_map, senior_map, junior_map, cat, nd,
+                 must_map=None, wish_map=None):
+        self.sched = sched
+        self.id_list = id_list
+        self.senior_map = senior_map
+        self.junior_map = junior_map
+        self.cat = cat
+        self.nd = nd
+        self._members = {(d, s): set() for d in range(1, nd+1) for s in cat.order}
+        self._senior = {key: 0 for key in self._members}
+        self._junior = {key: 0 for key in self._members}
+
+        # 變動戳記：每次 assign 遞增，並記在被改的人與日上（供規則管線找出 dirty set）
+        self.stamp = 0
+        self.nurse_stamp = {nid: 0 for nid in id_list}
+        self.day_stamp = {d: 0 for d in range(1, nd+1)}
+
+        # 時限（time.perf_counter 的絕對時間；None = 不限時）：各調整函式的迴圈自行檢查、提早結束
+        self.deadline = None
+        self.timed_out = False
+        # 取消旗標（有 is_set() 的物件，如 threading.Event）：與時限走同一套檢查
+        self.cancel = None
+        self.cancelled = False
+        self._next_cancel_poll = 0.0
+
+        # 精簡表示
+        self.index = {nid: i for i, nid in enumerate(id_list)}
+        n = len(id_list)
+        self.grid = np.zeros((n, nd), dtype=np.int8)
+        self.code_counts = np.zeros((n, len(cat.codes)), dtype=np.int32)
+        self.code_counts[:, 0] = nd
+        self.role_arr = np.array([cat.code_index.get(role_map.get(nid, ""), 0) for nid in id_list],
+                                 dtype=np.int8)
+        self.senior_arr = np.array([bool(senior_map.get(nid, False)) for nid in id_list],
+                                   dtype=bool)
+        self.junior_arr = np.array([bool(junior_map.get(nid, False)) for nid in id_list],
+                                   dtype=bool)
+        self.unit_arr = cat.unit_table(self.junior_arr)
+        self._units = {nid: dict(zip(cat.order, row))
+                       for nid, row in zip(id_list, self.unit_arr.tolist())}
+
+        # 位元遮罩
+        self.full_bits = month_mask(nd)
+        self._bits = {nid: [self.full_bits] + [0]*(len(cat.codes)-1) for nid in id_list}
+        self.must_bits = {nid: day_mask((must_map or {}).get(nid, ())) & self.full_bits
+                          for nid in id_list}
+        self.wish_bits = {nid: day_mask((wish_map or {}).get(nid, ())) & self.full_bits
+                          for nid in id_list}
+
+        for nid in id_list:
+            for d, code in sched[nid].items():
+                self._enter(nid, d, code)
+
+        # 連續上班段索引
+        self.segments = SegmentIndex(nd)
+        self._work_bits = {}
+        for nid in id_list:
+            self.segments.build(nid, [d for d in range(1, nd+1) if sched[nid][d] in cat.work])
+            bits = 0
+            for s in cat.order:
+                bits |= self._bits[nid][cat.code_index[s]]
+            self._work_bits[nid] = bits
+
+    def _enter(self, nid, d, code):
+        i = self.index[nid]
+        c = self.cat.code_index[code]
+        self.grid[i, d-1] = c
+        self.code_counts[i, c] += 1
+        self.code_counts[i, 0] -= 1
+        if c:   # 回到未排（代碼 0）時 bits[0] 已由 _leave 設好，不能再清掉
+            bits = self._bits[nid]
+            bits[c] |= 1 << d
+            bits[0] &= ~(1 << d)
+        key = (d, code)
+        if key not in self._members:
+            return
+        self._members[key].add(nid)
+        if self.senior_map.get(nid, False):
+            self._senior[key] += 1
+        if self.junior_map.get(nid, False):
+            self._junior[key] += 1
+
+    def _leave(self, nid, d, code):
+        i = self.index[nid]
+        c = self.cat.code_index[code]
+        self.grid[i, d-1] = 0
+        self.code_counts[i, c] -= 1
+        self.code_counts[i, 0] += 1
+        if c:
+            bits = self._bits[nid]
+            bits[c] &= ~(1 << d)
+            bits[0] |= 1 << d
+        key = (d, code)
+        if key not in self._members:
+            return
+        self._members[key].discard(nid)
+        if self.senior_map.get(nid, False):
+            self._senior[key] -= 1
+        if self.junior_map.get(nid, False):
+            self._junior[key] -= 1
+
+    def code(self, nid, d):
+        """某人某日班別；超出月份範圍回傳空字串"""
+        return self.sched[nid].get(d, "")
+
+    def assign(self, nid, d, code):
+        """改一格並同步更新統計"""
+        old = self.sched[nid][d]
+        if old == code:
+            return
+        self._leave(nid, d, old)
+        self.sched[nid][d] = code
+        self._enter(nid, d, code)
+        self.stamp += 1
+        self.nurse_stamp[nid] = self.stamp
+        self.day_stamp[d] = self.stamp
+        was_work, now_work = old in self.cat.work, code in self.cat.work
+        if now_work and not was_work:
+            self.segments.set_work(nid, d)
+            self._work_bits[nid] |= 1 << d
+        elif was_work and not now_work:
+            self.segments.clear_work(nid, d)
+            self._work_bits[nid] &= ~(1 << d)
+
+    def units_of(self, nid, s):
+        return self._units[nid][s]
+
+    def members(self, d, s):
+        return self._members.get((d, s), set())
+
+    def headcount(self, d, s):
+        return len(self.members(d, s))
+
+    def senior_count(self, d, s):
+        return self._senior.get((d, s), 0)
+
+    def junior_count(self, d, s):
+        return self._junior.get((d, s), 0)
+
+    def actual_units(self, d, s):
+        key = (d, s)
+        if key not in self._members:
+            return 0.0
+        jr = self._junior[key]
+        return (len(self._members[key]) - jr) + jr * self.cat.jr_units[s]
+
+    def white_senior_ok(self, total, sen):
+        """白班資深比例是否 >= 1/3（無人時視為通過）"""
+        if total == 0:
+            return True
+        return sen >= ceil(total / 3)
+
+    def white_senior_ok_if_remove(self, d, nid):
+        """把某人從白班移走後，該班資深比例是否仍 >= 1/3"""
+        s = self.code(nid, d)
+        if s not in self.cat.white:
+            return True
+        total = self.headcount(d, s) - 1
+        sen = self.senior_count(d, s) - (1 if self.senior_map.get(nid, False) else 0)
+        return self.white_senior_ok(total, sen)
+
+    def white_senior_ok_if_add(self, d, nid, s):
+        """把某人排進 s 班後，若為白班，資深比例是否仍 >= 1/3"""
+        if s not in self.cat.white:
+            return True
+        total = self.headcount(d, s) + 1
+        sen = self.senior_count(d, s) + (1 if self.senior_map.get(nid, False) else 0)
+        return self.white_senior_ok(total, sen)
+
+    # ---- 每人天數（O(1) 計數器／列切片） ----
+    def count_code(self, nid, code):
+        return int(self.code_counts[self.index[nid], self.cat.code_index[code]])
+
+    def off_total(self, nid):
+        return self.count_code(nid, OFF)
+
+    def work_total(self, nid):
+        return int(self.code_counts[self.index[nid], self.cat.work_idx].sum())
+
+    def count_code_between(self, nid, code, d1, d2):
+        """第 d1～d2 天（含）中某代碼的天數"""
+        row = self.grid[self.index[nid], max(d1, 1)-1:min(d2, self.nd)]
+        return int(np.count_nonzero(row == self.cat.code_index[code]))
+
+    # ---- 變動追蹤 ----
+    def nurses_touched_since(self, stamp):
+        """戳記 stamp 之後被改過的人（依 id_list 順序）"""
+        return [nid for nid in self.id_list if self.nurse_stamp[nid] > stamp]
+
+    def days_touched_since(self, stamp):
+        """戳記 stamp 之後被改過的日子"""
+        return [d for d in range(1, self.nd+1) if self.day_stamp[d] > stamp]
+
+    def __getstate__(self):
+        # 取消旗標（Event 或跨行程代理）不隨狀態序列化（檢查點、送往其他行程）
+        st = self.__dict__.copy()
+        st["cancel"] = None
+        return st
+
+    # ---- 時限 ----
+    def out_of_time(self):
+        """
+        已過 deadline 或已被取消就回傳 True（並記下 timed_out / cancelled）；班表在任何時候中止都是完整的。
+        取消旗標可能是跨行程的代理物件，每 CANCEL_POLL_SECONDS 才查一次。
+        """
+        if self.timed_out or self.cancelled:
+            return True
+        if self.deadline is None and self.cancel is None:
+            return False
+        now = time.perf_counter()
+        if self.deadline is not None and now >= self.deadline:
+            self.timed_out = True
+        elif self.cancel is not None and now >= self._next_cancel_poll:
+            self._next_cancel_poll = now + CANCEL_POLL_SECONDS
+            self.cancelled = bool(self.cancel.is_set())
+        return self.timed_out or self.cancelled
+
+    def time_left(self, limit=None):
+        """距 deadline 的秒數與 limit 取小者（皆無則 None）"""
+        if self.deadline is None:
+            return limit
+        left = max(0.0, self.deadline - time.perf_counter())
+        return left if limit is None else min(limit, left)
+
+    # ---- 位元遮罩 ----
+    def code_bits(self, nid, code):
+        return self._bits[nid][self.cat.code_index[code]]
+
+    def work_bits(self, nid):
+        return self._work_bits[nid]
+
+    def is_must(self, nid, d):
+        return bool(self.must_bits[nid] >> d & 1)
+
+    def can_take_bits(self, nid, code):
+        """可把某人改成 code 的日子：非必休，且與目前前後日班別皆有足夠休息"""
+        bits = self._bits[nid]
+        prev_bad = 0
+        for c in self.cat.clash_before[code]:
+            prev_bad |= bits[c]
+        next_bad = 0
+        for c in self.cat.clash_after[code]:
+            next_bad |= bits[c]
+        return self.full_bits & ~self.must_bits[nid] & ~(prev_bad << 1) & ~(next_bad >> 1)
+
+    # ---- 向量化彙總 ----
+    def roster_matrix(self):
+        """nurses × days 的班別字串矩陣"""
+        return np.array(self.cat.codes, dtype=object)[self.grid]
+
+    def day_mask_count(self, code, day_mask):
+        """每人在 day_mask（長度 nd 的 bool 陣列）標記日子中某代碼的天數"""
+        return np.count_nonzero((self.grid == self.cat.code_index[code]) & day_mask[None, :], axis=1)
+
+    def units_by_day(self):
+        """days × shifts 的實際能力單位"""
+        out = np.zeros((self.nd, len(self.cat.order)))
+        for k, s in enumerate(self.cat.order):
+            on = self.grid == self.cat.code_index[s]
+            out[:, k] = (on * self.unit_arr[:, k][:, None]).sum(axis=0)
+        return out
+
+    # ---- 快照 ----
+    def snapshot(self):
+        return self.grid.copy()
+
+    def restore(self, grid):
+        """把班表改回快照（只改不同的格子，統計同步更新）"""
+        for i, d0 in np.argwhere(self.grid != grid).tolist():
+            self.assign(self.id_list[i], d0 + 1, self.cat.codes[grid[i, d0]])
+
+# ================== 排班規則常數 ==================
+# 「半月休假基底」改為 0，代表不強制依 1–15 / 16–月底切半
+MIN_OFF_BEFORE_15 = 0
+MIN_OFF_AFTER_15  = 0
+
+TARGET_OFF_DAYS = 10    # 目標月休 ≈ 10 天（整體）
+MAX_WORK_STREAK  = 5     # 最大連續上班 5 天
+MAX_OFF_STREAK   = 2     # 連續休假盡量不超過 2 天
+PIPELINE_MAX_ROUNDS = 6  # 調整規則最多重跑幾輪（未收斂即停）
+CANCEL_POLL_SECONDS = 0.05  # 取消旗標的查詢間隔
+
+# 違規項目權重（規則管線判斷一輪是否變好）
+VIOLATION_WEIGHTS = {
+    "連七": 1000,
+    "班次不足": 100,
+    "週未休": 100,
+    "超過每週上限": 100,
+    "白班資深不足": 100,
+    "月休不足": 50,
+    "連班過長": 50,
+    "上班天數超出": 20,
+    "月休差距": 5,
+    "短上班段": 1,
+    "連休過長": 1,
+}
+
+# 局部搜尋目標函數權重（軟性項目；硬性規則以「每人違規數不可增加」把關）
+LOCAL_SEARCH_WEIGHTS = {
+    "硬性違規": 1000,  # 每人 連七／連班過長／週未休／超過每週上限／月休不足／上班天數超出 的件數
+    "缺額單位": 100,   # 低於 min_units 的能力單位
+    "超編單位": 5,     # 高於 max_units 的能力單位
+    "月休偏差": 2,     # (O 天數 − 目標月休)²
+    "想休上班": 0.2,   # 在想休日上班
+    "短上班段": 3,     # 短於最小連續上班天數的上班段
+    "連休過長": 2,     # 長於連續休假上限的休假段
+    "假日上班": 1,     # 每人假日上班天數²（越平均越好）
+}
+
+# ================== 排班主邏輯：initial ==================
+# 最小成本流分配（選用 ortools.graph）；成本權重：想休 ≫ 本週未休 ≫ 已排天數 > 剩餘餘裕 > 同分次序
+FLOW_WISH_COST = 1000
+FLOW_WEEK_OFF_COST = 500     # 本週還沒休：越接近週末越貴，週末最後一天為全額
+FLOW_ASSIGNED_COST = 2
+FLOW_SLACK_COST = 1
+
+def _load_min_cost_flow():
+    try:
+        from ortools.graph.python import min_cost_flow
+    except ImportError:
+        return None
+    return min_cost_flow
+
+# ================== 請休表（每人每月一列） ==================
+# 精簡格式：欄位 nurse_id, must, wish；must / wish 為本月日期的清單（"1;5;12"）。
+# wish 空白 = 隱含「本月必休以外的每一天」（員工端儲存的預設），"-" = 沒有想休日。
+# 舊格式（nurse_id, date, type 每人每天一列）仍可讀，compact_prefs 可轉成精簡格式。
+PREF_COLUMNS = ["nurse_id", "must", "wish"]
+NO_DAYS = "-"
+
+def format_days(days):
+    return ";".join(str(d) for d in sorted(days))
+
+def parse_days(text, nd):
+    """'1;5;12' → {1, 5, 12}（只留 1..nd；無法解析的片段略過）"""
+    out = set()
+    for part in str(text).replace(",", ";").split(";"):
+        try:
+            d = int(float(part))
+        except ValueError:
+            continue
+        if 1 <= d <= nd:
+            out.add(d)
+    return out
+
+def _pref_record(nid, must, wish, nd):
+    implicit = set(range(1, nd+1)) - must
+    wish_text = "" if wish == implicit else (format_days(wish) if wish else NO_DAYS)
+    return {"nurse_id": nid, "must": format_days(must), "wish": wish_text}
+
+def pref_record(nurse_id, year, month, must_days, wish_days=None):
+    """一位護理師當月的請休列；wish_days 為 None 時想休日隱含為必休以外的每一天"""
+    nd = days_in_month(year, month)
+    must = {int(d) for d in must_days if 1 <= int(d) <= nd}
+    wish = set(range(1, nd+1)) - must if wish_days is None else {int(d) for d in wish_days if 1 <= int(d) <= nd}
+    return _pref_record(nurse_id, must, wish, nd)
+
+def compact_prefs(prefs_df, year, month):
+    """請休表（精簡或舊格式）→ 精簡格式（每人一列，依第一次出現的順序）"""
+    if "must" in prefs_df.columns:
+        out = prefs_df.copy()
+        for c in PREF_COLUMNS:
+            if c not in out.columns:
+                out[c] = ""
+        return out[PREF_COLUMNS].fillna("").astype(str).reset_index(drop=True)
+    must_map, wish_map = _parse_date_maps(prefs_df, year, month)
+    nd = days_in_month(year, month)
+    order = []
+    if "nurse_id" in prefs_df.columns:
+        order = list(dict.fromkeys(normalize_id(x) for x in prefs_df["nurse_id"]))
+    rows = [_pref_record(nid, set(must_map.get(nid, ())), set(wish_map.get(nid, ())), nd)
+            for nid in order if nid in must_map or nid in wish_map]
+    return pd.DataFrame(rows, columns=PREF_COLUMNS)
+
+# 偏好表解析結果的快取（依表內容雜湊；畫面每次重跑、服務重複請求都不必重新解析）
+PREF_MAP_CACHE_SIZE = 16
+_pref_map_cache = OrderedDict()
+_pref_map_lock = threading.Lock()
+
+def _parse_day_maps(prefs_df, year, month):
+    """精簡格式 → ({員編: 必休日}, {員編: 想休日})"""
+    nd = days_in_month(year, month)
+    all_days = set(range(1, nd+1))
+    must_map, wish_map = {}, {}
+    for r in prefs_df.itertuples(index=False):
+        nid = normalize_id(getattr(r, "nurse_id", ""))
+        if not nid:
+            continue
+        must = parse_days(getattr(r, "must", ""), nd)
+        raw_wish = getattr(r, "wish", "")
+        raw_wish = "" if pd.isna(raw_wish) else str(raw_wish).strip()
+        wish = all_days - must if raw_wish == "" else parse_days(raw_wish, nd)
+        if must:
+            must_map.setdefault(nid, set()).update(must)
+        if wish:
+            wish_map.setdefault(nid, set()).update(wish)
+    return must_map, wish_map
+
+def _parse_date_maps(prefs_df, year, month):
+    maps = {"must": {}, "wish": {}}
+    if prefs_df.empty or "type" not in prefs_df.columns:
+        return maps["must"], maps["wish"]
+    parsed = {}   # 同一日期字串只解析一次（偏好表的日期高度重複）
+    for r in prefs_df.itertuples(index=False):
+        typ = getattr(r, "type", "")
+        if typ not in maps:
+            continue
+        nid = normalize_id(getattr(r,"nurse_id",""))
+        raw = getattr(r,"date","")
+        if pd.isna(raw) or str(raw).strip()=="":
+            continue
+        if raw not in parsed:
+            parsed[raw] = pd.to_datetime(raw, errors="coerce")
+        dt = parsed[raw]
+        if pd.isna(dt):
+            continue
+        if int(dt.year)==int(year) and int(dt.month)==int(month):
+            maps[typ].setdefault(nid, set()).add(int(dt.day))
+    return maps["must"], maps["wish"]
+
+def preference_maps(prefs_df, year, month):
+    """
+    請休表（精簡或舊格式）→ ({員編: 本月必休日}, {員編: 本月想休日})（含不在人員清單上的員編）。
+    依 (年, 月, 表內容雜湊) 快取最近 PREF_MAP_CACHE_SIZE 份；回傳的 dict 與集合不可修改。
+    """
+    key = (int(year), int(month), tuple(prefs_df.columns), len(prefs_df),
+           int(pd.util.hash_pandas_object(prefs_df, index=False).sum()) if len(prefs_df) else 0)
+    with _pref_map_lock:
+        hit = _pref_map_cache.get(key)
+        if hit is not None:
+            _pref_map_cache.move_to_end(key)
+            return hit
+    if "must" in prefs_df.columns:
+        hit = _parse_day_maps(prefs_df, year, month)
+    else:
+        hit = _parse_date_maps(prefs_df, year, month)
+    with _pref_map_lock:
+        _pref_map_cache[key] = hit
+        while len(_pref_map_cache) > PREF_MAP_CACHE_SIZE:
+            _pref_map_cache.popitem(last=False)
+    return hit
+
+def roster_inputs(year, month, users_df, prefs_df, demand_df, cat):
+    """
+    人員／偏好／需求資料表 → 排班用的對照表：
+    (id_list, role_map, wcap_map, senior_map, junior_map, must_map, wish_map, demand)
+    """
+    tmp = users_df.copy()
+    for col in ["employee_id","shift","weekly_cap","senior","junior"]:
+        if col not in tmp.columns:
+            tmp[col] = ""
+    tmp["employee_id"] = tmp["employee_id"].map(normalize_id)
+    tmp["shift"] = tmp["shift"].astype(str).str.upper().map(
+        lambda s: s if s in cat.work else ""
+    )
+    tmp = tmp[(tmp["employee_id"].astype(str).str.len()>0) & (tmp["shift"].isin(cat.order))]
+
+    def to_bool(x):
+        return str(x).strip().upper() in ("TRUE","1","YES","Y","T")
+
+    def to_wcap(x):
+        try:
+            v = int(float(x))
+            return v if v >= 0 else None
+        except:
+            return None
+
+    role_map   = {r.employee_id: r.shift   for r in tmp.itertuples(index=False)}
+    wcap_map   = {r.employee_id: to_wcap(r.weekly_cap) for r in tmp.itertuples(index=False)}
+    senior_map = {r.employee_id: to_bool(r.senior) for r in tmp.itertuples(index=False)}
+    junior_map = {r.employee_id: to_bool(r.junior) for r in tmp.itertuples(index=False)}
+    id_list    = sorted(role_map.keys(), key=lambda s: s)
+
+    # 偏好 map（只留在職名單上的人）
+    all_must, all_wish = preference_maps(prefs_df, year, month)
+    must_map = {nid: set(all_must.get(nid, ())) for nid in id_list}
+    wish_map = {nid: set(all_wish.get(nid, ())) for nid in id_list}
+
+    demand = demand_from_df(demand_df, cat.order)
+
+    return id_list, role_map, wcap_map, senior_map, junior_map, must_map, wish_map, demand
+
+def build_initial_schedule(year, month, users_df, prefs_df, demand_df, cat, seed=0,
+                           assign_mode="greedy", deadline=None):
+    """
+    逐日逐班排出初始班表。assign_mode：
+      - "greedy"：每班依（想休、已排天數、同分次序）一次挑一人
+      - "flow"：每天解一次最小成本流，同時決定各班人選（未安裝 ortools 時退回 greedy）
+    deadline（time.perf_counter 時刻）已過時，其餘日子改用 greedy。
+    """
+    nd = days_in_month(year, month)
+
+    (id_list, role_map, wcap_map, senior_map, junior_map,
+     must_map, wish_map, demand) = roster_inputs(year, month, users_df, prefs_df, demand_df, cat)
+
+    sched = {nid: {d:"" for d in range(1, nd+1)} for nid in id_list}
+    # 位元遮罩（bit d = 第 d 天）：尚未排的日子、想休日
+    full = month_mask(nd)
+    free_bits = {nid: full & ~day_mask(must_map[nid]) for nid in id_list}
+    wish_bits = {nid: day_mask(wish_map[nid]) for nid in id_list}
+    assigned_days = {nid: 0 for nid in id_list}
+    week_cnt = {nid: [0]*6 for nid in id_list}   # 每人各週（1～5）已排上班天數
+    by_role = {s: [nid for nid in id_list if role_map[nid] == s] for s in cat.order}
+
+    def person_units_on(nid, s):
+        return cat.jr_units[s] if junior_map.get(nid,False) else 1.0
+
+    # 先標必休 O（不可被後續邏輯改掉）
+    for nid in id_list:
+        for d in must_map[nid]:
+            if 1 <= d <= nd:
+                sched[nid][d] = "O"
+
+    # 同分時的次序：seed = 0 依員編；其他 seed 依固定亂數（可重現）
+    if seed:
+        rng = random.Random(seed)
+        tiebreak = {nid: rng.random() for nid in id_list}
+    else:
+        tiebreak = {nid: 0.0 for nid in id_list}
+
+    # 選人池：每 (day, shift) 依 (wished, assigned_days, 同分次序, id) 建堆積，
+    # 分「全部／非新人／資深／資深非新人」四堆；
+    # 同一班內只有被選中的人會改變，休息不足、週上限、已排班者於取用時延遲剔除
+    def eligible(nid, d, s):
+        if not free_bits[nid] >> d & 1:
+            return False
+        if not cat.rest_ok(sched[nid].get(d-1,""), s):
+            return False
+        cap = wcap_map[nid]
+        if cap is not None and week_cnt[nid][week_index(d)] >= cap:
+            return False
+        return True
+
+    def pick_pool(d, s):
+        pools = {"all": [], "nj": [], "sen": [], "sen_nj": []}
+        bit = 1 << d
+        for nid in by_role[s]:
+            if not free_bits[nid] & bit:
+                continue
+            key = (1 if wish_bits[nid] & bit else 0, assigned_days[nid], tiebreak[nid], nid)
+            jr = junior_map.get(nid, False)
+            sen = senior_map.get(nid, False)
+            pools["all"].append(key)
+            if not jr:
+                pools["nj"].append(key)
+            if sen:
+                pools["sen"].append(key)
+            if sen and not jr:
+                pools["sen_nj"].append(key)
+        for heap in pools.values():
+            heapq.heapify(heap)
+        return pools
+
+    def peek(heap, d, s):
+        while heap and not eligible(heap[0][-1], d, s):
+            heapq.heappop(heap)
+        return heap[0][-1] if heap else None
+
+    def pick_next(pools, d, s, n_assigned, senior_cnt):
+        # 首位必有資深（避免新人成為唯一）：尚無資深時只從非新人挑
+        if senior_cnt == 0:
+            first = peek(pools["nj"], d, s)
+            sen_heap = pools["sen_nj"]
+        else:
+            first = peek(pools["all"], d, s)
+            sen_heap = pools["sen"]
+        if first is None:
+            return None
+        if s in cat.white and senior_cnt < ceil((n_assigned+1)/3):
+            cand = peek(sen_heap, d, s)
+            if cand is not None:
+                return cand
+        return first
+
+    def take(nid, d, s):
+        sched[nid][d] = s
+        free_bits[nid] &= ~(1 << d)
+        assigned_days[nid] += 1
+        week_cnt[nid][week_index(d)] += 1
+
+    def head_range(d, s):
+        """能力單位需求 → 以正式人員計的最低／上限人數"""
+        mn_u, mx_u = demand.get(d,{}).get(s, (0,0))
+        lo = ceil(mn_u - 1e-9)
+        return [lo, max(lo, ceil(mx_u - 1e-9))]
+
+    # 各班每人平均應上班天數（以上限人數估）：剩餘餘裕 = 之後可上班且非想休的天數 − 還需上班天數
+    share = {
+        s: sum(head_range(d, s)[1] for d in range(1, nd+1)) / max(1, len(by_role[s]))
+        for s in cat.order
+    }
+    rank = {nid: i for i, nid in enumerate(sorted(id_list, key=lambda n: (tiebreak[n], n)))}
+    scale = len(id_list) + 1
+    cost_bound = (FLOW_WISH_COST + FLOW_WEEK_OFF_COST + nd * (FLOW_ASSIGNED_COST + FLOW_SLACK_COST)) * scale + scale
+    reward_quota = 3 * cost_bound
+    reward_max = 10 * cost_bound
+    reward_min = 20 * cost_bound
+
+    def flow_cost(nid, d):
+        bit = 1 << d
+        later = free_bits[nid] & ~wish_bits[nid] & (month_mask(nd) & ~((bit << 1) - 1))
+        slack = bin(later).count("1") - max(0.0, share[role_map[nid]] - assigned_days[nid])
+        wk = week_index(d)
+        first = min(dd for dd in range(1, d+1) if week_index(dd) == wk)
+        last = max(dd for dd in range(d, nd+1) if week_index(dd) == wk)
+        rested = any(sched[nid][dd] == "O" for dd in range(first, d))
+        week_cost = 0.0
+        if not rested and last > first:
+            week_cost = FLOW_WEEK_OFF_COST * (d - first) / (last - first)
+        base = (FLOW_WISH_COST * (1 if wish_bits[nid] & bit else 0)
+                + week_cost
+                + FLOW_ASSIGNED_COST * assigned_days[nid]
+                + FLOW_SLACK_COST * slack)
+        return int(round(base)) * scale + rank[nid]
+
+    def solve_day_flow(d, heads):
+        """
+        一天一次最小成本流：
+          來源 → 人（容量 1，成本見 flow_cost）→ 班；來源 → 匯點可直接流過（當天不排）
+          資深 → 白班資深配額點、非新人 → 首位點，配額點 → 班另有獎勵（資深 1/3、首位非新人）
+          班 → 匯點：先補到最低人數（大獎勵）、再補到上限人數（次大獎勵）
+        回傳 {班別: [人]}
+        """
+        smcf = mcf.SimpleMinCostFlow()
+        source, sink = 0, 1
+        nodes = {}
+
+        def node(key):
+            if key not in nodes:
+                nodes[key] = len(nodes) + 2
+            return nodes[key]
+
+        arcs = []
+        cands = [nid for nid in id_list if free_bits[nid] >> d & 1]
+        for nid in cands:
+            s = role_map[nid]
+            if not eligible(nid, d, s):
+                continue
+            u = node(("nurse", nid))
+            smcf.add_arc_with_capacity_and_unit_cost(source, u, 1, flow_cost(nid, d))
+            arcs.append((smcf.add_arc_with_capacity_and_unit_cost(u, node(("shift", s)), 1, 0), nid, s))
+            if senior_map.get(nid, False) and s in cat.white:
+                arcs.append((smcf.add_arc_with_capacity_and_unit_cost(u, node(("sen", s)), 1, 0), nid, s))
+            if not junior_map.get(nid, False):
+                arcs.append((smcf.add_arc_with_capacity_and_unit_cost(u, node(("nj", s)), 1, 0), nid, s))
+        for s in cat.order:
+            if ("shift", s) not in nodes:
+                continue
+            lo, hi = heads[s]
+            v = nodes[("shift", s)]
+            if ("sen", s) in nodes:
+                smcf.add_arc_with_capacity_and_unit_cost(nodes[("sen", s)], v, ceil(hi / 3), -reward_quota)
+            if ("nj", s) in nodes:
+                smcf.add_arc_with_capacity_and_unit_cost(nodes[("nj", s)], v, 1, -reward_quota)
+            smcf.add_arc_with_capacity_and_unit_cost(v, sink, lo, -reward_min)
+            smcf.add_arc_with_capacity_and_unit_cost(v, sink, hi - lo, -reward_max)
+        smcf.add_arc_with_capacity_and_unit_cost(source, sink, len(cands), 0)
+        smcf.set_node_supply(source, len(cands))
+        smcf.set_node_supply(sink, -len(cands))
+        for key in nodes.values():
+            smcf.set_node_supply(key, 0)
+
+        picks = {s: [] for s in cat.order}
+        if smcf.solve() != smcf.OPTIMAL:
+            return picks
+        for arc, nid, s in arcs:
+            if smcf.flow(arc):
+                picks[s].append(nid)
+        return picks
+
+    def assign_day_by_flow(d):
+        # 新人能力不足 1 單位：單位數未達需求且該班人數已用滿時，人數加一重解
+        heads = {s: head_range(d, s) for s in cat.order}
+        while True:
+            picks = solve_day_flow(d, heads)
+            grow = False
+            for s in cat.order:
+                mn_u, mx_u = demand.get(d,{}).get(s, (0,0))
+                units = sum(person_units_on(nid, s) for nid in picks[s])
+                if len(picks[s]) == heads[s][1] and units + 1e-9 < mx_u:
+                    if units + 1e-9 < mn_u:
+                        heads[s][0] += 1
+                    heads[s][1] += 1
+                    grow = True
+            if not grow:
+                break
+        for s in cat.order:
+            for nid in picks[s]:
+                take(nid, d, s)
+
+    mcf = _load_min_cost_flow() if assign_mode == "flow" else None
+
+    # 逐日逐班排班
+    for d in range(1, nd+1):
+        if mcf is not None and deadline is not None and time.perf_counter() > deadline:
+            mcf = None
+        if mcf is not None:
+            assign_day_by_flow(d)
+        else:
+            for s in cat.order:
+                mn_u, mx_u = demand.get(d,{}).get(s, (0,0))
+                pools = pick_pool(d, s)
+                n_assigned = 0
+                units_sum = 0.0
+                senior_cnt = 0
+
+                # 先達到 min_units，再往 max_units 補
+                for target in (mn_u, mx_u):
+                    while units_sum + 1e-9 < target:
+                        nid = pick_next(pools, d, s, n_assigned, senior_cnt)
+                        if nid is None:
+                            break
+                        take(nid, d, s)
+                        n_assigned += 1
+                        units_sum += person_units_on(nid, s)
+                        if senior_map.get(nid,False):
+                            senior_cnt += 1
+
+        # 其餘沒被排到的人 → O（但不覆蓋原本必休 O）
+        for nid in id_list:
+            if sched[nid][d] == "":
+                sched[nid][d] = "O"
+
+    return sched, demand, role_map, id_list, senior_map, junior_map, wcap_map, must_map, wish_map
+
+# ================== 樣式初排：預先列舉的合法上班／休假樣式 ==================
+# 每週（week_index 區間）一塊，每塊的 上班/休 樣式以位元表示（bit i = 該塊第 i+1 天上班）；
+# 同一組規則參數只列舉一次。整月由各週樣式串接，交界處再檢查連班／連休／短上班段。
+PATTERN_NEED_MIN = 10.0      # 每單位補到最低需求的價值
+PATTERN_NEED_MAX = 3.0       # 每單位補到上限需求的價值
+PATTERN_OVER = -2.0          # 超過上限仍上班
+PATTERN_WISH = -8.0          # 想休日上班
+PATTERN_SENIOR = 15.0        # 白班資深未達配額（需求人數的 1/3）或已不足 1/3 時資深上班的加值
+PATTERN_JUNIOR_OVER = -8.0   # 白班資深已不足 1/3 時非資深再上班（比補上限需求的價值大，不為補上限犧牲資深比例）
+PATTERN_VIOLATION = 1000.0   # 樣式違反規則（只在必休日讓合法樣式都不可行時才會用到）
+PATTERN_SWEEPS = 3           # 逐人重挑樣式的輪數
+
+@lru_cache(maxsize=None)
+def week_patterns(length, max_work_streak, max_off_streak, min_stretch):
+    """
+    列舉長度 length 的所有樣式：(bits, 上班天數, 開頭段(是否上班, 長度), 結尾段(是否上班, 長度),
+    是否整塊同一種, 塊內違規數)。塊內違規：至少一休、連班 ≤ max_work_streak、連休 ≤ max_off_streak、
+    不碰塊邊界的上班段 ≥ min_stretch（碰邊界的段留到串接時檢查）。
+    回傳 (合法樣式, 全部樣式)。
+    """
+    out = []
+    for bits in range(1 << length):
+        runs = []
+        for i in range(length):
+            w = bool(bits >> i & 1)
+            if runs and runs[-1][0] == w:
+                runs[-1][1] += 1
+            else:
+                runs.append([w, 1])
+        viol = 0 if bits != (1 << length) - 1 else 1
+        for k, (w, n) in enumerate(runs):
+            if w and n > max_work_streak or not w and n > max_off_streak:
+                viol += 1
+            if w and 0 < k < len(runs) - 1 and n < min_stretch:
+                viol += 1
+        out.append((bits, bin(bits).count("1"), tuple(runs[0]), tuple(runs[-1]), len(runs) == 1, viol))
+    return tuple(p for p in out if p[5] == 0), tuple(out)
+
+def _join_patterns(trail, pat, max_work_streak, max_off_streak, min_stretch):
+    """前面的結尾段 trail 接上樣式 pat → (新的結尾段, 交界違規數)"""
+    _bits, _n, (lw, ll), last, uniform, _viol = pat
+    tw, tl = trail
+    viol = 0
+    if tw == lw:
+        run = tl + ll
+        if run > (max_work_streak if lw else max_off_streak):
+            viol += 1
+        if uniform:
+            return (lw, run), viol
+        if lw and run < min_stretch:
+            viol += 1
+    else:
+        if tw and tl < min_stretch:
+            viol += 1
+        if uniform:
+            return (lw, ll), viol
+        if lw and ll < min_stretch:
+            viol += 1
+    return last, viol
+
+def build_pattern_schedule(year, month, users_df, prefs_df, demand_df, cat, seed=0,
+                           min_stretch=3, max_work_streak=MAX_WORK_STREAK,
+                           max_off_streak=MAX_OFF_STREAK, min_off=8,
+                           min_work_days=0, max_work_days=31, deadline=None):
+    """
+    樣式初排：每人從合法週樣式串出一整月的上班／休假樣式（固定班、不跨班），
+    依序一人一次：以動態規劃挑「補目前剩餘需求價值最高」的串接，
+    再以每日上班價格（二分搜尋）把上班天數調到該班人均需求附近、且在上下限內。
+    必休日只能用休的樣式；當週沒有合法樣式符合必休時才退用全部樣式（違規重罰）。
+    白班資深比例以每日價值處理：資深補到配額有加值，資深已不足 1/3 時非資深再上班扣分。
+    樣式固定班別，某白班本身的資深不到 1/3 時無法靠換班補足，資深不足會比 greedy 多
+    （greedy 會以少排人或每週一休違規換資深比例）；這種單位宜用 greedy／flow 初排。
+    deadline（time.perf_counter 時刻）已過時：第一輪已排完就停在目前的樣式，
+    否則整份改用 greedy 初排。
+    回傳與 build_initial_schedule 相同。
+    """
+    nd = days_in_month(year, month)
+    (id_list, role_map, wcap_map, senior_map, junior_map,
+     must_map, wish_map, demand) = roster_inputs(year, month, users_df, prefs_df, demand_df, cat)
+
+    blocks = []
+    for d in range(1, nd+1):
+        if not blocks or week_index(d) != week_index(blocks[-1][0]):
+            blocks.append([d, 0])
+        blocks[-1][1] += 1
+
+    def person_units_on(nid, s):
+        return cat.jr_units[s] if junior_map.get(nid, False) else 1.0
+
+    # 剩餘需求（能力單位）與白班資深人數
+    need_min = {(d, s): demand.get(d,{}).get(s,(0,0))[0] for d in range(1, nd+1) for s in cat.order}
+    need_max = {(d, s): demand.get(d,{}).get(s,(0,0))[1] for d in range(1, nd+1) for s in cat.order}
+    heads = {(d, s): 0 for d in range(1, nd+1) for s in cat.order}
+    seniors = {(d, s): 0 for d in range(1, nd+1) for s in cat.order}
+    # 白班資深配額：以需求上限人數的 1/3 計（第一輪資深還沒排完時也知道要留位置給資深）
+    quota = {(d, s): ceil(need_max[d, s] / 3 - 1e-9) for d in range(1, nd+1) for s in cat.order}
+
+    capacity = {s: 0.0 for s in cat.order}
+    for nid in id_list:
+        capacity[role_map[nid]] += person_units_on(nid, role_map[nid])
+    work_hi = min(max_work_days, nd - min_off)
+    work_lo = min(min_work_days, work_hi)
+    target = {
+        s: min(work_hi, max(work_lo, round(sum(need_max[d, s] for d in range(1, nd+1)) / capacity[s])))
+        for s in cat.order if capacity[s] > 0
+    }
+
+    def day_values(nid, s):
+        u = person_units_on(nid, s)
+        sen = senior_map.get(nid, False) and s in cat.white
+        vals = [0.0] * (nd + 1)
+        for d in range(1, nd+1):
+            to_min = max(0.0, min(u, need_min[d, s]))
+            to_max = max(0.0, min(u, need_max[d, s]) - to_min)
+            v = PATTERN_NEED_MIN * to_min + PATTERN_NEED_MAX * to_max
+            if to_min + to_max <= 1e-9:
+                v = PATTERN_OVER
+            if d in wish_map[nid]:
+                v += PATTERN_WISH
+            if s in cat.white:
+                if sen and (seniors[d, s] < quota[d, s] or 3 * seniors[d, s] < heads[d, s] + 1):
+                    v += PATTERN_SENIOR
+                elif not sen and 3 * seniors[d, s] < heads[d, s] + 1:
+                    v += PATTERN_JUNIOR_OVER
+            vals[d] = v
+        return vals
+
+    def candidates(nid):
+        """每週可用的樣式：(樣式, 上班日列表)，符合必休與每週上限"""
+        cap = wcap_map.get(nid)
+        out = []
+        for first, length in blocks:
+            legal, every = week_patterns(length, max_work_streak, max_off_streak, min_stretch)
+            must = 0
+            for d in must_map[nid]:
+                if first <= d < first + length:
+                    must |= 1 << (d - first)
+
+            def fits(p):
+                return not p[0] & must and (cap is None or p[1] <= cap)
+            pats = [p for p in legal if fits(p)] or [p for p in every if fits(p)]
+            out.append([(p, [first + i for i in range(length) if p[0] >> i & 1]) for p in pats])
+        return out
+
+    def best_month(cands, vals, price):
+        states = {(False, 0): (0.0, ())}
+        for pats in cands:
+            new = {}
+            for trail, (score, path) in states.items():
+                for p, days in pats:
+                    key, viol = _join_patterns(trail, p, max_work_streak, max_off_streak, min_stretch)
+                    value = (score + sum(vals[d] for d in days) - price * len(days)
+                             - PATTERN_VIOLATION * (viol + p[5]))
+                    if key not in new or value > new[key][0]:
+                        new[key] = (value, path + (days,))
+            states = new
+        def closing(item):
+            (tw, tl), (score, _path) = item
+            return score - (PATTERN_VIOLATION if tw and tl < min_stretch else 0.0)
+        _key, (_score, path) = max(states.items(), key=closing)
+        return [d for days in path for d in days]
+
+    # 必休多的人先排（可選樣式少）；同分依種子
+    rng = random.Random(seed)
+    tiebreak = {nid: (rng.random() if seed else 0.0) for nid in id_list}
+    order = sorted(id_list, key=lambda nid: (-len(must_map[nid]), tiebreak[nid], nid))
+
+    def book(nid, days, sign):
+        s = role_map[nid]
+        u = person_units_on(nid, s) * sign
+        for d in days:
+            need_min[d, s] -= u
+            need_max[d, s] -= u
+            heads[d, s] += sign
+            if senior_map.get(nid, False):
+                seniors[d, s] += sign
+
+    # 第一輪依序排；之後每輪把每個人的樣式拿掉、依其他人的結果重挑（後排的人補到的洞會回饋給先排的人）
+    chosen = {}
+    for nid in [nid for _sweep in range(PATTERN_SWEEPS) for nid in order]:
+        if deadline is not None and time.perf_counter() > deadline:
+            if len(chosen) < len(order):
+                return build_initial_schedule(year, month, users_df, prefs_df,
+                                              demand_df, cat, seed=seed)
+            break
+        s = role_map[nid]
+        if nid in chosen:
+            book(nid, chosen[nid], -1)
+        vals = day_values(nid, s)
+        cands = candidates(nid)
+        want = target.get(s, work_lo)
+
+        def miss(n):
+            return max(want - n, n - work_hi, 0)
+
+        # 每日上班價格（從 0 開始）：上班天數超過上限就漲價、不到人均就降價；
+        # 落在 [人均, 上限] 之間即採用，缺額多的日子因此仍可多排
+        lo_p, hi_p = -2 * PATTERN_NEED_MIN, 2 * PATTERN_NEED_MIN
+        best = None
+        for _ in range(8):
+            price = (lo_p + hi_p) / 2
+            days = best_month(cands, vals, price)
+            if best is None or miss(len(days)) < miss(len(best)):
+                best = days
+            if len(days) > work_hi:
+                lo_p = price
+            elif len(days) < want:
+                hi_p = price
+            else:
+                break
+        chosen[nid] = best
+        book(nid, best, 1)
+
+    sched = {nid: {d: OFF for d in range(1, nd+1)} for nid in id_list}
+    for nid, days in chosen.items():
+        for d in days:
+            sched[nid][d] = role_map[nid]
+    return sched, demand, role_map, id_list, senior_map, junior_map, wcap_map, must_map, wish_map
+
+# ================== 各種調整函式 ==================
+def cross_shift_balance_with_units(year, month, id_list, state,
+                                   demand, role_map, senior_map, junior_map,
+                                   days=None):
+    nd = days_in_month(year, month)
+    sched = state.sched
+    cat = state.cat
+
+    def senior_ok_after_move(d, nid_move, from_s, to_s):
+        # 移出與移入的班別若為白班，各自資深比例都要 >= 1/3
+        sen = 1 if senior_map.get(nid_move,False) else 0
+        if from_s in cat.white:
+            if not state.white_senior_ok(state.headcount(d, from_s) - 1,
+                                         state.senior_count(d, from_s) - sen):
+                return False
+        if to_s in cat.white:
+            if not state.white_senior_ok(state.headcount(d, to_s) + 1,
+                                         state.senior_count(d, to_s) + sen):
+                return False
+        return True
+
+    for d in (range(1, nd+1) if days is None else days):
+        if state.out_of_time():
+            break
+        mins = {s: demand.get(d,{}).get(s,(0,0))[0] for s in cat.order}
+
+        changed = True
+        while changed:
+            changed = False
+            shortages = [(s, mins[s]-state.actual_units(d,s)) for s in cat.order
+                         if state.actual_units(d,s) + 1e-9 < mins[s]]
+            if not shortages:
+                break
+            shortages.sort(key=lambda x: -x[1])
+
+            for tgt, _need in shortages:
+                for src in cat.order:
+                    if src == tgt:
+                        continue
+                    if state.actual_units(d,src) - 1e-9 <= mins.get(src,0):
+                        continue
+                    candidates = [nid for nid in sorted(state.members(d, src))
+                                  if not junior_map.get(nid,False)]
+                    candidates.sort(key=lambda nid: -state.units_of(nid, src))
+                    moved = False
+
+                    for mv in candidates:
+                        # 移出後來源班別不能反而低於最小需求（否則兩班會來回互搶）
+                        if state.actual_units(d,src) - state.units_of(mv,src) + 1e-9 < mins.get(src,0):
+                            continue
+                        if not senior_ok_after_move(d, mv, src, tgt):
+                            continue
+                        if not (cat.rest_ok(sched[mv].get(d-1,""), tgt) and
+                                cat.rest_ok(tgt, sched[mv].get(d+1,""))):
+                            continue
+
+                        state.assign(mv, d, tgt)
+                        changed = True
+                        moved = True
+                        break
+                    if moved:
+                        break
+    return state
+
+def prefer_off_on_holidays(year, month, state, demand_df, id_list,
+                           role_map, senior_map, junior_map, holiday_set,
+                           days=None):
+    nd = days_in_month(year, month)
+    sched = state.sched
+    cat = state.cat
+    demand = demand_from_df(demand_df, cat.order)
+
+    def is_hday(d):
+        return is_sunday(year, month, d) or (date(year,month,d) in holiday_set)
+
+    for d in (range(1, nd+1) if days is None else days):
+        if state.out_of_time():
+            break
+        if not is_hday(d):
+            continue
+        for s in cat.order:
+            mn, _ = demand.get(d,{}).get(s,(0,0))
+
+            changed = True
+            while changed:
+                changed = False
+                cur = state.actual_units(d, s)
+                if cur <= mn + 1e-9:
+                    break
+
+                cands = sorted(state.members(d, s))
+                cands.sort(key=lambda nid: (state.units_of(nid,s),
+                                            not junior_map.get(nid,False)))
+                moved = False
+                for nid in cands:
+                    u = state.units_of(nid,s)
+                    if cur - u + 1e-9 < mn:
+                        continue
+                    if not state.white_senior_ok_if_remove(d,nid):
+                        continue
+                    if not (cat.rest_ok(sched[nid].get(d-1,""), "O") and
+                            cat.rest_ok("O", sched[nid].get(d+1,""))):
+                        continue
+                    state.assign(nid, d, "O")
+                    changed = True
+                    moved = True
+                    break
+                if not moved:
+                    break
+    return state
+
+def enforce_weekly_one_off(year, month, state, demand_df, id_list,
+                           role_map, senior_map, junior_map, holiday_set):
+    nd = days_in_month(year, month)
+    sched = state.sched
+    cat = state.cat
+    demand = demand_from_df(demand_df, cat.order)
+
+    def week_range(w):
+        if w==1: return range(1,8)
+        if w==2: return range(8,15)
+        if w==3: return range(15,22)
+        if w==4: return range(22,29)
+        return range(29, nd+1)
+
+    week_bits = {w: week_mask(w, nd) for w in [1,2,3,4,5]}
+
+    def has_off(nid, w):
+        return bool(state.code_bits(nid, OFF) & week_bits[w])
+
+    for nid in id_list:
+        if state.out_of_time():
+            break
+        for w in [1,2,3,4,5]:
+            rng = [d for d in week_range(w) if 1 <= d <= nd]
+            if not rng:
+                continue
+            if has_off(nid, w):
+                continue
+            candidates = sorted(rng, key=lambda d: (0 if is_sunday(year, month, d) else 1,))
+            for d in candidates:
+                cur = sched[nid][d]
+                if cur == "O":
+                    break
+                mn = demand.get(d,{}).get(cur,(0,0))[0]
+                u  = state.units_of(nid, cur)
+                if state.actual_units(d, cur) - u + 1e-9 < mn:
+                    continue
+                if not state.white_senior_ok_if_remove(d, nid):
+                    continue
+                if not (cat.rest_ok(sched[nid].get(d-1,""), "O") and
+                        cat.rest_ok("O", sched[nid].get(d+1,""))):
+                    continue
+                state.assign(nid, d, "O")
+                break
+    return state
+
+def enforce_min_monthly_off(year, month, state, demand_df, id_list,
+                            role_map, senior_map, junior_map,
+                            min_off=8, balance=True, holiday_set=None,
+                            target_off=10):
+    nd = days_in_month(year, month)
+    cat = state.cat
+    if holiday_set is None:
+        holiday_set = set()
+    if target_off is None:
+        target_off = min_off
+    target_off = max(min_off, target_off)
+
+    demand = demand_from_df(demand_df, cat.order)
+
+    def is_hday(d):
+        return is_sunday(year, month, d) or (date(year,month,d) in holiday_set)
+
+    # ---- 每 (day, shift) 的 slack 堆積：每班別一堆，元素 (假日優先, -slack, day, 版本) ----
+    # 本函式只會把上班改成 O，slack 只減不增；移不動任何人的格子直接淘汰
+    min_unit = {s: min(1.0, cat.jr_units[s]) for s in cat.order}
+    slot_ver = {}
+    slack_heaps = {s: [] for s in cat.order}
+
+    def push_slot(d, s):
+        ver = slot_ver.get((d, s), 0) + 1
+        slot_ver[(d, s)] = ver
+        slack = state.actual_units(d, s) - demand.get(d,{}).get(s,(0,0))[0]
+        if slack + 1e-9 >= min_unit[s]:
+            heapq.heappush(slack_heaps[s], (1 if is_hday(d) else 2, -slack, d, ver))
+
+    for d in range(1, nd+1):
+        for s in cat.order:
+            push_slot(d, s)
+
+    def best_day(nid, s, cand_bits):
+        """s 班堆積中此人可改休的最佳一格（cand_bits 為此人上 s 班且可改 O 的日子；
+        過期元素丟棄，其餘原樣放回）"""
+        heap = slack_heaps[s]
+        popped = []
+        found = None
+        while heap:
+            entry = heapq.heappop(heap)
+            _hpri, neg_slack, d, ver = entry
+            if slot_ver[(d, s)] != ver:
+                continue
+            popped.append(entry)
+            if not cand_bits >> d & 1:
+                continue
+            if -neg_slack + 1e-9 < state.units_of(nid, s):
+                continue
+            if not state.white_senior_ok_if_remove(d, nid):
+                continue
+            found = entry
+            break
+        for entry in popped:
+            heapq.heappush(heap, entry)
+        return found
+
+    # ---- 依 O 天數分桶：每桶為員工索引的堆積，已移到別桶者延遲剔除 ----
+    off_cnt = state.code_counts[:, cat.off_idx].tolist()
+    buckets = {}
+    for i, k in enumerate(off_cnt):
+        buckets.setdefault(k, []).append(i)
+    lo = min(off_cnt) if off_cnt else 0
+    hi = max(off_cnt) if off_cnt else 0
+
+    def bucket_members(k):
+        return sorted(i for i in buckets.get(k, ()) if off_cnt[i] == k)
+
+    def lowest():
+        """O 天數最少者（同數取 id 最小）"""
+        nonlocal lo
+        while lo <= hi:
+            heap = buckets.get(lo, [])
+            while heap and off_cnt[heap[0]] != lo:
+                heapq.heappop(heap)
+            if heap:
+                return heap[0]
+            lo += 1
+        return None
+
+    def try_add_one_off(nid):
+        nonlocal hi
+        i = state.index[nid]
+        if off_cnt[i] >= target_off:
+            return False
+        best = None
+        off_ok = state.can_take_bits(nid, OFF)
+        for s in cat.order:
+            cand_bits = state.code_bits(nid, s) & off_ok
+            if not cand_bits:
+                continue
+            entry = best_day(nid, s, cand_bits)
+            if entry is not None and (best is None or entry[:3] < best[0][:3]):
+                best = (entry, s)
+        if best is None:
+            return False
+        (_hpri, _neg_slack, chosen_d, _ver), s = best
+        state.assign(nid, chosen_d, "O")
+        push_slot(chosen_d, s)
+        off_cnt[i] += 1
+        heapq.heappush(buckets.setdefault(off_cnt[i], []), i)
+        hi = max(hi, off_cnt[i])
+        return True
+
+    # 先確保至少 min_off
+    changed = True
+    while changed:
+        if state.out_of_time():
+            break
+        changed = False
+        lowest()
+        needs = [state.id_list[i] for k in range(lo, min_off) for i in bucket_members(k)]
+        if not needs:
+            break
+        for nid in needs:
+            if try_add_one_off(nid):
+                changed = True
+
+    if not balance:
+        return state
+
+    # 平衡 O，讓大家接近：每次補最少者一天，直到差距 <= 1 或最少者補不動
+    while True:
+        if state.out_of_time():
+            break
+        i = lowest()
+        if i is None or hi - lo <= 1:
+            break
+        if not try_add_one_off(state.id_list[i]):
+            break
+
+    return state
+
+def enforce_min_work_stretch(year, month, state, demand_df, id_list,
+                             role_map, senior_map, junior_map,
+                             min_stretch=3,
+                             holiday_set=None, must_map=None):
+    sched = state.sched
+    cat = state.cat
+    if holiday_set is None:
+        holiday_set = set()
+    if must_map is None:
+        must_map = {}
+
+    demand = demand_from_df(demand_df, cat.order)
+
+    def try_move_off_forward(nid, d):
+        s_fixed = role_map[nid]
+        if s_fixed not in cat.work:
+            return False
+        # 必休與前後休息一次以位元遮罩判斷
+        if not state.can_take_bits(nid, s_fixed) >> d & 1:
+            return False
+        mn_d, mx_d = demand.get(d,{}).get(s_fixed,(0,0))
+        if state.actual_units(d, s_fixed) + state.units_of(nid,s_fixed) > mx_d + 1e-9:
+            return False
+        if not state.white_senior_ok_if_add(d, nid, s_fixed):
+            return False
+
+        later_work = state.work_bits(nid) & state.can_take_bits(nid, OFF)
+        for d2 in iter_days((later_work >> (d+1)) << (d+1)):
+            s2 = sched[nid][d2]
+            mn2, _mx2 = demand.get(d2,{}).get(s2,(0,0))
+            if state.actual_units(d2,s2) - state.units_of(nid,s2) + 1e-9 < mn2:
+                continue
+            if not state.white_senior_ok_if_remove(d2, nid):
+                continue
+            state.assign(nid, d, s_fixed)
+            state.assign(nid, d2, "O")
+            return True
+        return False
+
+    # 迭代到不再變動：每次成功都是把一天 O 往後移，必然收斂
+    changed = True
+    while changed:
+        changed = False
+        for nid in id_list:
+            if state.out_of_time():
+                break
+            # 逐一取目前（非必休）O 的下一天；移動後新的 O 只會出現在更後面
+            d = first_day_after(state.code_bits(nid, OFF) & ~state.must_bits[nid], 0)
+            while d is not None:
+                if state.segments.streak_before(nid, d) < min_stretch:
+                    if try_move_off_forward(nid, d):
+                        changed = True
+                d = first_day_after(state.code_bits(nid, OFF) & ~state.must_bits[nid], d)
+    return state
+
+def enforce_streak_preferences(year, month, state, demand_df, id_list,
+                               role_map, senior_map, junior_map,
+                               max_work_streak=5, max_off_streak=2,
+                               min_monthly_off=8,
+                               min_before=0, min_after=0,
+                               target_off=10,
+                               holiday_set=None, must_map=None):
+    nd = days_in_month(year, month)
+    sched = state.sched
+    cat = state.cat
+    if holiday_set is None:
+        holiday_set = set()
+    if must_map is None:
+        must_map = {}
+
+    demand = demand_from_df(demand_df, cat.order)
+
+    def off_before(nid):
+        return state.count_code_between(nid, "O", 1, 15)
+
+    def off_after(nid):
+        return state.count_code_between(nid, "O", 16, nd)
+
+    # 1) 最大連續上班天數（> max_work_streak 會試圖插 O）
+    for nid in id_list:
+        if state.out_of_time():
+            break
+        for start, end in state.segments.runs(nid):
+            if end - start + 1 <= max_work_streak:
+                continue
+            for mid in range(start+1, end):
+                if mid in must_map.get(nid,set()):
+                    continue
+                s_mid = sched[nid][mid]
+                mn = demand.get(mid,{}).get(s_mid,(0,0))[0]
+                u  = state.units_of(nid, s_mid)
+                if state.actual_units(mid, s_mid) - u + 1e-9 < mn:
+                    continue
+                if not state.white_senior_ok_if_remove(mid, nid):
+                    continue
+                if state.off_total(nid) + 1 > target_off + 2:
+                    continue
+                if not (cat.rest_ok(sched[nid].get(mid-1,""), "O") and
+                        cat.rest_ok("O", sched[nid].get(mid+1,""))):
+                    continue
+                state.assign(nid, mid, "O")
+                break
+
+    # 2) 限制連續休假天數（> max_off_streak 時嘗試插上班）
+    for nid in id_list:
+        if state.out_of_time():
+            break
+        s_fixed = role_map[nid]
+        if s_fixed not in cat.work:
+            continue
+        for start, end in state.segments.gaps(nid):
+            if end - start + 1 <= max_off_streak:
+                continue
+            for mid in range(start+1, end):
+                if mid in must_map.get(nid,set()):
+                    continue
+                if mid <= 15:
+                    if min_before > 0 and off_before(nid) - 1 < min_before:
+                        continue
+                else:
+                    if min_after > 0 and off_after(nid) - 1 < min_after:
+                        continue
+                if state.off_total(nid) - 1 < min_monthly_off:
+                    continue
+
+                mn, mx = demand.get(mid,{}).get(s_fixed,(0,0))
+                if state.actual_units(mid, s_fixed) + state.units_of(nid,s_fixed) > mx + 1e-9:
+                    continue
+                if not state.white_senior_ok_if_add(mid, nid, s_fixed):
+                    continue
+                if not (cat.rest_ok(sched[nid].get(mid-1,""), s_fixed) and
+                        cat.rest_ok(s_fixed, sched[nid].get(mid+1,""))):
+                    continue
+                state.assign(nid, mid, s_fixed)
+                break
+
+    return state
+
+def hard_break_long_work_streaks(year, month, state, demand_df, id_list,
+                                 role_map, senior_map, junior_map,
+                                 max_work_streak=5,
+                                 min_monthly_off=8,
+                                 must_map=None):
+    """
+    更強制版：只要某人連續上班 > max_work_streak，就盡量在中間插 O
+    只確保：
+      1) 當日能力 >= min_units
+      2) 白班資深比例維持 >= 1/3
+      3) 這個人月休最後 >= min_monthly_off
+    """
+    sched = state.sched
+    cat = state.cat
+    if must_map is None:
+        must_map = {}
+
+    demand = demand_from_df(demand_df, cat.order)
+
+    for nid in id_list:
+        if state.out_of_time():
+            break
+        for start, end in state.segments.runs(nid):
+            length = end - start + 1
+            if length <= max_work_streak:
+                continue
+
+            cur_off = state.off_total(nid)
+            needed_breaks = ceil(length / max_work_streak) - 1
+
+            candidates = list(range(start + 1, end))
+            score_list = []
+            for day in candidates:
+                if day in must_map.get(nid, set()):
+                    continue
+                s_code = sched[nid][day]
+                mn, _mx = demand.get(day, {}).get(s_code, (0, 0))
+                u = state.units_of(nid, s_code)
+                slack = state.actual_units(day, s_code) - u - mn
+                score_list.append((slack, day, s_code, u))
+
+            score_list.sort(reverse=True, key=lambda x: x[0])
+
+            used = 0
+            for slack, day, s_code, u in score_list:
+                if used >= needed_breaks:
+                    break
+                if slack < -1e-9:
+                    continue
+                # 把某人從 D 變成 O 時，白班資深比例是否仍 >= 1/3
+                if not state.white_senior_ok_if_remove(day, nid):
+                    continue
+                if cur_off + 1 < min_monthly_off:
+                    pass
+                state.assign(nid, day, "O")
+                cur_off += 1
+                used += 1
+
+    return state
+
+def smooth_short_work_segments(year, month, state, demand_df, id_list,
+                               role_map, senior_map, junior_map,
+                               min_stretch=3,
+                               min_monthly_off=8,
+                               min_before=0,
+                               min_after=0,
+                               holiday_set=None,
+                               must_map=None):
+    nd = days_in_month(year, month)
+    sched = state.sched
+    cat = state.cat
+    if holiday_set is None:
+        holiday_set = set()
+    if must_map is None:
+        must_map = {}
+
+    demand = demand_from_df(demand_df, cat.order)
+
+    def off_before(nid):
+        return state.count_code_between(nid, "O", 1, 15)
+
+    def off_after(nid):
+        return state.count_code_between(nid, "O", 16, nd)
+
+    for nid in id_list:
+        if state.out_of_time():
+            break
+        for start, end in state.segments.short_runs(nid, min_stretch):
+            # 前面的延長可能已與此段合併，重新取得目前所在的整段
+            run = state.segments.run_at(nid, start)
+            if run is None:
+                continue
+            start, end = run
+            length = end - start + 1
+            if length >= min_stretch:
+                continue
+            extended = True
+            while length < min_stretch and extended:
+                extended = False
+                # 左邊
+                ld = start - 1
+                if ld >= 1 and sched[nid][ld] == "O" and ld not in must_map.get(nid,set()):
+                    if state.off_total(nid) - 1 >= min_monthly_off:
+                        if (ld <= 15 and (min_before == 0 or off_before(nid) - 1 >= min_before)) or \
+                           (ld >= 16 and (min_after == 0 or off_after(nid) - 1 >= min_after)):
+                            s_fixed = role_map[nid]
+                            if s_fixed in cat.work:
+                                mn, mx = demand.get(ld,{}).get(s_fixed,(0,0))
+                                if state.actual_units(ld, s_fixed) + state.units_of(nid,s_fixed) <= mx + 1e-9:
+                                    if state.white_senior_ok_if_add(ld, nid, s_fixed):
+                                        if cat.rest_ok(sched[nid].get(ld-1,""), s_fixed) and \
+                                           cat.rest_ok(s_fixed, sched[nid].get(ld+1,"")):
+                                            state.assign(nid, ld, s_fixed)
+                                            start, end = state.segments.run_at(nid, ld)
+                                            extended = True
+                length = end - start + 1
+                # 右邊
+                rd = end + 1
+                if length < min_stretch and rd <= nd and sched[nid][rd] == "O" and rd not in must_map.get(nid,set()):
+                    if state.off_total(nid) - 1 >= min_monthly_off:
+                        if (rd <= 15 and (min_before == 0 or off_before(nid) - 1 >= min_before)) or \
+                           (rd >= 16 and (min_after == 0 or off_after(nid) - 1 >= min_after)):
+                            s_fixed = role_map[nid]
+                            if s_fixed in cat.work:
+                                mn, mx = demand.get(rd,{}).get(s_fixed,(0,0))
+                                if state.actual_units(rd, s_fixed) + state.units_of(nid,s_fixed) <= mx + 1e-9:
+                                    if state.white_senior_ok_if_add(rd, nid, s_fixed):
+                                        if cat.rest_ok(sched[nid].get(rd-1,""), s_fixed) and \
+                                           cat.rest_ok(s_fixed, sched[nid].get(rd+1,"")):
+                                            state.assign(nid, rd, s_fixed)
+                                            start, end = state.segments.run_at(nid, rd)
+                                            extended = True
+                length = end - start + 1
+
+    return state
+
+def ensure_no_seven_consecutive_work(year, month, state, id_list, must_map=None):
+    """
+    最後防線：任何人連續上班 >= 7 天，就一定拆開，插入 O
+    （這裡不再看 min_units / 資深比例，只優先符合勞基法不連七）。
+    """
+    if must_map is None:
+        must_map = {}
+    nd = days_in_month(year, month)
+    sched = state.sched
+    cat = state.cat
+
+    for nid in id_list:
+        for start, end in state.segments.runs(nid):
+            length = end - start + 1
+            if length < 7:
+                continue
+            needed_breaks = (length - 1) // 6
+
+            insert_points = []
+            base = start + 5
+            while base <= end and len(insert_points) < needed_breaks:
+                insert_points.append(base)
+                base += 6
+
+            for day in insert_points:
+                choose = None
+                for delta in range(0, 3):
+                    for cand in [day - delta, day + delta]:
+                        if cand < start or cand > end:
+                            continue
+                        if cand < 1 or cand > nd:
+                            continue
+                        if cand in must_map.get(nid, set()):
+                            continue
+                        if sched[nid][cand] in cat.work:
+                            choose = cand
+                            break
+                    if choose is not None:
+                        break
+
+                if choose is not None:
+                    state.assign(nid, choose, "O")
+
+    return state
+
+def enforce_workday_limits(year, month, state, demand_df, id_list,
+                           role_map, senior_map, junior_map,
+                           min_work_days, max_work_days,
+                           min_monthly_off, max_work_streak,
+                           holiday_set=None, must_map=None):
+    """
+    限制每個人「本月總上班天數」介於 [min_work_days, max_work_days]：
+      - 若超過 max_work_days：找幾天上班改成 O
+      - 若低於 min_work_days：找幾天 O 改成該人的固定班別
+    並且：
+      - 不打破每日 min_units
+      - 白班仍維持資深 >= 1/3
+      - 不把月休壓到 min_monthly_off 以下
+      - 不製造 > max_work_streak 或 >=7 天連班
+    """
+    nd = days_in_month(year, month)
+    sched = state.sched
+    cat = state.cat
+
+    # 防呆：若設定顛倒就互換
+    if min_work_days > max_work_days:
+        min_work_days, max_work_days = max_work_days, min_work_days
+
+    # 需求表轉成好查的 dict
+    demand = demand_from_df(demand_df, cat.order)
+
+    if holiday_set is None:
+        holiday_set = set()
+    if must_map is None:
+        must_map = {nid: set() for nid in id_list}
+
+    def is_hday(d):
+        return is_sunday(year, month, d) or (date(year, month, d) in holiday_set)
+
+    # ---------- A. 先處理「上班太多」的人，讓 work_total <= max_work_days ----------
+    for nid in id_list:
+        while state.work_total(nid) > max_work_days:
+            if state.out_of_time():
+                break
+            candidates = []
+            for d in range(1, nd + 1):
+                if d in must_map.get(nid, set()):
+                    continue
+                s = sched[nid][d]
+                if s not in cat.work:
+                    continue
+                mn, _mx = demand.get(d, {}).get(s, (0, 0))
+                u = state.units_of(nid, s)
+                # 移除之後不能低於最小需求
+                if state.actual_units(d, s) - u + 1e-9 < mn:
+                    continue
+                if not state.white_senior_ok_if_remove(d, nid):
+                    continue
+                if not (cat.rest_ok(sched[nid].get(d - 1, ""), "O") and
+                        cat.rest_ok("O", sched[nid].get(d + 1, ""))):
+                    continue
+                slack = state.actual_units(d, s) - mn
+                candidates.append((0 if is_hday(d) else 1, -slack, d))
+
+            if not candidates:
+                break
+
+            candidates.sort()
+            _, _, chosen_d = candidates[0]
+            state.assign(nid, chosen_d, "O")
+
+    # ---------- B. 再處理「上班太少」的人，讓 work_total >= min_work_days ----------
+    for nid in id_list:
+        while state.work_total(nid) < min_work_days:
+            if state.out_of_time():
+                break
+            candidates = []
+            s_fixed = role_map[nid]
+            if s_fixed not in cat.work:
+                break
+
+            for d in range(1, nd + 1):
+                if d in must_map.get(nid, set()):
+                    continue
+                if sched[nid][d] != "O":
+                    continue
+                # 不能把月休壓到小於 min_monthly_off
+                if state.off_total(nid) - 1 < min_monthly_off:
+                    continue
+
+                mn, mx = demand.get(d, {}).get(s_fixed, (0, 0))
+                u = state.units_of(nid, s_fixed)
+                # 加上去不能超過 max_units
+                if state.actual_units(d, s_fixed) + u > mx + 1e-9:
+                    continue
+                # 前一天、隔一天 11 小時休息 + 不製造太長連班
+                if not (cat.rest_ok(sched[nid].get(d - 1, ""), s_fixed) and
+                        cat.rest_ok(s_fixed, sched[nid].get(d + 1, ""))):
+                    continue
+
+                new_streak = state.segments.streak_if_add(nid, d)
+                if new_streak > max_work_streak:
+                    continue
+                if new_streak >= 7:  # 絕對不要連七
+                    continue
+
+                if not state.white_senior_ok_if_add(d, nid, s_fixed):
+                    continue
+
+                slack = mx - (state.actual_units(d, s_fixed) + u)
+                candidates.append((1 if is_hday(d) else 0, -slack, d))
+
+            if not candidates:
+                break
+
+            candidates.sort()
+            _, _, chosen_d = candidates[0]
+            state.assign(nid, chosen_d, s_fixed)
+
+    return state
+
+# ================== 違規統計 ==================
+def schedule_violations(state, demand, min_stretch=3, max_work_streak=5, max_off_streak=2,
+                        min_off=8, min_work_days=0, max_work_days=31, balance=True,
+                        wcap_map=None):
+    """各規則目前剩餘的違規數（班次以 (day, shift) 計、週以 (人, 週) 計，其餘以人或段計）"""
+    cat = state.cat
+    nd = state.nd
+    out = {k: 0 for k in VIOLATION_WEIGHTS}
+
+    mins = np.array([[demand.get(d,{}).get(s,(0,0))[0] for s in cat.order]
+                     for d in range(1, nd+1)], dtype=float)
+    out["班次不足"] = int(np.count_nonzero(state.units_by_day() + 1e-9 < mins))
+    out["白班資深不足"] = sum(
+        1 for d in range(1, nd+1) for s in cat.white
+        if not state.white_senior_ok(state.headcount(d, s), state.senior_count(d, s))
+    )
+
+    week_bits = [week_mask(w, nd) for w in [1,2,3,4,5]]
+    for nid in state.id_list:
+        for start, end in state.segments.runs(nid):
+            length = end - start + 1
+            if length >= 7:
+                out["連七"] += 1
+            if length > max_work_streak:
+                out["連班過長"] += 1
+            if length < min_stretch:
+                out["短上班段"] += 1
+        for start, end in state.segments.gaps(nid):
+            if end - start + 1 > max_off_streak:
+                out["連休過長"] += 1
+        off_bits = state.code_bits(nid, OFF)
+        out["週未休"] += sum(1 for wb in week_bits if wb and not off_bits & wb)
+        cap = (wcap_map or {}).get(nid)
+        if cap is not None:
+            work_bits = state.work_bits(nid)
+            out["超過每週上限"] += sum(1 for wb in week_bits if (work_bits & wb).bit_count() > cap)
+
+    offs = state.code_counts[:, cat.off_idx]
+    work = state.code_counts[:, cat.work_idx].sum(axis=1)
+    out["月休不足"] = int(np.count_nonzero(offs < min_off))
+    out["上班天數超出"] = int(np.count_nonzero((work < min_work_days) | (work > max_work_days)))
+    if balance and len(offs):
+        out["月休差距"] = max(int(offs.max() - offs.min()) - 1, 0)
+    return out
+
+def violation_score(violations):
+    return sum(VIOLATION_WEIGHTS[k] * v for k, v in violations.items())
+
+# ================== 規則管線：只重跑受影響的規則直到不動點 ==================
+def run_rule_pipeline(state, rules, score_fn, max_rounds=PIPELINE_MAX_ROUNDS, keep_initial=False,
+                      on_rule=None, resume=None, on_checkpoint=None):
+    """
+    rules：依序的 (名稱, fn, 違規項目)；fn(nurses, days) 只需處理傳入的人／日
+    （需看全體的規則可忽略參數、整體重算）。score_fn(state) 回傳各違規項目的數量。
+
+    第一輪所有規則都跑；之後每條規則只在上次跑完後有人／日被（任何規則）改過時，
+    帶著這些 dirty 人／日重跑。每輪結束以加權違規分數判斷：
+    沒有任何變動即收斂；分數沒有變好就退回上一輪的班表並停止；最多跑 max_rounds 輪。
+    state 設有 deadline 時，逾時就在規則之間停下，同樣以分數決定是否退回上一輪。
+    keep_initial=True 時傳入的班表也算一輪（第一輪沒有變好就退回原班表），
+    給本身已大致合規的初排（如樣式初排）用。
+    on_rule(輪數, 規則序號, 名稱) 在每條規則檢查完後呼叫（進度顯示用）。
+    on_checkpoint(規則序號, 進度) 在第一輪每條規則跑完後呼叫，進度為當時的管線紀錄
+    （呼叫端須立即複製或序列化）；之後以 resume=進度 搭配當時的班表狀態，
+    可從下一條規則接著跑，結果與從頭跑相同（逐步檢查點用）。
+    回傳 (每條規則的收斂報告, 最終違規統計)。
+    """
+    last = {name: -1 for name, _fn, _key in rules}
+    report = {name: {"規則": name, "執行次數": 0, "修改格數": 0, "最後一輪修改": 0}
+              for name, _fn, _key in rules}
+    if resume is None:
+        best_violations = score_fn(state) if keep_initial else None
+        best_grid = state.snapshot() if keep_initial else None
+        start, first_changes = 0, 0
+    else:
+        # 只接手本次規則清單上的紀錄（後段規則可能與存檔時不同）
+        last.update((k, v) for k, v in resume["last"].items() if k in last)
+        report.update((k, v) for k, v in resume["report"].items() if k in report)
+        best_violations, best_grid = resume["best_violations"], resume["best_grid"]
+        start, first_changes = resume["next"], resume["round_changes"]
+
+    rounds = 0
+    converged = False
+    while rounds < max_rounds:
+        rounds += 1
+        round_changes = first_changes if rounds == 1 else 0
+        for i, (name, fn, _key) in enumerate(rules):
+            if rounds == 1 and i < start:
+                continue
+            if state.out_of_time():
+                break
+            nurses = state.nurses_touched_since(last[name])
+            if nurses:
+                days = state.days_touched_since(last[name])
+                before = state.stamp
+                fn(nurses, days)
+                delta = state.stamp - before
+                last[name] = state.stamp
+                report[name]["執行次數"] += 1
+                report[name]["修改格數"] += delta
+                round_changes += delta
+            else:
+                delta = 0
+            report[name]["最後一輪修改"] = delta
+            if on_rule is not None:
+                on_rule(rounds, i, name)
+            if on_checkpoint is not None and rounds == 1:
+                on_checkpoint(i, {"next": i + 1, "last": last, "report": report,
+                                  "round_changes": round_changes,
+                                  "best_violations": best_violations, "best_grid": best_grid})
+
+        violations = score_fn(state)
+        if best_violations is not None and \
+           violation_score(violations) >= violation_score(best_violations):
+            # 這一輪沒有變好：退回上一輪結果
+            state.restore(best_grid)
+            violations = best_violations
+            converged = True
+            break
+        best_violations = violations
+        best_grid = state.snapshot()
+        if round_changes == 0:
+            converged = True
+            break
+        if state.out_of_time():
+            break
+
+    for name, _fn, key in rules:
+        rec = report[name]
+        rec["收斂"] = converged or rec["最後一輪修改"] == 0
+        rec["剩餘違規"] = violations.get(key, 0) if key else 0
+        rec["輪數"] = rounds
+    return list(report.values()), violations
+
+# ================== 逐步檢查點：只改後段規則的參數時從中間接著排 ==================
+PASS_CHECKPOINT_ENTRIES = 64   # 每個 PassCheckpoints 保留的步驟數
+
+def frame_digest(df):
+    """資料表內容的 sha256（欄名 + 各列雜湊；跨行程穩定）"""
+    h = hashlib.sha256(json.dumps([str(c) for c in df.columns]).encode("utf-8"))
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+def _chain_key(prev, *parts):
+    return hashlib.sha256(json.dumps([prev, *parts], sort_keys=True, default=str)
+                          .encode("utf-8")).hexdigest()
+
+class PassCheckpoints:
+    """
+    初排與規則管線第一輪每條規則之後的班表狀態（pickle 後存放，行程內 LRU，可跨執行緒共用）。
+    鍵是一條雜湊鏈：每一步的鍵 = 前一步的鍵 + 這一步用到的參數；只改某條規則的參數時，
+    它之前各步的鍵不變，schedule_month 從最後一個還對得上的步驟接著排，結果與從頭排相同。
+    """
+
+    def __init__(self, max_entries=PASS_CHECKPOINT_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def latest(self, keys):
+        """keys（依步驟順序）中最後一個有存的 → (步驟序號, 內容)；都沒有回傳 None"""
+        with self._lock:
+            for step in range(len(keys) - 1, -1, -1):
+                blob = self._entries.get(keys[step])
+                if blob is not None:
+                    self._entries.move_to_end(keys[step])
+                    break
+            else:
+                return None
+        return step, pickle.loads(blob)
+
+    def put(self, key, payload):
+        blob = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._entries[key] = blob
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+# ================== 局部搜尋（模擬退火） ==================
+def improve_by_local_search(year, month, state, demand, id_list, role_map, holiday_set,
+                            iterations=20000, seed=0, time_limit=None, wcap_map=None,
+                            min_stretch=3, max_work_streak=5, max_off_streak=2,
+                            min_off=8, target_off=10, min_work_days=0, max_work_days=31,
+                            t_start=5.0, t_end=0.05):
+    """
+    以模擬退火改善規則排完的班表。鄰域：
+      - flip：某人某天 上班 ↔ O
+      - swap：同固定班別的兩人在同一天互換（一人上班、一人休）
+      - shift-move：某人把一天上班移到另一天（本月上班天數不變）
+    每步只重算受影響的人（O(天數)）與 (day, shift)（O(1)）的目標值。
+    必休、11 小時休息、白班資深比例、不可全為新人視為硬性；
+    連七、連班過長、週未休、超過每週上限、月休不足、上班天數超出以「每人違規數不可增加」把關。
+    回傳統計 dict；班表最後退回搜尋過程中最好的一份。
+    """
+    nd = state.nd
+    sched = state.sched
+    cat = state.cat
+    w = LOCAL_SEARCH_WEIGHTS
+    rng = random.Random(seed)
+
+    hol_bits = day_mask(d for d in range(1, nd+1)
+                        if is_sunday(year, month, d) or date(year, month, d) in holiday_set)
+    week_bits = [wb for wb in (week_mask(k, nd) for k in [1,2,3,4,5]) if wb]
+    movable = [nid for nid in id_list if role_map.get(nid) in cat.work]
+    by_role = {s: [nid for nid in movable if role_map[nid] == s] for s in cat.order}
+
+    def slot_cost(d, s):
+        mn, mx = demand.get(d,{}).get(s,(0,0))
+        act = state.actual_units(d, s)
+        return w["缺額單位"] * max(0.0, mn - act) + w["超編單位"] * max(0.0, act - mx)
+
+    def slot_ok(d, s):
+        total = state.headcount(d, s)
+        if total and state.junior_count(d, s) == total:
+            return False
+        if s in cat.white:
+            return state.white_senior_ok(total, state.senior_count(d, s))
+        return True
+
+    def nurse_cost(nid):
+        """回傳 (硬性違規數, 軟性成本)"""
+        work_bits = state.work_bits(nid)
+        off_bits = state.code_bits(nid, OFF)
+        off = off_bits.bit_count()
+        work = work_bits.bit_count()
+        hard = 0
+        short = 0
+        for start, end in state.segments.runs(nid):
+            length = end - start + 1
+            if length >= 7:
+                hard += 1
+            if length > max_work_streak:
+                hard += 1
+            if length < min_stretch:
+                short += 1
+        long_gaps = sum(1 for start, end in state.segments.gaps(nid)
+                        if end - start + 1 > max_off_streak)
+        hard += sum(1 for wb in week_bits if not off_bits & wb)
+        cap = (wcap_map or {}).get(nid)
+        if cap is not None:
+            hard += sum(1 for wb in week_bits if (work_bits & wb).bit_count() > cap)
+        hard += (off < min_off) + (work < min_work_days) + (work > max_work_days)
+        soft = (w["月休偏差"] * (off - target_off) ** 2
+                + w["想休上班"] * (work_bits & state.wish_bits[nid]).bit_count()
+                + w["短上班段"] * short
+                + w["連休過長"] * long_gaps
+                + w["假日上班"] * (work_bits & hol_bits).bit_count() ** 2)
+        return hard, soft
+
+    def objective(hard, soft):
+        return w["硬性違規"] * hard + soft
+
+    def total_cost():
+        cost = sum(objective(*nurse_cost(nid)) for nid in id_list)
+        cost += sum(slot_cost(d, s) for d in range(1, nd+1) for s in cat.order)
+        return cost
+
+    def propose():
+        """隨機產生一組 [(nid, day, 新代碼)]；無合適候選回傳 None"""
+        nid = rng.choice(movable)
+        s_fixed = role_map[nid]
+        d = rng.randint(1, nd)
+        cur = sched[nid][d]
+        r = rng.random()
+        if r < 0.4:
+            return [(nid, d, s_fixed if cur == OFF else OFF)]
+        if r < 0.7:
+            other = rng.choice(by_role[s_fixed])
+            if other == nid:
+                return None
+            if cur == s_fixed and sched[other][d] == OFF:
+                return [(nid, d, OFF), (other, d, s_fixed)]
+            if cur == OFF and sched[other][d] == s_fixed:
+                return [(other, d, OFF), (nid, d, s_fixed)]
+            return None
+        d2 = rng.randint(1, nd)
+        if cur in cat.work and sched[nid][d2] == OFF:
+            return [(nid, d, OFF), (nid, d2, s_fixed)]
+        if cur == OFF and sched[nid][d2] in cat.work:
+            return [(nid, d2, OFF), (nid, d, s_fixed)]
+        return None
+
+    def undo(applied):
+        for nid, d, old in reversed(applied):
+            state.assign(nid, d, old)
+
+    cost = total_cost()
+    stats = {"起始成本": round(cost, 2), "嘗試步數": 0, "接受步數": 0, "改善步數": 0}
+    best_cost = cost
+    best_grid = state.snapshot()
+    t0 = time.perf_counter()
+    cool = (t_end / t_start) ** (1.0 / iterations) if iterations > 0 else 1.0
+    temp = t_start
+
+    for it in range(iterations):
+        if it % 256 == 0 and ((time_limit is not None and time.perf_counter() - t0 > time_limit)
+                              or state.out_of_time()):
+            break
+        temp *= cool
+        move = propose()
+        if move is None:
+            continue
+        stats["嘗試步數"] += 1
+
+        nurses = {nid for nid, _d, _c in move}
+        slots = set()
+        for nid, d, code in move:
+            for c in (sched[nid][d], code):
+                if c in cat.work:
+                    slots.add((d, c))
+        before_nurse = {nid: nurse_cost(nid) for nid in nurses}
+        before_slots = {key: (slot_cost(*key), slot_ok(*key)) for key in slots}
+
+        # 逐格套用；必休與前後休息以位元遮罩檢查
+        applied = []
+        legal = True
+        for nid, d, code in move:
+            if not state.can_take_bits(nid, code) >> d & 1:
+                legal = False
+                break
+            applied.append((nid, d, sched[nid][d]))
+            state.assign(nid, d, code)
+        if legal:
+            for key in slots:
+                if before_slots[key][1] and not slot_ok(*key):
+                    legal = False
+                    break
+        after_nurse = {}
+        if legal:
+            for nid in nurses:
+                after_nurse[nid] = nurse_cost(nid)
+                if after_nurse[nid][0] > before_nurse[nid][0]:
+                    legal = False
+                    break
+        if not legal:
+            undo(applied)
+            continue
+
+        delta = sum(objective(*after_nurse[nid]) - objective(*before_nurse[nid]) for nid in nurses)
+        delta += sum(slot_cost(*key) - before_slots[key][0] for key in slots)
+        if delta <= 0 or rng.random() < exp(-delta / temp):
+            cost += delta
+            stats["接受步數"] += 1
+            if delta < 0:
+                stats["改善步數"] += 1
+            if cost < best_cost - 1e-9:
+                best_cost = cost
+                best_grid = state.snapshot()
+        else:
+            undo(applied)
+
+    state.restore(best_grid)
+    elapsed = time.perf_counter() - t0
+    stats["最終成本"] = round(total_cost(), 2)
+    stats["秒數"] = round(elapsed, 2)
+    stats["每秒步數"] = int(stats["嘗試步數"] / elapsed) if elapsed > 0 else 0
+    return stats
+
+# ================== 精確解後端（CP-SAT，選用） ==================
+def solve_with_cp_sat(year, month, state, demand, id_list, role_map, wcap_map,
+                      allow_cross=True, time_limit=10.0,
+                      min_stretch=3, max_work_streak=5, max_off_streak=2,
+                      min_off=8, min_work_days=0, max_work_days=31, balance=True,
+                      seed=0, free_nurses=None, free_days=None, num_workers=None):
+    """
+    以 OR-Tools CP-SAT 重解整月班表，並以目前班表（state）作為起始解提示。
+    硬性：一天最多一班、必休、11 小時休息、不連七（規則排班結果本來就滿足，提示必為可行解）；
+    其餘規則皆為軟性，目標函數與 schedule_violations 的加權分數一致
+    （班次不足另加每缺／超 0.01 單位 1 分的細部成本）。
+    free_nurses / free_days 給定時只重解該視窗內的格子（大鄰域搜尋用），其餘格子固定為目前班別，
+    只建立與視窗有關的限制；不碰到視窗的項目為常數，不影響比較。
+    在 time_limit 秒內回傳找到的最佳班表矩陣（grid 編碼）與求解資訊；
+    未安裝 ortools 或時限內無可行解時 grid 為 None。
+    """
+    try:
+        from ortools.sat.python import cp_model
+    except ImportError:
+        return None, {"狀態": "未安裝 ortools"}
+
+    nd = state.nd
+    sched = state.sched
+    cat = state.cat
+    unit = 100                                              # 能力單位以 0.01 為整數
+    w = {k: v * unit for k, v in VIOLATION_WEIGHTS.items()}  # 件數成本（與細部成本同尺度）
+    m = cp_model.CpModel()
+    penalties = []
+
+    def flag(name):
+        v = m.NewBoolVar("")
+        penalties.append((w[name], v))
+        return v
+
+    def is_free(nid, d):
+        return ((free_nurses is None or nid in free_nurses)
+                and (free_days is None or d in free_days))
+
+    def soft_at_most(terms, name):
+        """terms 全部成立時記一件違規；全為常數（不在視窗內）則略過"""
+        e = sum(terms) - (len(terms) - 1)
+        if not isinstance(e, int):
+            m.Add(e <= flag(name))
+
+    # x[nid, d, s]：視窗內可排的班別（固定班；允許跨班時非新人也可排其他班），必休日不建變數
+    x = {}
+    for nid in id_list:
+        shifts = [role_map[nid]]
+        if allow_cross and not state.junior_map.get(nid, False):
+            shifts = list(cat.order)
+        for d in range(1, nd+1):
+            if state.is_must(nid, d) or not is_free(nid, d):
+                continue
+            for s in shifts:
+                x[nid, d, s] = m.NewBoolVar("")
+
+    # 視窗外的格子以常數代入（上班 1／休 0）
+    work = {}
+    for nid in id_list:
+        for d in range(1, nd+1):
+            if not is_free(nid, d):
+                work[nid, d] = int(sched[nid][d] in cat.order)
+                continue
+            vs = [x[nid, d, s] for s in cat.order if (nid, d, s) in x]
+            if vs:
+                m.AddAtMostOne(vs)
+            work[nid, d] = sum(vs)
+
+    # 每日每班：能力單位、白班資深比例
+    for d in range(1, nd+1):
+        for s in cat.order:
+            members = [(nid, x[nid, d, s]) for nid in id_list if (nid, d, s) in x]
+            if not members:
+                continue
+            fixed = [nid for nid in state.members(d, s) if not is_free(nid, d)]
+            mn, mx = demand.get(d,{}).get(s,(0,0))
+            coefs = [int(round(state.units_of(nid, s) * unit)) for nid, _v in members]
+            base = sum(int(round(state.units_of(nid, s) * unit)) for nid in fixed)
+            units = base + sum(c * v for c, (_nid, v) in zip(coefs, members))
+            short = m.NewIntVar(0, int(mn * unit), "")
+            over = m.NewIntVar(0, base + sum(coefs), "")
+            m.Add(units + short >= int(mn * unit))
+            m.Add(units - over <= int(mx * unit))
+            m.Add(short <= int(mn * unit) * flag("班次不足"))
+            penalties += [(1, short), (1, over)]
+            if s in cat.white:
+                size = len(members) + len(fixed)
+                total = len(fixed) + sum(v for _nid, v in members)
+                sen = (sum(1 for nid in fixed if state.senior_map.get(nid, False))
+                       + sum(v for nid, v in members if state.senior_map.get(nid, False)))
+                m.Add(3 * sen + 3 * size * flag("白班資深不足") >= total)
+
+    # 11 小時休息（前一日 → 當日）；一端固定時直接禁掉另一端的衝突班別
+    bad_pairs = [(a, b) for a in cat.order for b in cat.order if not cat.rest_ok(a, b)]
+    for nid in id_list:
+        for d in range(1, nd):
+            for a, b in bad_pairs:
+                va, vb = x.get((nid, d, a)), x.get((nid, d+1, b))
+                if va is not None and vb is not None:
+                    m.AddBoolOr([va.Not(), vb.Not()])
+                elif va is not None and not is_free(nid, d+1) and sched[nid][d+1] == b:
+                    m.Add(va == 0)
+                elif vb is not None and not is_free(nid, d) and sched[nid][d] == a:
+                    m.Add(vb == 0)
+
+    def segment_starts(terms_at, length):
+        """terms_at(d) 連續 length 天成立、且前一天不成立（月初視為不成立）的段數旗標條件"""
+        for d0 in range(1, nd - length + 2):
+            terms = [terms_at(d) for d in range(d0, d0 + length)]
+            if d0 > 1:
+                terms.append(1 - terms_at(d0 - 1))
+            yield terms
+
+    weeks = [[d for d in range(7*(k-1)+1, (7*k if k < 5 else nd)+1) if d <= nd] for k in [1,2,3,4,5]]
+    weeks = [wk for wk in weeks if wk]
+    offs = []
+    for nid in id_list:
+        wd = [work[nid, d] for d in range(1, nd+1)]
+        total = sum(wd)
+        if isinstance(total, int):
+            # 整月都不在視窗內：只以常數參與月休差距
+            offs.append(nd - total)
+            continue
+        for d0 in range(nd - 6):
+            seven = sum(wd[d0:d0+7])
+            if not isinstance(seven, int):
+                m.Add(seven <= 6)
+        # 連班過長／連休過長：以段的起點計數
+        for terms in segment_starts(lambda d: work[nid, d], max_work_streak + 1):
+            soft_at_most(terms, "連班過長")
+        for terms in segment_starts(lambda d: 1 - work[nid, d], max_off_streak + 1):
+            soft_at_most(terms, "連休過長")
+        # 短上班段：前一天休（或月初）、上班 L 天、後一天休（或月底）
+        for length in range(1, min_stretch):
+            for d0 in range(1, nd - length + 2):
+                terms = [work[nid, d] for d in range(d0, d0 + length)]
+                if d0 > 1:
+                    terms.append(1 - work[nid, d0-1])
+                if d0 + length <= nd:
+                    terms.append(1 - work[nid, d0+length])
+                soft_at_most(terms, "短上班段")
+        # 每週：至少一休、上限天數
+        cap = wcap_map.get(nid)
+        for wk in weeks:
+            wsum = sum(wd[d-1] for d in wk)
+            if isinstance(wsum, int):
+                continue
+            m.Add(wsum <= len(wk) - 1 + flag("週未休"))
+            if cap is not None and cap < len(wk):
+                m.Add(wsum <= cap + len(wk) * flag("超過每週上限"))
+        # 月休／上班天數
+        m.Add(nd - total + nd * flag("月休不足") >= min_off)
+        m.Add(total + nd * flag("上班天數超出") >= min_work_days)
+        m.Add(total - nd * flag("上班天數超出") <= max_work_days)
+        off = m.NewIntVar(0, nd, "")
+        m.Add(off == nd - total)
+        offs.append(off)
+
+    if balance and offs:
+        off_max = m.NewIntVar(0, nd, "")
+        off_min = m.NewIntVar(0, nd, "")
+        m.AddMaxEquality(off_max, offs)
+        m.AddMinEquality(off_min, offs)
+        spread = m.NewIntVar(0, nd, "")
+        m.Add(spread >= off_max - off_min - 1)
+        penalties.append((w["月休差距"], spread))
+
+    m.Minimize(sum(coef * v for coef, v in penalties))
+
+    # 以目前班表為起始解
+    for (nid, d, s), v in x.items():
+        m.AddHint(v, sched[nid][d] == s)
+
+    solver = cp_model.CpSolver()
+    solver.parameters.max_time_in_seconds = float(time_limit)
+    # 至少 8 個 worker 才會啟用 CP-SAT 內建的 LNS 等完整搜尋組合；視窗子問題由呼叫端指定
+    if num_workers is None:
+        num_workers = max(8, os.cpu_count() or 1)
+    solver.parameters.num_workers = int(num_workers)
+    solver.parameters.random_seed = int(seed)
+    status = solver.Solve(m)
+    info = {
+        "狀態": solver.StatusName(status),
+        "目標值": None,
+        "下界": None,
+        "秒數": round(solver.WallTime(), 2),
+    }
+    if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+        return None, info
+    info["目標值"] = round(solver.ObjectiveValue() / unit, 2)
+    info["下界"] = round(solver.BestObjectiveBound() / unit, 2)
+
+    grid = state.snapshot()
+    for nid in id_list:
+        for d in range(1, nd+1):
+            if is_free(nid, d) and not state.is_must(nid, d):
+                grid[state.index[nid], d-1] = cat.off_idx
+    for (nid, d, s), v in x.items():
+        if solver.Value(v):
+            grid[state.index[nid], d-1] = cat.code_index[s]
+    return grid, info
+
+# ================== 大鄰域搜尋（LNS，選用） ==================
+# 每次只放開一個視窗（某週 × 一組人，或某固定班的一組人 × 全月）交給 CP-SAT 重解，
+# 其餘格子固定；同一批的視窗互不重疊，可在不同行程平行求解。
+LNS_MAX_WINDOW_NURSES = 60   # 每個視窗最多放開的人數（控制每步的求解規模）
+
+def lns_windows(id_list, role_map, nd, seed=0):
+    """
+    切出視窗批次（同批互不重疊）：
+      - 第 1/3/5 週一批、第 2/4 週一批：每週再把全部人員洗牌後切成數組，可跨班調動
+      - 固定班一批：同班別的人切成數組、全月放開、不跨班（各組互不影響需求格）
+    回傳 [[(名稱, free_nurses, free_days, allow_cross), ...], ...]
+    """
+    rng = random.Random(seed)
+    size = LNS_MAX_WINDOW_NURSES
+
+    def chunks(ids):
+        ids = list(ids)
+        rng.shuffle(ids)
+        n = max(1, ceil(len(ids) / size))
+        return [set(ids[i::n]) for i in range(n)]
+
+    week_days = {}
+    for d in range(1, nd+1):
+        week_days.setdefault(week_index(d), set()).add(d)
+
+    batches = []
+    for ks in ([1, 3, 5], [2, 4]):
+        batch = []
+        for k in ks:
+            if k not in week_days:
+                continue
+            for j, nurses in enumerate(chunks(id_list)):
+                batch.append((f"第{k}週-{j+1}", nurses, week_days[k], True))
+        batches.append(batch)
+
+    batch = []
+    for s in sorted(set(role_map[nid] for nid in id_list)):
+        for j, nurses in enumerate(chunks(nid for nid in id_list if role_map[nid] == s)):
+            batch.append((f"{s}班-{j+1}", nurses, None, False))
+    batches.append(batch)
+    return [b for b in batches if b]
+
+_LNS_BASE = None
+
+def _lns_init(state, demand, id_list, role_map, wcap_map):
+    """行程池初始化：每個工作行程只收一次完整狀態，之後每個視窗只傳班表矩陣"""
+    global _LNS_BASE
+    _LNS_BASE = (state, demand, id_list, role_map, wcap_map)
+
+def _lns_window_job(args):
+    grid, kwargs = args
+    state, demand, id_list, role_map, wcap_map = _LNS_BASE
+    state.restore(grid)
+    return solve_with_cp_sat(0, 0, state, demand, id_list, role_map, wcap_map, **kwargs)
+
+def improve_by_lns(year, month, state, demand, id_list, role_map, wcap_map, score_fn,
+                   allow_cross=True, time_limit=30.0, window_time=2.0, rounds=3,
+                   max_workers=None, seed=0, **rule_kwargs):
+    """
+    大鄰域搜尋：依 lns_windows 的批次輪流重解視窗，同批視窗以行程池平行求解；
+    每個視窗的結果依序套回目前班表，整體違規加權分數（score_fn）變好才採用，否則還原。
+    每個視窗求解不超過 window_time 秒，整體不超過 time_limit 秒；
+    一整輪都沒有視窗被採用就提早結束。rule_kwargs 直接轉給 solve_with_cp_sat。
+    """
+    if importlib.util.find_spec("ortools") is None:
+        return {"狀態": "未安裝 ortools"}
+
+    t0 = time.perf_counter()
+    deadline = t0 + float(time_limit)
+    cat = state.cat
+    start = best = violation_score(score_fn(state))
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    tried = accepted = 0
+    rounds_done = 0
+
+    pool = None
+    if max_workers > 1:
+        pool = ProcessPoolExecutor(max_workers=max_workers, initializer=_lns_init,
+                                   initargs=(state, demand, id_list, role_map, wcap_map))
+    try:
+        for r in range(int(rounds)):
+            improved = False
+            for batch in lns_windows(id_list, role_map, state.nd, seed=seed + r):
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0.05 or state.out_of_time():
+                    break
+                # 只送出剩餘時間內跑得完的視窗，整體時限不會被一整批拖長
+                batch = batch[:max(1, int(remaining // window_time)) * max(1, max_workers)]
+                # 同批視窗平行時平均分配核心數給各個 CP-SAT
+                threads = max(1, (os.cpu_count() or 1) // max(1, min(max_workers, len(batch))))
+                jobs = [(state.snapshot(), dict(rule_kwargs,
+                                                allow_cross=allow_cross and cross,
+                                                time_limit=min(window_time, remaining),
+                                                seed=seed + r,
+                                                free_nurses=nurses,
+                                                free_days=days,
+                                                num_workers=threads))
+                        for _name, nurses, days, cross in batch]
+                if pool is None:
+                    results = (solve_with_cp_sat(year, month, state, demand, id_list, role_map,
+                                                 wcap_map, **kwargs)
+                               for _grid, kwargs in jobs)
+                else:
+                    results = pool.map(_lns_window_job, jobs)
+
+                for (_name, nurses, days, _cross), (grid, _info) in zip(batch, results):
+                    tried += 1
+                    if grid is None:
+                        continue
+                    fallback = state.snapshot()
+                    for nid in nurses:
+                        i = state.index[nid]
+                        for d in (days if days is not None else range(1, state.nd+1)):
+                            if grid[i, d-1] != state.grid[i, d-1]:
+                                state.assign(nid, d, cat.codes[grid[i, d-1]])
+                    value = violation_score(score_fn(state))
+                    if value < best:
+                        best = value
+                        accepted += 1
+                        improved = True
+                    else:
+                        state.restore(fallback)
+            rounds_done += 1
+            if not improved or time.perf_counter() >= deadline or state.out_of_time():
+                break
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return {
+        "起始分數": start,
+        "最終分數": best,
+        "輪數": rounds_done,
+        "視窗數": tried,
+        "採用視窗": accepted,
+        "秒數": round(time.perf_counter() - t0, 2),
+    }
+
+# ================== 整體排班流程 ==================
+# 排班參數預設值（欄位說明見 params.ScheduleSettings）；shift_catalogue 為 None 時用預設 D/E/N
+DEFAULT_SETTINGS = ScheduleSettings().as_dict()
+
+def holiday_dates(hol_df, year, month):
+    """假日清單 → 本月假日的 date 集合（同樣的日期字串與年月只解析一次）"""
+    raws = tuple(hol_df["date"].tolist()) if "date" in hol_df.columns else ()
+    return set(_holiday_dates(raws, int(year), int(month)))
+
+@lru_cache(maxsize=64)
+def _holiday_dates(raws, year, month):
+    out = set()
+    for raw in raws:
+        if pd.isna(raw) or str(raw).strip()=="":
+            continue
+        dt = pd.to_datetime(raw, errors="coerce")
+        if pd.isna(dt):
+            continue
+        if int(dt.year)==year and int(dt.month)==month:
+            out.add(date(int(dt.year), int(dt.month), int(dt.day)))
+    return frozenset(out)
+
+def roster_frame(state, id_list, role_map):
+    """班表狀態 → 班表 DataFrame（id、shift、senior、junior、各日代碼）"""
+    base_cols = {
+        "id": id_list,
+        "shift": [role_map[nid] for nid in id_list],
+        "senior": state.senior_arr,
+        "junior": state.junior_arr,
+    }
+    day_cols = [str(d) for d in range(1, state.nd+1)]
+    return pd.concat(
+        [pd.DataFrame(base_cols),
+         pd.DataFrame(state.roster_matrix(), columns=day_cols)],
+        axis=1
+    ).sort_values(["shift","senior","junior","id"]).reset_index(drop=True)
+
+def schedule_month(year, month, users_df, prefs_df, hol_df, df_demand,
+                   settings=None, seed=0, progress=None, cancel=None, checkpoints=None):
+    """
+    完整排班一次：初排 → 規則管線 → 局部搜尋 → 產出 班表 / 統計 / 達標 / 報告。
+    只吃傳入的資料表與設定（不讀檔、不碰畫面），可在其他行程中執行。
+    settings 可為 dict（缺的欄位用 DEFAULT_SETTINGS）或 ScheduleSettings。
+    seed = 0 為原本的確定性結果；其他值會隨機打破選人同分並決定局部搜尋的亂數。
+    settings["deadline_ms"] 給定時各步驟自行檢查時限、逾時提早結束，回傳目前最佳的完整班表，
+    報告的「逾時中止」標示是否被截斷，「剩餘違規」為各規則剩下的件數。
+    progress(進度 0–1, 說明, 班表 DataFrame 或 None)：每個步驟（初排、每條規則、局部搜尋…）後呼叫，
+    步驟結束時附上當下的班表。cancel（有 is_set() 的物件）被設定時與逾時一樣提早結束，
+    報告的「已取消」為 True。
+    checkpoints（PassCheckpoints）給定時，從最後一個輸入與參數都沒變的步驟接著排
+    （例如只改「每月最多上班天數」就只重跑最後一條規則與其後步驟），報告的「沿用檢查點」為該步驟。
+    """
+    t_start = time.perf_counter()
+    if isinstance(settings, ScheduleSettings):
+        settings = settings.as_dict()
+    cfg = {**DEFAULT_SETTINGS, **(settings or {})}
+    allow_cross = cfg["allow_cross"]
+    prefer_off_holiday = cfg["prefer_off_holiday"]
+    min_monthly_off = cfg["min_monthly_off"]
+    balance_monthly_off = cfg["balance_monthly_off"]
+    min_work_stretch = cfg["min_work_stretch"]
+    min_work_days = cfg["min_work_days"]
+    max_work_days = cfg["max_work_days"]
+    local_search_iters = cfg["local_search_iters"]
+
+    cat = ShiftCatalogue(cfg["shift_catalogue"] or SHIFT_CATALOGUE,
+                         cfg["d_avg"], cfg["e_avg"], cfg["n_avg"])
+
+    ndays = days_in_month(year, month)
+    holiday_set_local = holiday_dates(hol_df, year, month)
+
+    # ---- 各調整規則（依序）；nurses / days 為上次執行後被改過的人 / 日 ----
+    def rule_cross_shift(nurses, days):
+        cross_shift_balance_with_units(
+            year, month, id_list, state,
+            demand_map, role_map, senior_map, junior_map,
+            days=days
+        )
+
+    def rule_holiday_off(nurses, days):
+        prefer_off_on_holidays(
+            year, month, state, df_demand, id_list,
+            role_map, senior_map, junior_map, holiday_set_local,
+            days=days
+        )
+
+    def rule_weekly_off(nurses, days):
+        enforce_weekly_one_off(
+            year, month, state, df_demand, nurses,
+            role_map, senior_map, junior_map, holiday_set_local
+        )
+
+    def rule_monthly_off(nurses, days):
+        # 平衡 O 需看全體，固定整體重算
+        enforce_min_monthly_off(
+            year, month, state, df_demand, id_list,
+            role_map, senior_map, junior_map,
+            min_off=min_monthly_off,
+            balance=balance_monthly_off,
+            holiday_set=holiday_set_local,
+            target_off=TARGET_OFF_DAYS
+        )
+
+    # 不再使用「1–15 休 5 天、16–月底休 3 天」的半月基底規則
+
+    def rule_min_stretch(nurses, days):
+        enforce_min_work_stretch(
+            year, month, state, df_demand, nurses,
+            role_map, senior_map, junior_map,
+            min_stretch=min_work_stretch,
+            holiday_set=holiday_set_local,
+            must_map=must_map
+        )
+
+    def rule_streak_prefs(nurses, days):
+        enforce_streak_preferences(
+            year, month, state, df_demand, nurses,
+            role_map, senior_map, junior_map,
+            max_work_streak=MAX_WORK_STREAK,
+            max_off_streak=MAX_OFF_STREAK,
+            min_monthly_off=min_monthly_off,
+            min_before=MIN_OFF_BEFORE_15,
+            min_after=MIN_OFF_AFTER_15,
+            target_off=TARGET_OFF_DAYS,
+            holiday_set=holiday_set_local,
+            must_map=must_map
+        )
+
+    def rule_break_long(nurses, days):
+        hard_break_long_work_streaks(
+            year, month, state, df_demand, nurses,
+            role_map, senior_map, junior_map,
+            max_work_streak=MAX_WORK_STREAK,
+            min_monthly_off=min_monthly_off,
+            must_map=must_map
+        )
+
+    def rule_smooth(nurses, days):
+        smooth_short_work_segments(
+            year, month, state, df_demand, nurses,
+            role_map, senior_map, junior_map,
+            min_stretch=min_work_stretch,
+            min_monthly_off=min_monthly_off,
+            min_before=MIN_OFF_BEFORE_15,
+            min_after=MIN_OFF_AFTER_15,
+            holiday_set=holiday_set_local,
+            must_map=must_map
+        )
+
+    # 🧱 先確保絕對不會連七
+    def rule_no_seven(nurses, days):
+        ensure_no_seven_consecutive_work(
+            year, month, state, nurses, must_map
+        )
+
+    # ✅ 再依「本月上班最少 / 最多天數」做最後微調（不打破連班限制）
+    def rule_workday_limits(nurses, days):
+        enforce_workday_limits(
+            year, month, state, df_demand, nurses,
+            role_map, senior_map, junior_map,
+            min_work_days=min_work_days,
+            max_work_days=max_work_days,
+            min_monthly_off=min_monthly_off,
+            max_work_streak=MAX_WORK_STREAK,
+            holiday_set=holiday_set_local,
+            must_map=must_map
+        )
+
+    rules = []
+    if allow_cross:
+        rules.append(("跨班補缺", rule_cross_shift, "班次不足"))
+    if prefer_off_holiday:
+        rules.append(("假日優先休", rule_holiday_off, None))
+    rules += [
+        ("每週至少一休", rule_weekly_off, "週未休"),
+        ("月休下限與平衡", rule_monthly_off, "月休不足"),
+        ("最小連續上班", rule_min_stretch, "短上班段"),
+        ("連班／連休偏好", rule_streak_prefs, "連休過長"),
+        ("拆長連班", rule_break_long, "連班過長"),
+        ("補短上班段", rule_smooth, "短上班段"),
+        ("不連七", rule_no_seven, "連七"),
+        ("月上班天數上下限", rule_workday_limits, "上班天數超出"),
+    ]
+
+    # 各規則除了前面步驟的結果外還用到的參數（逐步檢查點的鍵）
+    holidays_key = sorted(d.isoformat() for d in holiday_set_local)
+    rule_params = {
+        "跨班補缺": (),
+        "假日優先休": (holidays_key,),
+        "每週至少一休": (holidays_key,),
+        "月休下限與平衡": (min_monthly_off, balance_monthly_off, holidays_key),
+        "最小連續上班": (min_work_stretch, holidays_key),
+        "連班／連休偏好": (min_monthly_off, holidays_key),
+        "拆長連班": (min_monthly_off,),
+        "補短上班段": (min_work_stretch, min_monthly_off, holidays_key),
+        "不連七": (),
+        "月上班天數上下限": (min_work_days, max_work_days, min_monthly_off, holidays_key),
+    }
+
+    # ---- 逐步檢查點：找最後一個輸入與參數都對得上的步驟 ----
+    # 步驟 0 = 初排（人員、偏好、需求、班別、種子、初排方式）；步驟 i = 第一輪第 i 條規則之後
+    # 樣式初排的班表是管線的比較基準（keep_initial）：存下的進度含以當時計分參數算的基準分數，
+    # 所以步驟 0 的鍵要涵蓋初排與 score 用到的全部參數（需求與每週上限已在資料表摘要裡）
+    pattern_params = ((min_work_stretch, min_monthly_off, min_work_days, max_work_days,
+                       balance_monthly_off, MAX_WORK_STREAK, MAX_OFF_STREAK)
+                      if cfg["initial_assign"] == "pattern" else None)
+    resume = None
+    if checkpoints is not None:
+        step_keys = [_chain_key(
+            ENGINE_VERSION, "初排", year, month, seed, cfg["initial_assign"], pattern_params,
+            frame_digest(users_df), frame_digest(prefs_df), frame_digest(df_demand),
+            cfg["shift_catalogue"], cfg["d_avg"], cfg["e_avg"], cfg["n_avg"]
+        )]
+        for name, _fn, _key in rules:
+            step_keys.append(_chain_key(step_keys[-1], name, rule_params[name]))
+        resume = checkpoints.latest(step_keys)
+
+    if resume is not None:
+        resumed_step, (maps, state, pipeline_resume) = resume
+        (demand_map, role_map, id_list, senior_map, junior_map,
+         wcap_map, must_map, wish_map) = maps
+        state.timed_out = state.cancelled = False
+        state.deadline = None
+    else:
+        resumed_step, pipeline_resume = None, None
+        # 時限從排班開始就算，初排（flow／樣式）也要守；逾時則改用 greedy 初排
+        deadline = t_start + cfg["deadline_ms"] / 1000.0 if cfg["deadline_ms"] else None
+        if cfg["initial_assign"] == "pattern":
+            initial = build_pattern_schedule(
+                year, month, users_df, prefs_df, df_demand, cat, seed=seed,
+                min_stretch=min_work_stretch,
+                min_off=min_monthly_off,
+                min_work_days=min_work_days,
+                max_work_days=max_work_days,
+                deadline=deadline
+            )
+        else:
+            initial = build_initial_schedule(
+                year, month, users_df, prefs_df,
+                df_demand, cat, seed=seed,
+                assign_mode=cfg["initial_assign"],
+                deadline=deadline
+            )
+        (sched, demand_map, role_map, id_list,
+         senior_map, junior_map, wcap_map,
+         must_map, wish_map) = initial
+        maps = (demand_map, role_map, id_list, senior_map, junior_map,
+                wcap_map, must_map, wish_map)
+        state = ScheduleState(sched, id_list, role_map, senior_map, junior_map,
+                              cat, ndays, must_map=must_map, wish_map=wish_map)
+    if cfg["deadline_ms"]:
+        state.deadline = t_start + cfg["deadline_ms"] / 1000.0
+    state.cancel = cancel
+
+    def save_checkpoint(step, pipeline_progress):
+        # 被時限或取消截斷的步驟不存
+        if checkpoints is not None and not state.out_of_time():
+            checkpoints.put(step_keys[step], (maps, state, pipeline_progress))
+
+    if resume is None:
+        save_checkpoint(0, None)
+
+    # ---- 進度：各步驟平分進度條 ----
+    phases = ["初排", "規則管線"]
+    if local_search_iters > 0:
+        phases.append("局部搜尋")
+    if cfg["engine"] == "cp-sat":
+        phases.append("精確解")
+    elif cfg["engine"] == "lns":
+        phases.append("大鄰域搜尋")
+
+    def report_progress(phase, within=1.0, label=None, with_roster=True):
+        if progress is None:
+            return
+        k = phases.index(phase)
+        progress((k + within) / len(phases), label or phase,
+                 roster_frame(state, id_list, role_map) if with_roster else None)
+
+    report_progress("初排")
+
+    def score(cur):
+        return schedule_violations(
+            cur, demand_map,
+            min_stretch=min_work_stretch,
+            max_work_streak=MAX_WORK_STREAK,
+            max_off_streak=MAX_OFF_STREAK,
+            min_off=min_monthly_off,
+            min_work_days=min_work_days,
+            max_work_days=max_work_days,
+            balance=balance_monthly_off,
+            wcap_map=wcap_map
+        )
+
+    def on_rule(rnd, i, name):
+        # 輪數未知：每輪補上剩餘進度的一半
+        report_progress("規則管線", 1 - 0.5 ** (rnd - 1 + (i + 1) / len(rules)),
+                        f"規則管線 第 {rnd} 輪：{name}", with_roster=False)
+
+    convergence, _violations = run_rule_pipeline(
+        state, rules, score, keep_initial=cfg["initial_assign"] == "pattern",
+        on_rule=on_rule if progress is not None else None,
+        resume=pipeline_resume,
+        on_checkpoint=(lambda i, prog: save_checkpoint(i + 1, prog)) if checkpoints is not None else None
+    )
+    report_progress("規則管線")
+
+    # ---- 規則排完後以局部搜尋微調 ----
+    search_stats = {}
+    if local_search_iters > 0 and not state.out_of_time():
+        search_stats = improve_by_local_search(
+            year, month, state, demand_map, id_list, role_map, holiday_set_local,
+            iterations=int(local_search_iters),
+            seed=seed,
+            time_limit=state.time_left(),
+            wcap_map=wcap_map,
+            min_stretch=min_work_stretch,
+            max_work_streak=MAX_WORK_STREAK,
+            max_off_streak=MAX_OFF_STREAK,
+            min_off=min_monthly_off,
+            target_off=TARGET_OFF_DAYS,
+            min_work_days=min_work_days,
+            max_work_days=max_work_days
+        )
+        report_progress("局部搜尋")
+
+    # ---- 精確解後端：以上面結果為起始解，時限內找到更好的才採用 ----
+    solver_info = {}
+    if cfg["engine"] == "cp-sat" and not state.out_of_time():
+        before = score(state)
+        grid, solver_info = solve_with_cp_sat(
+            year, month, state, demand_map, id_list, role_map, wcap_map,
+            allow_cross=allow_cross,
+            time_limit=state.time_left(cfg["solver_time_limit"]),
+            min_stretch=min_work_stretch,
+            max_work_streak=MAX_WORK_STREAK,
+            max_off_streak=MAX_OFF_STREAK,
+            min_off=min_monthly_off,
+            min_work_days=min_work_days,
+            max_work_days=max_work_days,
+            balance=balance_monthly_off,
+            seed=seed
+        )
+        solver_info["採用"] = False
+        if grid is not None:
+            fallback = state.snapshot()
+            state.restore(grid)
+            if violation_score(score(state)) < violation_score(before):
+                solver_info["採用"] = True
+            else:
+                state.restore(fallback)
+        report_progress("精確解")
+
+    # ---- 大鄰域搜尋：逐週／逐班別視窗重解，適合整月精確解解不動的大單位 ----
+    lns_stats = {}
+    if cfg["engine"] == "lns" and not state.out_of_time():
+        lns_stats = improve_by_lns(
+            year, month, state, demand_map, id_list, role_map, wcap_map, score,
+            allow_cross=allow_cross,
+            time_limit=state.time_left(cfg["solver_time_limit"]),
+            window_time=cfg["lns_window_time"],
+            max_workers=cfg["lns_workers"],
+            seed=seed,
+            min_stretch=min_work_stretch,
+            max_work_streak=MAX_WORK_STREAK,
+            max_off_streak=MAX_OFF_STREAK,
+            min_off=min_monthly_off,
+            min_work_days=min_work_days,
+            max_work_days=max_work_days,
+            balance=balance_monthly_off
+        )
+        report_progress("大鄰域搜尋")
+
+    # 逾時中止時規則可能沒跑完：不連七一定要補上（只看連班段，很快）
+    if state.out_of_time():
+        ensure_no_seven_consecutive_work(year, month, state, id_list, must_map)
+
+    violations = score(state)
+    initial_assign = cfg["initial_assign"]
+    if initial_assign == "flow" and _load_min_cost_flow() is None:
+        initial_assign = "greedy（未安裝 ortools）"
+    report = {
+        "種子": seed,
+        "初始分配": initial_assign,
+        "分數": violation_score(violations),
+        "規則收斂": pd.DataFrame(convergence),
+        "局部搜尋": search_stats,
+        "精確解": solver_info,
+        "大鄰域搜尋": lns_stats,
+        "剩餘違規": violations,
+        "逾時中止": state.timed_out,
+        "已取消": state.cancelled,
+        "沿用檢查點": (None if resumed_step is None else
+                   "初排" if resumed_step == 0 else rules[resumed_step - 1][0]),
+        "秒數": round(time.perf_counter() - t_start, 2),
+    }
+
+    # ---- 以班表矩陣向量化產出 班表 / 統計 / 達標 ----
+    roster_df = roster_frame(state, id_list, role_map)
+    base_cols = {
+        "id": id_list,
+        "shift": [role_map[nid] for nid in id_list],
+        "senior": state.senior_arr,
+        "junior": state.junior_arr,
+    }
+
+    hday_mask = np.array([
+        is_sunday(year, month, d) or (date(year,month,d) in holiday_set_local)
+        for d in range(1, ndays+1)
+    ], dtype=bool)
+
+    counts = state.code_counts
+    summary_df = pd.DataFrame({
+        **base_cols,
+        **{f"{c}天數": counts[:, cat.code_index[c]] for c in [*cat.order, OFF]},
+        "本月例假日放假數": state.day_mask_count(OFF, hday_mask),
+    }).sort_values(
+        ["shift","senior","junior","id"]
+    ).reset_index(drop=True)
+
+    act = state.units_by_day().ravel()
+    bounds = np.array([demand_map.get(d,{}).get(s,(0,0))
+                       for d in range(1, ndays+1) for s in cat.order]).reshape(-1, 2)
+    mn, mx = bounds[:, 0], bounds[:, 1]
+    status = np.select(
+        [act + 1e-9 < mn, act <= mx + 1e-9],
+        ["🔴 不足", "🟢 達標"],
+        default="🟡 超編"
+    )
+    compliance_df = pd.DataFrame({
+        "day": np.repeat(np.arange(1, ndays+1), len(cat.order)),
+        "shift": cat.order * ndays,
+        "min_units": mn,
+        "max_units": mx,
+        "actual_units": np.round(act, 2),
+        "狀態": status,
+    })
+
+    return roster_df, summary_df, compliance_df, report
+
+def _schedule_month_args(args):
+    return schedule_month(*args)
+
+def _best_of_watched(jobs, max_workers, progress, cancel):
+    """平行跑多個種子，邊等邊回報進度、轉送取消旗標；結果依 jobs 順序"""
+    manager = remote = None
+    if cancel is not None:
+        manager = multiprocessing.Manager()
+        remote = manager.Event()
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(_schedule_month_args, job + (None, remote)): k
+                       for k, job in enumerate(jobs)}
+            done_results = {}
+            best = None
+            pending = set(futures)
+            while pending:
+                done, pending = wait(pending, timeout=CANCEL_POLL_SECONDS * 2)
+                for fut in done:
+                    res = fut.result()
+                    done_results[futures[fut]] = res
+                    if best is None or (res[3]["分數"], res[3]["種子"]) < (best[3]["分數"], best[3]["種子"]):
+                        best = res
+                    if progress is not None:
+                        progress(len(done_results) / len(jobs),
+                                 f"種子 {res[3]['種子']} 完成（{len(done_results)}/{len(jobs)}）",
+                                 best[0])
+                if remote is not None and cancel.is_set() and not remote.is_set():
+                    remote.set()
+    finally:
+        if manager is not None:
+            manager.shutdown()
+    return [done_results[k] for k in sorted(done_results)]
+
+def schedule_best_of(year, month, users_df, prefs_df, hol_df, df_demand,
+                     settings=None, seeds=(0,), max_workers=None, progress=None, cancel=None):
+    """
+    多起點：每個種子各跑一次完整排班（行程池平行），依違規加權分數取最好的一份
+    （同分取種子小者）。回傳與 schedule_month 相同，報告另附各種子的分數表。
+    progress / cancel 同 schedule_month：依序執行時轉給每次排班；平行時每完成一個種子回報一次
+    （附目前最佳班表），取消旗標經 multiprocessing.Manager 轉給各行程。
+    """
+    seeds = list(seeds)
+    if isinstance(settings, ScheduleSettings):
+        settings = settings.as_dict()
+    if max_workers is None:
+        max_workers = min(len(seeds), os.cpu_count() or 1)
+    # 有時限時依「要跑幾波」平分給每次排班
+    if settings and settings.get("deadline_ms"):
+        waves = ceil(len(seeds) / max(1, max_workers))
+        settings = {**settings, "deadline_ms": settings["deadline_ms"] / waves}
+    jobs = [(year, month, users_df, prefs_df, hol_df, df_demand, settings, seed)
+            for seed in seeds]
+    if max_workers <= 1 or len(jobs) == 1:
+        results = []
+        for k, job in enumerate(jobs):
+            if results and cancel is not None and cancel.is_set():
+                break
+            sub = None if progress is None else (
+                lambda frac, label, roster, k=k:
+                    progress((k + frac) / len(jobs), f"種子 {seeds[k]}：{label}", roster))
+            results.append(schedule_month(*job, progress=sub, cancel=cancel))
+    elif progress is None and cancel is None:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(_schedule_month_args, jobs))
+    else:
+        results = _best_of_watched(jobs, max_workers, progress, cancel)
+
+    best = min(results, key=lambda r: (r[3]["分數"], r[3]["種子"]))
+    best[3]["多起點"] = pd.DataFrame(
+        [{"種子": r[3]["種子"], "分數": r[3]["分數"]} for r in results]
+    )
+    return best
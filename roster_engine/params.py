@@ -0,0 +1,83 @@
+"""
+排班參數物件：不依賴 pandas / numpy，CLI 解析參數與畫面組設定時不必載入引擎。
+"""
+from dataclasses import dataclass, asdict, field
+from math import ceil
+
+# ScheduleSettings 裡由需求參數與班別目錄推得、不由使用者直接指定的欄位
+DERIVED_SETTINGS = ("d_avg", "e_avg", "n_avg", "shift_catalogue")
+# 只能從固定選項擇一的設定欄位（命令列 choices、服務檢查請求）
+SETTING_CHOICES = {
+    "initial_assign": ("greedy", "flow", "pattern"),
+    "engine": ("greedy", "cp-sat", "lns"),
+}
+# 資料目錄的儲存後端（見 data.open_store）
+STORE_BACKENDS = ("auto", "csv", "sqlite")
+
+
+@dataclass
+class DemandParams:
+    """床數與護病比區間 → 每日各班需求（能力單位）；平均護病比決定新人能力單位"""
+    total_beds: int = 120
+    d_ratio_min: float = 6
+    d_ratio_max: float = 7
+    e_ratio_min: float = 10
+    e_ratio_max: float = 12
+    n_ratio_min: float = 15
+    n_ratio_max: float = 16
+
+    @property
+    def ratios(self):
+        return {
+            "D": (self.d_ratio_min, self.d_ratio_max),
+            "E": (self.e_ratio_min, self.e_ratio_max),
+            "N": (self.n_ratio_min, self.n_ratio_max),
+        }
+
+    @property
+    def d_avg(self):
+        return (self.d_ratio_min + self.d_ratio_max) / 2.0
+
+    @property
+    def e_avg(self):
+        return (self.e_ratio_min + self.e_ratio_max) / 2.0
+
+    @property
+    def n_avg(self):
+        return (self.n_ratio_min + self.n_ratio_max) / 2.0
+
+    def units_range(self, ratio):
+        """某組護病比（D / E / N）下的 (最少, 最多) 能力單位（未含加開）"""
+        r_min, r_max = self.ratios.get(ratio, self.ratios["D"])
+        return ceil(self.total_beds / max(r_max, 1)), ceil(self.total_beds / max(r_min, 1))
+
+
+@dataclass
+class ScheduleSettings:
+    """排班規則與引擎選項；as_dict() 即 schedule_month 的 settings"""
+    allow_cross: bool = True
+    prefer_off_holiday: bool = True
+    min_monthly_off: int = 8
+    balance_monthly_off: bool = True
+    min_work_stretch: int = 3
+    min_work_days: int = 15
+    max_work_days: int = 22
+    local_search_iters: int = 20000
+    initial_assign: str = "greedy"   # 初排："greedy"（逐人挑選）、"flow"（每日最小成本流）或 "pattern"（合法樣式）
+    engine: str = "greedy"           # "greedy"、"cp-sat"（整月精確解改善）或 "lns"（逐視窗大鄰域搜尋）
+    solver_time_limit: float = 10.0  # 精確解／大鄰域搜尋總時限（秒）
+    lns_window_time: float = 2.0     # 大鄰域搜尋每個視窗的求解時限（秒）
+    lns_workers: int = None          # 大鄰域搜尋平行行程數（None = 核心數）
+    deadline_ms: float = None        # 整次排班時限（毫秒，None = 不限）；逾時回傳目前最佳班表
+    d_avg: float = 6.5
+    e_avg: float = 11.0
+    n_avg: float = 15.5
+    shift_catalogue: dict = field(default=None)  # None = 預設 D/E/N
+
+    @classmethod
+    def for_demand(cls, demand, **kwargs):
+        """以需求參數的平均護病比建立（新人能力單位與需求一致）"""
+        return cls(d_avg=demand.d_avg, e_avg=demand.e_avg, n_avg=demand.n_avg, **kwargs)
+
+    def as_dict(self):
+        return asdict(self)
@@ -0,0 +1,400 @@
+"""
+區網排班服務（標準函式庫 http.server，不需額外套件）：
+
+    nursing-schedule-server --data-dir nursing_data --host 0.0.0.0 --port 8765 --workers 2
+
+  POST /jobs                       送出排班工作（JSON，見 parse_job），回 202 與 job_id；
+                                   輸入（請求 + 資料目錄內容）雜湊相同且未失敗的工作直接回同一個 job_id
+  GET  /jobs/<id>                  狀態 queued / running / done / failed，完成時附 report
+  GET  /jobs/<id>/roster           班表（預設 JSON；?format=csv 為 CSV）
+  GET  /jobs/<id>/summary          統計
+  GET  /jobs/<id>/compliance       達標
+  GET  /users                      人員清單（不含 pwd4）
+  GET  /prefs?year=&month=         該月請休（每人一列：must 必休日、wish 想休日，空白 = 必休以外每天）
+  GET  /metrics                    排隊數、執行中、完成／失敗／合併次數、吞吐量
+
+工作在有上限的行程池裡執行；池滿時在池的佇列排隊。完成的工作只保留最近 MAX_FINISHED_JOBS 筆。
+資料目錄的結果快取（cache.ResultCache）有同樣輸入的結果時直接完成，不進行程池；
+排完（未逾時中止）的結果寫回快取。
+"""
+import argparse
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import fields
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+from .data import demand_for, input_fingerprint, open_store
+from .engine import schedule_month, schedule_best_of
+from .params import DERIVED_SETTINGS, SETTING_CHOICES, STORE_BACKENDS, DemandParams, ScheduleSettings
+
+MAX_FINISHED_JOBS = 256     # 保留的已完成工作數（超過時丟最舊的）
+MAX_RUNS = 16               # 單一工作多起點次數上限
+THROUGHPUT_WINDOW = 60.0    # 吞吐量統計視窗（秒）
+RESULT_TABLES = {"roster": 0, "summary": 1, "compliance": 2}
+
+
+class JobError(ValueError):
+    """請求內容不合法（回 400）"""
+
+
+def _json_default(o):
+    # report 裡的表（規則收斂等）、numpy 純量、日期等
+    if isinstance(o, pd.DataFrame):
+        return o.to_dict(orient="records")
+    if hasattr(o, "item"):
+        return o.item()
+    return str(o)
+
+def _dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, default=_json_default)
+
+def _frame_records(df):
+    return json.loads(df.to_json(orient="records", force_ascii=False))
+
+# ================== 請求 → 排班輸入 ==================
+def _field_value(label, f, value):
+    """請求裡的一個參數欄位 → 依 dataclass 欄位型別檢查／轉換後的值；不合法丟 JobError"""
+    if value is None:
+        if f.default is None:
+            return None
+        raise JobError(f"{label} 不可為 null")
+    if f.type is bool:
+        if isinstance(value, bool):
+            return value
+        raise JobError(f"{label} 須為 true / false")
+    if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+        raise JobError(f"{label} 型別不正確")
+    if f.type is str:
+        if not isinstance(value, str):
+            raise JobError(f"{label} 須為字串")
+        choices = SETTING_CHOICES.get(f.name)
+        if choices and value not in choices:
+            raise JobError(f"{label} 須為 {' / '.join(choices)}")
+        return value
+    try:
+        number = float(value)
+    except ValueError:
+        raise JobError(f"{label} 須為數字") from None
+    if not math.isfinite(number):
+        raise JobError(f"{label} 須為有限數字")
+    if f.type is int:
+        if number != int(number):
+            raise JobError(f"{label} 須為整數")
+        return int(number)
+    return number
+
+def parse_job(body, store):
+    """
+    請求 JSON：
+      year, month（必填）；seed（預設 0）、runs（預設 1）；
+      demand：DemandParams 欄位（床數、護病比區間），依資料目錄的加開人力產生每日需求；
+      demand_table：直接給每日需求表（列的清單，欄位同畫面），有給就不用 demand 產生；
+      settings：ScheduleSettings 欄位（d_avg 等推導欄位除外）。
+    回傳 (排班參數 dict, 輸入雜湊)。
+    """
+    if not isinstance(body, dict):
+        raise JobError("請求須為 JSON 物件")
+    try:
+        year, month = int(body["year"]), int(body["month"])
+        seed, runs = int(body.get("seed", 0)), int(body.get("runs", 1))
+    except KeyError as e:
+        raise JobError(f"缺少欄位 {e.args[0]}") from None
+    except (TypeError, ValueError):
+        raise JobError("year / month / seed / runs 須為整數") from None
+    if not 1 <= month <= 12:
+        raise JobError("month 須為 1–12")
+    if not 1 <= runs <= MAX_RUNS:
+        raise JobError(f"runs 須為 1–{MAX_RUNS}")
+
+    def pick(section, cls, skip=()):
+        given = body.get(section) or {}
+        if not isinstance(given, dict):
+            raise JobError(f"{section} 須為 JSON 物件")
+        by_name = {f.name: f for f in fields(cls) if f.name not in skip}
+        unknown = sorted(set(given) - set(by_name))
+        if unknown:
+            raise JobError(f"{section} 不認得的欄位：{', '.join(unknown)}")
+        return {name: _field_value(f"{section}.{name}", by_name[name], value)
+                for name, value in given.items()}
+
+    demand_params = DemandParams(**pick("demand", DemandParams))
+    rule_kwargs = pick("settings", ScheduleSettings, DERIVED_SETTINGS)
+
+    catalogue = store.load_shifts()
+    settings = ScheduleSettings.for_demand(demand_params, shift_catalogue=catalogue, **rule_kwargs)
+    if body.get("demand_table") is not None:
+        try:
+            df_demand = pd.DataFrame(body["demand_table"])
+        except (TypeError, ValueError):
+            raise JobError("demand_table 須為列的清單") from None
+        missing = [c for s in catalogue for c in (f"{s}_min_units", f"{s}_max_units")
+                   if c not in df_demand.columns]
+        if "day" not in df_demand.columns or missing:
+            raise JobError("demand_table 缺少欄位：" + ", ".join((["day"] if "day" not in df_demand.columns else []) + missing))
+    else:
+        df_demand = demand_for(store, year, month, demand_params, catalogue)
+
+    job = {
+        "year": year, "month": month, "seed": seed, "runs": runs,
+        "users": store.load_users(), "prefs": store.load_prefs(year, month),
+        "holidays": store.load_holidays(year, month),
+        "demand": df_demand, "settings": settings.as_dict(),
+    }
+    # 雜湊涵蓋實際送進引擎的全部內容（含資料目錄讀出的表），資料一改就不會誤合併
+    digest = input_fingerprint(year, month, job["users"], job["prefs"], job["holidays"],
+                               df_demand, job["settings"], seed=seed, runs=runs)
+    return job, digest
+
+def _run_job(job):
+    """在行程池裡跑；回傳同 schedule_month"""
+    inputs = (job["year"], job["month"], job["users"], job["prefs"], job["holidays"],
+              job["demand"], job["settings"])
+    if job["runs"] > 1:
+        return schedule_best_of(*inputs, seeds=range(job["seed"], job["seed"] + job["runs"]))
+    return schedule_month(*inputs, seed=job["seed"])
+
+# ================== 工作表（行程池 + 依雜湊合併） ==================
+class JobManager:
+    def __init__(self, store, workers=None):
+        self.store = store
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()   # job_id → 工作紀錄（送出順序）
+        self.by_hash = {}           # 輸入雜湊 → job_id（只留未失敗的）
+        self.started_at = time.time()
+        self.counts = {"送出": 0, "合併": 0, "快取": 0, "完成": 0, "失敗": 0}
+        self.finished_times = deque()   # 最近完成時刻（吞吐量）
+        self.run_seconds = 0.0
+
+    def submit(self, body):
+        """回傳 (job_id, 是否與既有工作合併)"""
+        job, digest = parse_job(body, self.store)
+        cached = self.store.results.get(digest)   # 磁碟結果快取（服務重啟、其他端排過的同樣輸入）
+        with self.lock:
+            self.counts["送出"] += 1
+            jid = self.by_hash.get(digest)
+            if jid is not None and jid in self.jobs:
+                self.counts["合併"] += 1
+                return jid, True
+            jid = uuid.uuid4().hex[:12]
+            rec = {"id": jid, "hash": digest, "year": job["year"], "month": job["month"],
+                   "submitted": time.time(), "finished": None, "result": None, "error": None}
+            if cached is not None:
+                self.counts["快取"] += 1
+                rec.update(future=None, finished=rec["submitted"], result=cached)
+                self.jobs[jid] = rec
+                self.by_hash[digest] = jid
+                self._evict()
+                return jid, False
+            rec["future"] = self.pool.submit(_run_job, job)
+            self.jobs[jid] = rec
+            self.by_hash[digest] = jid
+        rec["future"].add_done_callback(lambda fut, jid=jid: self._finish(jid, fut))
+        return jid, False
+
+    def _finish(self, jid, fut):
+        now = time.time()
+        with self.lock:
+            rec = self.jobs.get(jid)
+            if rec is None:
+                return
+            rec["finished"] = now
+            try:
+                rec["result"] = fut.result()
+                self.counts["完成"] += 1
+                self.run_seconds += float(rec["result"][3].get("秒數", 0.0))
+            except Exception as e:
+                rec["error"] = f"{type(e).__name__}: {e}"
+                self.counts["失敗"] += 1
+                if self.by_hash.get(rec["hash"]) == jid:
+                    del self.by_hash[rec["hash"]]   # 失敗的不合併，可重送
+            self.finished_times.append(now)
+            self._evict()
+            result = rec["result"]
+        if result is not None and not result[3].get("已取消"):
+            self.store.results.put(rec["hash"], result)
+            self.store.save_roster(result[0], rec["year"], rec["month"])
+
+    def _evict(self):
+        finished = [j for j, r in self.jobs.items() if r["finished"] is not None]
+        for jid in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            rec = self.jobs.pop(jid)
+            if self.by_hash.get(rec["hash"]) == jid:
+                del self.by_hash[rec["hash"]]
+
+    def _states(self):
+        """
+        job_id → 狀態。行程池依送出順序執行，未完成的前 workers 筆即執行中
+        （future.running() 對已送進池內佇列、還沒有行程接手的工作也回 True，不可靠）。
+        """
+        out, running = {}, 0
+        for jid, rec in self.jobs.items():
+            if rec["finished"] is not None:
+                out[jid] = "failed" if rec["error"] else "done"
+            elif running < self.workers:
+                out[jid] = "running"
+                running += 1
+            else:
+                out[jid] = "queued"
+        return out
+
+    def status(self, jid):
+        with self.lock:
+            rec = self.jobs.get(jid)
+            if rec is None:
+                return None
+            out = {"job_id": jid, "status": self._states()[jid], "year": rec["year"],
+                   "month": rec["month"], "hash": rec["hash"],
+                   "submitted": rec["submitted"], "finished": rec["finished"]}
+            if rec["error"]:
+                out["error"] = rec["error"]
+            if rec["result"] is not None:
+                out["report"] = rec["result"][3]
+            return out
+
+    def result(self, jid, table):
+        """已完成工作的某張表；未完成回 None，工作不存在丟 KeyError"""
+        with self.lock:
+            rec = self.jobs[jid]
+            if rec["result"] is None:
+                return None
+            return rec["result"][RESULT_TABLES[table]]
+
+    def metrics(self):
+        now = time.time()
+        with self.lock:
+            while self.finished_times and now - self.finished_times[0] > THROUGHPUT_WINDOW:
+                self.finished_times.popleft()
+            states = list(self._states().values())
+            done = self.counts["完成"]
+            uptime = now - self.started_at
+            return {
+                "workers": self.workers,
+                "queue_depth": states.count("queued"),
+                "running": states.count("running"),
+                "submitted": self.counts["送出"],
+                "coalesced": self.counts["合併"],
+                "cache_hits": self.counts["快取"],
+                "completed": done,
+                "failed": self.counts["失敗"],
+                "jobs_per_minute": round(len(self.finished_times) * 60.0 / THROUGHPUT_WINDOW, 2),
+                "jobs_per_minute_overall": round(done * 60.0 / max(uptime, 1e-9), 2),
+                "avg_run_seconds": round(self.run_seconds / done, 3) if done else None,
+                "uptime_seconds": round(uptime, 1),
+            }
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+# ================== HTTP ==================
+class ScheduleHandler(BaseHTTPRequestHandler):
+    manager = None   # make_server 指定
+
+    def _send(self, code, body, content_type="application/json; charset=utf-8"):
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _json(self, code, obj):
+        self._send(code, _dumps(obj))
+
+    def _error(self, code, msg):
+        self._json(code, {"error": msg})
+
+    def log_message(self, fmt, *args):
+        pass   # 不逐筆印存取紀錄
+
+    def do_POST(self):
+        if urlparse(self.path).path.rstrip("/") != "/jobs":
+            return self._error(404, "not found")
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except (ValueError, UnicodeDecodeError):
+            return self._error(400, "請求內容不是合法 JSON")
+        try:
+            jid, coalesced = self.manager.submit(body)
+        except JobError as e:
+            return self._error(400, str(e))
+        except Exception as e:   # 其餘錯誤也回 JSON，不讓連線沒有回應就斷掉
+            return self._error(500, f"{type(e).__name__}: {e}")
+        status = self.manager.status(jid)
+        self._json(200 if coalesced else 202,
+                   {"job_id": jid, "status": status["status"] if status else "done", "coalesced": coalesced})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        parts = [p for p in url.path.split("/") if p]
+        m = self.manager
+        try:
+            if parts == ["metrics"]:
+                return self._json(200, m.metrics())
+            if parts == ["users"]:
+                users = m.store.load_users().drop(columns=["pwd4"], errors="ignore")
+                return self._json(200, _frame_records(users))
+            if parts == ["prefs"]:
+                year, month = int(query["year"][0]), int(query["month"][0])
+                return self._json(200, _frame_records(m.store.load_prefs(year, month)))
+            if len(parts) == 2 and parts[0] == "jobs":
+                status = m.status(parts[1])
+                if status is None:
+                    return self._error(404, "job not found")
+                return self._json(200, status)
+            if len(parts) == 3 and parts[0] == "jobs" and parts[2] in RESULT_TABLES:
+                try:
+                    df = m.result(parts[1], parts[2])
+                except KeyError:
+                    return self._error(404, "job not found")
+                if df is None:
+                    return self._error(409, "job not finished")
+                if query.get("format", ["json"])[0] == "csv":
+                    return self._send(200, df.to_csv(index=False), "text/csv; charset=utf-8")
+                return self._json(200, _frame_records(df))
+        except (KeyError, ValueError):
+            return self._error(400, "查詢參數不正確")
+        self._error(404, "not found")
+
+
+def make_server(data_dir, host="127.0.0.1", port=8765, workers=None, backend="auto"):
+    """建立（尚未啟動的）服務；回傳 (server, manager)。backend 見 data.open_store"""
+    manager = JobManager(open_store(data_dir, backend), workers)
+    handler = type("BoundScheduleHandler", (ScheduleHandler,), {"manager": manager})
+    return ThreadingHTTPServer((host, port), handler), manager
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="nursing-schedule-server", description="區網排班服務")
+    p.add_argument("--data-dir", default="nursing_data", help="資料目錄（users.csv、prefs_*.csv …）")
+    p.add_argument("--host", default="127.0.0.1", help="綁定位址（區網存取用 0.0.0.0）")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--workers", type=int, default=None, help="排班行程數（預設核心數）")
+    p.add_argument("--store", choices=STORE_BACKENDS, default="auto",
+                   help="資料儲存（auto：資料目錄有 nursing.db 就用 SQLite，否則 CSV）")
+    args = p.parse_args(argv)
+
+    server, manager = make_server(args.data_dir, args.host, args.port, args.workers, args.store)
+    print(f"排班服務：http://{args.host}:{args.port}（{manager.workers} 個行程）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        manager.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,413 @@
+"""
+SQLite 資料目錄（資料目錄下的 nursing.db，WAL 模式）：與 CsvStore 相同的讀寫介面，
+另有單筆寫入（add_user、upsert_user、save_nurse_prefs 只寫一列），同一晚上百人送請休也不會互相覆蓋、不必重寫整個月。
+
+    nursing-schedule-migrate --data-dir nursing_data     # 把既有 CSV 匯入 nursing.db
+
+資料表（皆有索引）：
+  users      人員（employee_id 唯一；依加入順序讀出）
+  prefs      請休（year, month, nurse_id 一列：必休日、想休日，見 engine.PREF_COLUMNS）
+  holidays   假日（year, month, date）
+  extra      加開人力（year, month, day, shift, units；長表，班別目錄變了也不必改表）
+  shifts     自訂班別目錄（可無）
+  rosters    最近一次產生的班表（year, month 一列一位護理師，各日代碼存成 JSON）
+WAL 讓讀不擋寫、寫不擋讀；寫入一律 BEGIN IMMEDIATE，多個行程同時寫時依序排隊（busy timeout）。
+連線每個執行緒各一條（sqlite3 連線不可跨執行緒共用）。
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import pandas as pd
+
+from .cache import ResultCache
+from .data import USER_COLUMNS, shift_catalogue_from_frame
+from .engine import PREF_COLUMNS, SHIFT_CATALOGUE, compact_prefs, days_in_month, pref_record
+
+DB_NAME = "nursing.db"
+BUSY_TIMEOUT = 30.0   # 等待其他連線寫完的秒數
+SHIFT_COLUMNS = ["code", "segments", "ratio", "white", "label"]
+ROSTER_BASE = ["id", "shift", "senior", "junior"]
+MONTHLY_CSV = re.compile(r"^(prefs|holidays|extra|roster)_(\d{4})_(\d{2})\.csv$")
+
+PREFS_TABLE = """
+CREATE TABLE IF NOT EXISTS prefs (
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    nurse_id TEXT NOT NULL,
+    must TEXT NOT NULL DEFAULT '',
+    wish TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (year, month, nurse_id)
+);"""
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS users (
+    pos INTEGER PRIMARY KEY,
+    {", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in USER_COLUMNS)}
+);
+{PREFS_TABLE}
+CREATE TABLE IF NOT EXISTS holidays (
+    pos INTEGER PRIMARY KEY,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    date TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS holidays_month ON holidays (year, month);
+CREATE TABLE IF NOT EXISTS extra (
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    shift TEXT NOT NULL,
+    units INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (year, month, day, shift)
+);
+CREATE TABLE IF NOT EXISTS shifts (
+    pos INTEGER PRIMARY KEY,
+    {", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in SHIFT_COLUMNS)}
+);
+CREATE TABLE IF NOT EXISTS rosters (
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    pos INTEGER NOT NULL,
+    {", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in ROSTER_BASE)},
+    days TEXT NOT NULL,
+    PRIMARY KEY (year, month, pos)
+);
+"""
+
+
+_initialized = set()   # 本行程已初始化的資料庫檔
+_init_lock = threading.Lock()
+
+
+def _text(v):
+    return "" if pd.isna(v) else str(v)
+
+
+class SqliteStore:
+    """介面同 CsvStore；資料在 data_dir/nursing.db，結果快取同樣在 data_dir/result_cache"""
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        os.makedirs(data_dir, exist_ok=True)
+        self.db_path = os.path.join(data_dir, DB_NAME)
+        self._local = threading.local()
+        self.results = ResultCache(os.path.join(data_dir, "result_cache"))
+        self._init_db()
+
+    def _init_db(self):
+        """WAL、建表與舊表升級：每個資料庫檔每個行程只做一次"""
+        key = os.path.realpath(self.db_path)
+        with _init_lock:
+            if key in _initialized and os.path.exists(self.db_path):
+                return
+            conn = self._conn()
+            conn.execute("PRAGMA journal_mode=WAL")   # 寫在資料庫檔裡，之後的連線沿用
+            conn.executescript(SCHEMA)
+            self._unique_users()
+            self._upgrade_prefs()
+            _initialized.add(key)
+
+    # ---- 連線與交易 ----
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")   # WAL 下仍保證一致，只是斷電可能少最後一筆
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """關閉本執行緒的連線（最後一條連線關閉時 WAL 會併回資料庫檔）"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    @contextmanager
+    def _tx(self):
+        """寫入交易：一開始就取得寫鎖，整段讀-改-寫不會被其他連線插隊"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _query(self, sql, params=()):
+        return pd.read_sql_query(sql, self._conn(), params=params)
+
+    @staticmethod
+    def _rows(df, cols):
+        """DataFrame → 依 cols 順序的文字值列（缺欄補空字串）"""
+        present = [c if c in df.columns else None for c in cols]
+        return [tuple(_text(getattr(r, c)) if c else "" for c in present)
+                for r in df.itertuples(index=False)] if not df.empty else []
+
+    # ---- 人員 ----
+    def load_users(self):
+        return self._query(f"SELECT {', '.join(USER_COLUMNS)} FROM users ORDER BY pos")
+
+    def save_users(self, df):
+        with self._tx() as conn:
+            self._replace_users(conn, df)
+
+    @classmethod
+    def _replace_users(cls, conn, df):
+        # 員編唯一：整表儲存時重複的員編以後面那一列為準
+        conn.execute("DELETE FROM users")
+        conn.executemany(f"INSERT OR REPLACE INTO users ({', '.join(USER_COLUMNS)}) "
+                         f"VALUES ({', '.join('?' * len(USER_COLUMNS))})",
+                         cls._rows(df, USER_COLUMNS))
+
+    def _unique_users(self):
+        """員編唯一索引（空白員編除外）；舊資料庫的重複員編只留最早的一列（登入本來就只認那一列）"""
+        with self._tx() as conn:
+            conn.execute("DROP INDEX IF EXISTS users_employee_id")
+            conn.execute("DELETE FROM users WHERE employee_id <> '' AND pos NOT IN "
+                         "(SELECT MIN(pos) FROM users WHERE employee_id <> '' GROUP BY employee_id)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS users_employee_id_unique "
+                         "ON users (employee_id) WHERE employee_id <> ''")
+
+    def find_user(self, employee_id):
+        """員編 → 該列（Series），沒有回傳 None"""
+        df = self._query(f"SELECT {', '.join(USER_COLUMNS)} FROM users WHERE employee_id = ? "
+                         f"ORDER BY pos LIMIT 1", (str(employee_id),))
+        return None if df.empty else df.iloc[0]
+
+    def add_user(self, record):
+        """新增一位人員；員編已存在時不寫入、回傳 False（同時註冊同一員編只有一人成功）"""
+        cols = [c for c in USER_COLUMNS if c in record]
+        try:
+            self._conn().execute(f"INSERT INTO users ({', '.join(cols)}) "
+                                 f"VALUES ({', '.join('?' * len(cols))})",
+                                 [_text(record[c]) for c in cols])
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def upsert_user(self, record):
+        """新增或更新一位人員（依 employee_id）；其餘人員不動"""
+        cols = [c for c in USER_COLUMNS if c in record]
+        values = [_text(record[c]) for c in cols]
+        with self._tx() as conn:
+            cur = conn.execute(f"UPDATE users SET {', '.join(f'{c} = ?' for c in cols)} "
+                               f"WHERE employee_id = ?", (*values, str(record["employee_id"])))
+            if cur.rowcount == 0:
+                conn.execute(f"INSERT INTO users ({', '.join(cols)}) "
+                             f"VALUES ({', '.join('?' * len(cols))})", values)
+
+    # ---- 請休 ----
+    def _upgrade_prefs(self):
+        """舊版每人每天一列的 prefs 表 → 每人每月一列（在寫入交易裡檢查，多個行程同時開啟也只轉一次）"""
+        with self._tx() as conn:
+            cols = {r[1] for r in conn.execute("PRAGMA table_info(prefs)")}
+            if "date" not in cols:
+                return
+            old = pd.read_sql_query("SELECT year, month, nurse_id, date, type FROM prefs ORDER BY pos", conn)
+            conn.execute("DROP TABLE prefs")
+            conn.execute("DROP INDEX IF EXISTS prefs_month_nurse")
+            conn.execute(PREFS_TABLE)
+            for (year, month), df in old.groupby(["year", "month"], sort=False):
+                self._replace_prefs(conn, df, year, month)
+
+    def load_prefs(self, year, month):
+        return self._query(f"SELECT {', '.join(PREF_COLUMNS)} FROM prefs WHERE year = ? AND month = ? "
+                           f"ORDER BY rowid", (int(year), int(month)))
+
+    def save_prefs(self, df, year, month):
+        with self._tx() as conn:
+            self._replace_prefs(conn, df, year, month)
+
+    @classmethod
+    def _replace_prefs(cls, conn, df, year, month):
+        conn.execute("DELETE FROM prefs WHERE year = ? AND month = ?", (int(year), int(month)))
+        conn.executemany(f"INSERT OR REPLACE INTO prefs (year, month, {', '.join(PREF_COLUMNS)}) "
+                         f"VALUES (?, ?, {', '.join('?' * len(PREF_COLUMNS))})",
+                         [(int(year), int(month), *r)
+                          for r in cls._rows(compact_prefs(df, year, month), PREF_COLUMNS)])
+
+    def save_nurse_prefs(self, nurse_id, year, month, must_days, wish_days=None):
+        """只 upsert 某位護理師當月的那一列（wish_days 為 None 時想休日隱含）；其他人的列不動"""
+        rec = pref_record(nurse_id, year, month, must_days, wish_days)
+        self._conn().execute(
+            "INSERT INTO prefs (year, month, nurse_id, must, wish) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (year, month, nurse_id) DO UPDATE SET must = excluded.must, wish = excluded.wish",
+            (int(year), int(month), str(nurse_id), rec["must"], rec["wish"]))
+
+    # ---- 假日 ----
+    def load_holidays(self, year, month):
+        return self._query("SELECT date FROM holidays WHERE year = ? AND month = ? ORDER BY pos",
+                           (int(year), int(month)))
+
+    def save_holidays(self, df, year, month):
+        with self._tx() as conn:
+            self._replace_holidays(conn, df, year, month)
+
+    @classmethod
+    def _replace_holidays(cls, conn, df, year, month):
+        conn.execute("DELETE FROM holidays WHERE year = ? AND month = ?", (int(year), int(month)))
+        conn.executemany("INSERT INTO holidays (year, month, date) VALUES (?, ?, ?)",
+                         [(int(year), int(month), *r) for r in cls._rows(df, ["date"])])
+
+    # ---- 加開人力 ----
+    def load_extra(self, year, month, shift_codes=None):
+        if shift_codes is None:
+            shift_codes = list(self.load_shifts())
+        nd = days_in_month(year, month)
+        df = pd.DataFrame({"day": list(range(1, nd+1))})
+        for s in shift_codes:
+            df[f"{s}_extra"] = 0
+        rows = self._conn().execute("SELECT day, shift, units FROM extra WHERE year = ? AND month = ?",
+                                    (int(year), int(month))).fetchall()
+        for day, shift, units in rows:
+            col = f"{shift}_extra"
+            if col in df.columns and 1 <= day <= nd:
+                df.at[day - 1, col] = units
+        return df
+
+    def save_extra(self, df, year, month):
+        with self._tx() as conn:
+            self._replace_extra(conn, df, year, month)
+
+    @staticmethod
+    def _replace_extra(conn, df, year, month):
+        conn.execute("DELETE FROM extra WHERE year = ? AND month = ?", (int(year), int(month)))
+        if "day" not in df.columns:
+            return
+        shift_cols = [(c[:-len("_extra")], c) for c in df.columns if str(c).endswith("_extra")]
+        rows = []
+        for r in df.to_dict("records"):
+            if pd.isna(r["day"]):
+                continue
+            for shift, col in shift_cols:
+                units = 0 if pd.isna(r[col]) else int(r[col])
+                if units:
+                    rows.append((int(year), int(month), int(r["day"]), shift, units))
+        conn.executemany("INSERT OR REPLACE INTO extra (year, month, day, shift, units) "
+                         "VALUES (?, ?, ?, ?, ?)", rows)
+
+    # ---- 班別目錄 ----
+    def load_shifts(self):
+        df = self._query(f"SELECT {', '.join(SHIFT_COLUMNS)} FROM shifts ORDER BY pos")
+        return shift_catalogue_from_frame(df) if not df.empty else dict(SHIFT_CATALOGUE)
+
+    @classmethod
+    def _replace_shifts(cls, conn, df):
+        conn.execute("DELETE FROM shifts")
+        conn.executemany(f"INSERT INTO shifts ({', '.join(SHIFT_COLUMNS)}) "
+                         f"VALUES ({', '.join('?' * len(SHIFT_COLUMNS))})",
+                         cls._rows(df, SHIFT_COLUMNS))
+
+    # ---- 產生的班表 ----
+    def load_roster(self, year, month):
+        """最近一次產生的班表；沒有回傳 None"""
+        rows = self._conn().execute(
+            f"SELECT {', '.join(ROSTER_BASE)}, days FROM rosters WHERE year = ? AND month = ? ORDER BY pos",
+            (int(year), int(month))).fetchall()
+        if not rows:
+            return None
+        nd = days_in_month(year, month)
+        records = [dict(zip(ROSTER_BASE, r[:-1])) for r in rows]
+        for rec, r in zip(records, rows):
+            rec.update(zip((str(d) for d in range(1, nd+1)), json.loads(r[-1])))
+        return pd.DataFrame(records, columns=ROSTER_BASE + [str(d) for d in range(1, nd+1)])
+
+    def save_roster(self, roster_df, year, month):
+        with self._tx() as conn:
+            self._replace_roster(conn, roster_df, year, month)
+
+    @staticmethod
+    def _replace_roster(conn, roster_df, year, month):
+        day_cols = [c for c in roster_df.columns if c not in ROSTER_BASE]
+        rows = [(int(year), int(month), pos, *(_text(rec.get(c, "")) for c in ROSTER_BASE),
+                 json.dumps([_text(rec[c]) for c in day_cols], ensure_ascii=False))
+                for pos, rec in enumerate(roster_df.to_dict("records"))]
+        conn.execute("DELETE FROM rosters WHERE year = ? AND month = ?", (int(year), int(month)))
+        conn.executemany(f"INSERT INTO rosters (year, month, pos, {', '.join(ROSTER_BASE)}, days) "
+                         f"VALUES (?, ?, ?, {', '.join('?' * len(ROSTER_BASE))}, ?)", rows)
+
+    # ---- 從 CSV 資料目錄匯入 ----
+    def import_csv(self, csv_dir, replace=False):
+        """
+        匯入 CsvStore 資料目錄的 users.csv、shifts.csv 與各月 prefs_*、holidays_*、extra_*、roster_*；
+        整批一個交易。資料庫已有資料時除非 replace=True，否則丟 ValueError（避免重複匯入蓋掉新資料）。
+        原 CSV 不動。回傳各表匯入的列數。
+        """
+        monthly = []
+        for name in sorted(os.listdir(csv_dir)):
+            m = MONTHLY_CSV.match(name)
+            if m:
+                monthly.append((m.group(1), int(m.group(2)), int(m.group(3)), os.path.join(csv_dir, name)))
+        replacers = {"prefs": self._replace_prefs, "holidays": self._replace_holidays,
+                     "extra": self._replace_extra, "roster": self._replace_roster}
+        counts = dict.fromkeys(["users", "shifts", "prefs", "holidays", "extra", "roster"], 0)
+        tables = ["users", "shifts", "prefs", "holidays", "extra", "rosters"]
+
+        with self._tx() as conn:
+            if not replace:
+                existing = [t for t in tables if conn.execute(f"SELECT 1 FROM {t} LIMIT 1").fetchone()]
+                if existing:
+                    raise ValueError(f"資料庫已有資料（{'、'.join(existing)}）；要整批覆蓋請加 --replace")
+            for t in tables:
+                conn.execute(f"DELETE FROM {t}")
+
+            for kind, replace_fn in (("users", self._replace_users), ("shifts", self._replace_shifts)):
+                path = os.path.join(csv_dir, f"{kind}.csv")
+                if os.path.exists(path):
+                    df = pd.read_csv(path, dtype=str).fillna("")
+                    replace_fn(conn, df)
+                    counts[kind] = len(df)
+            for kind, year, month, path in monthly:
+                # 加開人力是數字；其餘同 CsvStore 以文字讀
+                df = pd.read_csv(path).fillna(0) if kind == "extra" else pd.read_csv(path, dtype=str).fillna("")
+                if kind == "prefs":
+                    df = compact_prefs(df, year, month)   # 舊的每人每天一列 → 每人一列
+                replacers[kind](conn, df, year, month)
+                counts[kind] += len(df)
+        return counts
+
+def main(argv=None):
+    p = argparse.ArgumentParser(prog="nursing-schedule-migrate",
+                                description="把資料目錄的 CSV 匯入同目錄的 SQLite（nursing.db）")
+    p.add_argument("--data-dir", default="nursing_data", help="資料目錄（users.csv、prefs_*.csv …）")
+    p.add_argument("--replace", action="store_true", help="資料庫已有資料時整批覆蓋")
+    args = p.parse_args(argv)
+    if not os.path.isdir(args.data_dir):
+        print(f"找不到資料目錄：{args.data_dir}", file=sys.stderr)
+        return 2
+    db_path = os.path.join(args.data_dir, DB_NAME)
+    try:
+        if os.path.exists(db_path):
+            # 既有資料庫：import_csv 整批一個交易，失敗就整批還原
+            store = SqliteStore(args.data_dir)
+            counts = store.import_csv(args.data_dir, replace=args.replace)
+        else:
+            # 新資料庫先在暫存目錄匯入，成功才搬進資料目錄；
+            # 否則留下半套或空的 nursing.db，auto 模式會直接改用它
+            tmp_dir = tempfile.mkdtemp(prefix=".migrate-", dir=args.data_dir)
+            try:
+                store = SqliteStore(tmp_dir)
+                counts = store.import_csv(args.data_dir, replace=args.replace)
+                store.close()
+                os.replace(store.db_path, db_path)
+            finally:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(f"已匯入 {db_path}：" + "、".join(f"{k} {v} 列" for k, v in counts.items()))
+    print("之後畫面、命令列與服務會自動改用 SQLite（--store csv 可指定沿用 CSV）")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,26 @@
+import pandas as pd
+import pytest
+
+from roster_engine.data import USER_COLUMNS, CsvStore
+
+YEAR, MONTH = 2025, 11
+NURSES = 12
+
+
+def unit_users(n=NURSES):
+    """小單位：白／小夜／大夜輪流，每三人兩位資深"""
+    rows = [{"employee_id": f"N{i:03d}", "name": f"n{i}", "pwd4": "1234",
+             "shift": "DEN"[i % 3], "weekly_cap": "", "senior": "TRUE" if i % 3 else "FALSE",
+             "junior": "FALSE"} for i in range(n)]
+    return pd.DataFrame(rows, columns=USER_COLUMNS)
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    """CSV 資料目錄：人員、當月請休與一個國定假日"""
+    store = CsvStore(str(tmp_path))
+    store.save_users(unit_users())
+    store.save_nurse_prefs("N000", YEAR, MONTH, [3, 4], [10])
+    store.save_nurse_prefs("N001", YEAR, MONTH, [], None)
+    store.save_holidays(pd.DataFrame({"date": [f"{YEAR}-{MONTH:02d}-11"]}), YEAR, MONTH)
+    return str(tmp_path)
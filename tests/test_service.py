@@ -0,0 +1,162 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from dataclasses import fields
+
+import pytest
+
+from roster_engine.params import ScheduleSettings
+from roster_engine.service import JobError, _field_value, make_server
+
+from conftest import MONTH, NURSES, YEAR
+
+JOB = {"year": YEAR, "month": MONTH, "demand": {"total_beds": 20}, "settings": {"local_search_iters": 0}}
+SETTING_FIELDS = {f.name: f for f in fields(ScheduleSettings)}
+
+
+@pytest.fixture
+def service(data_dir):
+    """在暫存資料目錄、隨機埠上啟動服務；回傳 (request 函式, JobManager)"""
+    server, manager = make_server(data_dir, port=0, workers=1, backend="csv")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def request(path, body=None, raw=None):
+        data = raw if raw is not None else (json.dumps(body).encode() if body is not None else None)
+        req = urllib.request.Request(base + path, data=data, method="GET" if data is None else "POST")
+        try:
+            with urllib.request.urlopen(req, timeout=60) as resp:
+                return resp.status, resp.read().decode("utf-8")
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode("utf-8")
+
+    yield request, manager
+    server.shutdown()
+    server.server_close()
+    manager.shutdown()
+
+
+def wait_done(request, jid, timeout=60.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        status = json.loads(request(f"/jobs/{jid}")[1])
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(0.1)
+    raise AssertionError(f"job {jid} not finished")
+
+
+# ---- _field_value ----
+@pytest.mark.parametrize("name, value, expected", [
+    ("allow_cross", False, False),
+    ("min_monthly_off", 9, 9),
+    ("min_monthly_off", "9", 9),
+    ("min_monthly_off", 9.0, 9),
+    ("solver_time_limit", "2.5", 2.5),
+    ("engine", "lns", "lns"),
+])
+def test_field_value_converts(name, value, expected):
+    got = _field_value(f"settings.{name}", SETTING_FIELDS[name], value)
+    assert got == expected and type(got) is type(expected)
+
+@pytest.mark.parametrize("name, value", [
+    ("allow_cross", "yes"),
+    ("allow_cross", 1),
+    ("min_monthly_off", True),
+    ("min_monthly_off", 8.5),
+    ("min_monthly_off", "eight"),
+    ("min_monthly_off", [8]),
+    ("min_monthly_off", None),
+    ("solver_time_limit", float("nan")),
+    ("solver_time_limit", "inf"),
+    ("engine", "simplex"),
+    ("engine", 3),
+])
+def test_field_value_rejects(name, value):
+    with pytest.raises(JobError):
+        _field_value(f"settings.{name}", SETTING_FIELDS[name], value)
+
+def test_field_value_nullable():
+    f = next(f for f in fields(ScheduleSettings) if f.default is None)
+    assert _field_value(f"settings.{f.name}", f, None) is None
+
+
+# ---- HTTP ----
+def test_job_runs_and_returns_tables(service):
+    request, _manager = service
+    code, body = request("/jobs", JOB)
+    assert code == 202
+    jid = json.loads(body)["job_id"]
+    status = wait_done(request, jid)
+    assert status["status"] == "done" and "分數" in status["report"]
+
+    code, body = request(f"/jobs/{jid}/roster")
+    assert code == 200 and len(json.loads(body)) == NURSES
+    code, body = request(f"/jobs/{jid}/summary?format=csv")
+    assert code == 200 and len(body.strip().splitlines()) == NURSES + 1
+
+def test_same_input_coalesces(service):
+    request, manager = service
+    first = json.loads(request("/jobs", JOB)[1])
+    code, body = request("/jobs", JOB)
+    second = json.loads(body)
+    assert code == 200 and second == dict(second, job_id=first["job_id"], coalesced=True)
+
+    other = json.loads(request("/jobs", dict(JOB, seed=3))[1])
+    assert other["job_id"] != first["job_id"] and not other["coalesced"]
+    assert manager.metrics()["coalesced"] == 1
+
+@pytest.mark.parametrize("body", [
+    {"month": MONTH},
+    {"year": YEAR, "month": 13},
+    {"year": YEAR, "month": MONTH, "runs": 0},
+    {"year": "x", "month": MONTH},
+    dict(JOB, settings={"bogus": 1}),
+    dict(JOB, settings={"d_avg": 1.0}),          # 推導欄位不可直接給
+    dict(JOB, settings={"allow_cross": "no"}),
+    dict(JOB, settings={"initial_assign": "random"}),
+    dict(JOB, demand={"total_beds": "many"}),
+    dict(JOB, demand=[20]),
+    dict(JOB, demand_table=[{"day": 1}]),
+    [JOB],
+])
+def test_invalid_job_is_400(service, body):
+    request, manager = service
+    code, resp = request("/jobs", body)
+    assert code == 400 and "error" in json.loads(resp)
+    assert manager.jobs == {}
+
+def test_malformed_json_is_400(service):
+    request, _manager = service
+    code, resp = request("/jobs", raw=b"{not json")
+    assert code == 400 and "error" in json.loads(resp)
+
+def test_unknown_paths_are_404(service):
+    request, _manager = service
+    for path, body in (("/jobs/missing", None), ("/jobs/missing/roster", None),
+                       ("/nothing", None), ("/elsewhere", JOB)):
+        code, resp = request(path, body)
+        assert code == 404 and "error" in json.loads(resp)
+
+def test_bad_query_is_400(service):
+    request, _manager = service
+    code, resp = request("/prefs?year=2025")
+    assert code == 400 and "error" in json.loads(resp)
+
+def test_unexpected_error_is_json_500(service, monkeypatch):
+    request, manager = service
+
+    def broken():
+        raise OSError("disk gone")
+    monkeypatch.setattr(manager.store, "load_shifts", broken)
+    code, resp = request("/jobs", JOB)
+    assert code == 500 and "disk gone" in json.loads(resp)["error"]
+
+def test_users_hide_password(service):
+    request, _manager = service
+    code, resp = request("/users")
+    users = json.loads(resp)
+    assert code == 200 and len(users) == NURSES and all("pwd4" not in u for u in users)
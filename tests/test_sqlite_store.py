@@ -0,0 +1,150 @@
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+import pytest
+from pandas.testing import assert_frame_equal
+
+from roster_engine.data import USER_COLUMNS, CsvStore, store_backend
+from roster_engine.engine import compact_prefs, preference_maps
+from roster_engine.sqlite_store import DB_NAME, SqliteStore, main
+
+from conftest import MONTH, NURSES, YEAR, unit_users
+
+# 每人每天一列的舊版 prefs 表與沒有唯一索引的 users 表（升級前的資料庫）
+OLD_SCHEMA = f"""
+CREATE TABLE users (
+    pos INTEGER PRIMARY KEY,
+    {", ".join(f"{c} TEXT NOT NULL DEFAULT ''" for c in USER_COLUMNS)}
+);
+CREATE INDEX users_employee_id ON users (employee_id);
+CREATE TABLE prefs (
+    pos INTEGER PRIMARY KEY,
+    nurse_id TEXT NOT NULL DEFAULT '',
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    date TEXT NOT NULL DEFAULT '',
+    type TEXT NOT NULL DEFAULT ''
+);
+"""
+
+
+def roster_frame(users):
+    days = {str(d): ["D" if (d + i) % 4 else "O" for i in range(len(users))] for d in range(1, 31)}
+    return pd.DataFrame({"id": users["employee_id"], "shift": users["shift"],
+                         "senior": users["senior"], "junior": users["junior"], **days})
+
+
+# ---- CSV → SQLite ----
+def test_migration_round_trip(data_dir):
+    csv = CsvStore(data_dir)
+    csv.save_roster(roster_frame(csv.load_users()), YEAR, MONTH)
+    assert main(["--data-dir", data_dir]) == 0
+    assert store_backend(data_dir) == "sqlite"
+
+    db = SqliteStore(data_dir)
+    assert_frame_equal(db.load_users(), csv.load_users())
+    assert_frame_equal(db.load_prefs(YEAR, MONTH), csv.load_prefs(YEAR, MONTH))
+    assert_frame_equal(db.load_holidays(YEAR, MONTH), csv.load_holidays(YEAR, MONTH))
+    assert_frame_equal(db.load_roster(YEAR, MONTH), csv.load_roster(YEAR, MONTH))
+
+def test_migration_refuses_existing_data(data_dir):
+    assert main(["--data-dir", data_dir]) == 0
+    CsvStore(data_dir).upsert_user({"employee_id": "N999", "name": "csv only"})
+    assert main(["--data-dir", data_dir]) == 2
+    assert SqliteStore(data_dir).find_user("N999") is None
+    assert main(["--data-dir", data_dir, "--replace"]) == 0
+    assert SqliteStore(data_dir).find_user("N999")["name"] == "csv only"
+
+def test_failed_migration_leaves_no_database(data_dir, monkeypatch):
+    def broken(*args):
+        raise OSError("disk full")
+    monkeypatch.setattr(SqliteStore, "_replace_holidays", broken)
+    with pytest.raises(OSError):
+        main(["--data-dir", data_dir])
+    assert not os.path.exists(os.path.join(data_dir, DB_NAME))
+    assert not [n for n in os.listdir(data_dir) if n.startswith(".migrate-")]
+    assert store_backend(data_dir) == "csv"
+
+def test_migration_keeps_last_duplicate_user(data_dir):
+    users = unit_users()
+    dup = users.iloc[[1]].assign(name="renamed")
+    CsvStore(data_dir).save_users(pd.concat([users, dup], ignore_index=True))
+    assert main(["--data-dir", data_dir]) == 0
+
+    loaded = SqliteStore(data_dir).load_users()
+    assert len(loaded) == NURSES and loaded["employee_id"].is_unique
+    assert SqliteStore(data_dir).find_user("N001")["name"] == "renamed"
+
+def test_legacy_prefs_csv_migrates_compact(data_dir):
+    legacy = pd.DataFrame({"nurse_id": ["N002", "N002", "N003"],
+                           "date": [f"{YEAR}-{MONTH:02d}-05", f"{YEAR}-{MONTH:02d}-06",
+                                    f"{YEAR}-{MONTH:02d}-07"],
+                           "type": ["must", "wish", "must"]})
+    legacy.to_csv(os.path.join(data_dir, f"prefs_{YEAR}_{MONTH:02d}.csv"), index=False)
+    assert main(["--data-dir", data_dir]) == 0
+    assert_frame_equal(SqliteStore(data_dir).load_prefs(YEAR, MONTH), compact_prefs(legacy, YEAR, MONTH))
+
+
+# ---- 舊版資料庫升級 ----
+def test_old_database_upgrades(tmp_path):
+    legacy = pd.DataFrame({"nurse_id": ["N000", "N000", "N000", "N001"],
+                           "year": YEAR, "month": MONTH,
+                           "date": [f"{YEAR}-{MONTH:02d}-{d:02d}" for d in (3, 4, 10, 20)],
+                           "type": ["must", "must", "wish", "must"]})
+    conn = sqlite3.connect(tmp_path / DB_NAME)
+    conn.executescript(OLD_SCHEMA)
+    conn.executemany("INSERT INTO users (employee_id, name) VALUES (?, ?)",
+                     [("N000", "first"), ("N001", "b"), ("N000", "second")])
+    conn.executemany("INSERT INTO prefs (nurse_id, year, month, date, type) VALUES (?, ?, ?, ?, ?)",
+                     legacy.itertuples(index=False))
+    conn.commit()
+    conn.close()
+
+    store = SqliteStore(str(tmp_path))
+    users = store.load_users()
+    assert list(users["employee_id"]) == ["N000", "N001"]
+    assert store.find_user("N000")["name"] == "first"
+    assert not store.add_user({"employee_id": "N000", "name": "third"})
+
+    prefs = store.load_prefs(YEAR, MONTH)
+    assert_frame_equal(prefs, compact_prefs(legacy.drop(columns=["year", "month"]), YEAR, MONTH))
+    must, wish = preference_maps(prefs, YEAR, MONTH)
+    assert set(must["N000"]) == {3, 4} and set(wish["N000"]) == {10}
+
+
+# ---- 同時寫入 ----
+@pytest.mark.parametrize("store_cls", [CsvStore, SqliteStore])
+def test_concurrent_writes_keep_every_row(tmp_path, store_cls):
+    store_cls(str(tmp_path)).save_users(unit_users())
+    threads_n, per_thread = 6, 5
+    errors = []
+
+    def work(t):
+        store = store_cls(str(tmp_path))   # 各執行緒自己開，模擬多個工作階段
+        try:
+            for k in range(per_thread):
+                nid = f"T{t}{k}"
+                store.upsert_user({"employee_id": nid, "name": nid, "shift": "D"})
+                store.upsert_user({"employee_id": f"N{t:03d}", "name": f"edited {k}"})
+                store.save_nurse_prefs(nid, YEAR, MONTH, [k + 1], [k + 2])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(t,)) for t in range(threads_n)]
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+    assert errors == []
+
+    store = store_cls(str(tmp_path))
+    users = store.load_users()
+    assert len(users) == NURSES + threads_n * per_thread and users["employee_id"].is_unique
+    for t in range(threads_n):
+        assert store.find_user(f"N{t:03d}")["name"] == f"edited {per_thread - 1}"
+    must, wish = preference_maps(store.load_prefs(YEAR, MONTH), YEAR, MONTH)
+    for t in range(threads_n):
+        for k in range(per_thread):
+            assert set(must[f"T{t}{k}"]) == {k + 1} and set(wish[f"T{t}{k}"]) == {k + 2}